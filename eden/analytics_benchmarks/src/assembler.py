@@ -3,6 +3,14 @@
 # not need to use something similar depending on how you
 # do query scheduling
 
+import math
+
+from catalog import matching_stats, ts_bounds, bid_price_only_on_impressions, impressions_in_every_group, type_matches, ROLLUP_LEVELS, \
+    standing_key
+
+# Columns whose filter values are numbers
+NUMERIC_COLUMNS = ["advertiser_id", "publisher_id", "user_id", "bid_price", "total_price"]
+
 def optimize_bid_price_or_impression_count_query_prefixes(q):
     """
     Constructs queries that only aggregate on bid_price or counts impressions
@@ -106,10 +114,33 @@ def optimize_bid_price_or_impression_count_query_prefixes(q):
     return sql.strip()
 
 
-def optimize_bid_price_or_impression_count_query(q):
+def rollup_table(level):
+    return f"events_bids_{level}s"
+
+
+def _rollup_level(q, levels):
+    """
+    The coarsest of the available rollup `levels` that still has every time
+    column `q` filters, groups, selects or orders by, or None if none does.
+    """
+    bucket_levels = {"m": "minute", "h": "hour", "d": "day", "w": "week"}
+    needed = len(ROLLUP_LEVELS) - 1
+    for item in [*q.get("select", []), *q.get("group_by", []),
+                 *(cond["col"] for cond in q.get("where", [])),
+                 *(o["col"] for o in q.get("order_by", []))]:
+        if _is_bucket(item):
+            needed = min(needed, ROLLUP_LEVELS.index(bucket_levels.get(item["bucket"][-1:], "minute")))
+        elif item in ROLLUP_LEVELS:
+            needed = min(needed, ROLLUP_LEVELS.index(item))
+    usable = [level for level in ROLLUP_LEVELS[:needed + 1] if level in levels]
+    return usable[-1] if usable else None
+
+
+def optimize_bid_price_or_impression_count_query(q, levels=("minute",)):
     """
     Constructs queries that only aggregate on bid_price or counts impressions
-    for optimization.
+    for optimization, reading the coarsest of the rollup `levels` that the
+    query's time columns allow.
     """
     select = q.get("select", [])
     where = q.get("where", [])
@@ -132,33 +163,46 @@ def optimize_bid_price_or_impression_count_query(q):
         # print("WHERE clause must filter for impressions and nothing else except optionally temporal columns")
         return False
 
-    # GROUP BY must either be a temporal column or absent
+    # GROUP BY must either be a temporal column, a time bucket or absent
     has_temporal_or_absent_group_by = (
         len(group_by) == 0 or
-        (len(group_by) == 1 and group_by[0] in temporals)
+        (len(group_by) == 1 and (_is_bucket(group_by[0]) or group_by[0] in temporals))
     )
     if not has_temporal_or_absent_group_by:
         # print("GROUP BY must either be a temporal column or absent")
         return False
 
-    # ORDER BY must be on a temporal column or absent
-    has_temporal_or_no_order_by = (
-        len(order_by) == 0 or
-        (len(order_by) == 1 and order_by[0].get("col") in temporals)
-    )
-    if not has_temporal_or_no_order_by:
-        # print("ORDER BY must be on a temporal column or absent")
-        return False
+    # ORDER BY must be on temporal columns or on the aggregations, so that
+    # top-N queries like ORDER BY SUM(bid_price) DESC LIMIT 10 stay on the rollup
+    aggregate_aliases = {
+        "COUNT(*)": '"count_star()"',
+        "SUM(BID_PRICE)": '"sum(bid_price)"',
+        "AVG(BID_PRICE)": '"avg(bid_price)"',
+    }
+    optimized_order_by = []
+    for o in order_by:
+        col = o.get("col")
+        if col in temporals or col == "bucket":
+            optimized_order_by.append(o)
+        elif col.replace(" ", "").upper() in aggregate_aliases:
+            optimized_order_by.append({**o, "col": aggregate_aliases[col.replace(" ", "").upper()]})
+        else:
+            # print("ORDER BY must be on a temporal column, an aggregation or absent")
+            return False
 
     # Check aggregations in SELECT
     # Only aggregations (AVG or SUM) on bid_price or COUNT(*) or temporals
     optimized_select = []
     for item in select:
-        if isinstance(item, dict):
+        if _is_bucket(item):
+            # Any bucket of whole minutes is a re-aggregation of minutes
+            optimized_select.append(item)
+        elif isinstance(item, dict):
             for func, col in item.items():
                 # We can answer COUNT(*) since we know we are filtering for impressions only
+                # COALESCE because COUNT over no rows is 0 where SUM is NULL
                 if col == "*" and func.upper() == "COUNT":
-                    optimized_select.append('SUM(count_impressions) AS "count_star()"')
+                    optimized_select.append('COALESCE(SUM(count_impressions), 0) AS "count_star()"')
 
                 # Allow any aggregation on bid_price
                 elif col == "bid_price" and func.upper() == "SUM":
@@ -177,29 +221,623 @@ def optimize_bid_price_or_impression_count_query(q):
                 # print("SELECT must be a single aggregation on bid_price or COUNT(*) or a temporal column")
                 return False
 
+    # Ordering by an aggregation needs it in SELECT to refer to its alias
+    selected = " ".join(item for item in optimized_select if isinstance(item, str))
+    if any(o["col"].startswith('"') and o["col"] not in selected for o in optimized_order_by):
+        return False
+
     # If we get here, the query can be executed with our optimized path
-    select_sql = _select_to_sql(optimized_select)
-    specialized_tbl = "events_bids_minutes"
+    level = _rollup_level(q, levels)
+    if level is None:
+        return False
+    # day and week are DATEs, cast so buckets come out like they do on minute
+    bucket_col = level if level in ("minute", "hour") else f"{level}::TIMESTAMP"
+    select_sql = _select_to_sql(optimized_select, bucket_col=bucket_col)
+    specialized_tbl = rollup_table(level)
     where_sql = _where_to_sql(optimized_where)
     group_by_sql = _group_by_to_sql(group_by)
+    order_by_sql = _order_by_to_sql(optimized_order_by)
+    limit_sql = _limit_to_sql(q)
+    sql = f"SELECT {select_sql} FROM {specialized_tbl} {where_sql} {group_by_sql} {order_by_sql} {limit_sql}"
+    return sql.strip()
+
+
+# Aggregations that run along the time column a query groups by, over the
+# groups up to each one: {"CUMSUM": col} is a running total and
+# {"MOVING_SUM": [col, "60m"]} the total of the trailing 60 minutes. col is a
+# column to sum or "*" to count rows.
+WINDOW_AGGREGATES = ("CUMSUM", "MOVING_SUM")
+INTERVAL_MINUTES = {"m": 1, "h": 60, "d": 24 * 60, "w": 7 * 24 * 60}
+TIME_WIDTH_MINUTES = {"minute": 1, "hour": 60, "day": 24 * 60, "week": 7 * 24 * 60}
+
+
+def _interval_minutes(spec):
+    n, unit = spec[:-1], spec[-1:]
+    if not n.isdigit() or int(n) == 0 or unit not in INTERVAL_MINUTES:
+        raise ValueError(f"Invalid interval {spec!r}, expected e.g. '15m', '6h', '1d' or '2w'")
+    return int(n) * INTERVAL_MINUTES[unit]
+
+
+def _window_aggregates(q):
+    """[(func, col, window in minutes or None)] of `q`'s window aggregations."""
+    aggregates = []
+    for item in q.get("select", []):
+        if isinstance(item, dict) and not _is_bucket(item):
+            for func, col in item.items():
+                if func.upper() == "CUMSUM":
+                    aggregates.append(("CUMSUM", col, None))
+                elif func.upper() == "MOVING_SUM":
+                    aggregates.append(("MOVING_SUM", col[0], col[1]))
+    return aggregates
+
+
+def _window_key(q):
+    """The time column or bucket window aggregations run along, and its width in minutes."""
+    keys = [key for key in q.get("group_by", []) if _is_bucket(key) or key in TIME_WIDTH_MINUTES]
+    if len(keys) != 1:
+        raise ValueError("CUMSUM and MOVING_SUM need exactly one time column or bucket in group_by")
+    key = keys[0]
+    width = _interval_minutes(key["bucket"]) if _is_bucket(key) else TIME_WIDTH_MINUTES[key]
+    for func, col, spec in _window_aggregates(q):
+        if spec is not None and _interval_minutes(spec) % width:
+            raise ValueError(f"MOVING_SUM window {spec!r} must be a multiple of the {width} minute groups")
+    return key, width
+
+
+def _output_name(func, col):
+    # Column names of the aggregations, by DuckDB or by our aliases
+    return "count_star()" if col == "*" and func.upper() == "COUNT" else _aggregate_name(func, col)
+
+
+def _aggregate_aliases(q):
+    # ORDER BY spellings of `q`'s aggregations, normalized, to their columns
+    aliases = {}
+    for item in q.get("select", []):
+        if isinstance(item, dict) and not _is_bucket(item):
+            for func, col in item.items():
+                spelled = f"{func}({', '.join(col) if isinstance(col, list) else col})"
+                aliases[spelled.replace(" ", "").upper()] = f'"{_output_name(func, col)}"'
+    return aliases
+
+
+def _window_order_by(q):
+    aliases = _aggregate_aliases(q)
+    return [{**o, "col": aliases.get(o["col"].replace(" ", "").upper(), o["col"])} for o in q.get("order_by", [])]
+
+
+def window_query(q, dark_launch=False, catalog=None):
+    """
+    SQL for a query with CUMSUM or MOVING_SUM, as window functions over the
+    query's groups. The groups are assembled like any query, so with
+    dark_launch impression queries read them from the coarsest bid rollup
+    that fits, and the windows run over a row per group. Looking the
+    window ends up in events_bids_minutes_prefix instead was slower, as
+    every ASOF join sorts the whole prefix table.
+    """
+    key, width = _window_key(q)
+    key_name = "bucket" if _is_bucket(key) else key
+    group_keys = ["bucket" if _is_bucket(k) else k for k in q.get("group_by", [])]
+    inner_select = []
+    select = []
+    for item in q.get("select", []):
+        if isinstance(item, str) or _is_bucket(item):
+            inner_select.append(item)
+            select.append("bucket" if _is_bucket(item) else item)
+            continue
+        for func, col in item.items():
+            if func.upper() not in WINDOW_AGGREGATES:
+                inner_select.append({func: col})
+                select.append(f'"{_output_name(func, col)}"')
+                continue
+            column, spec = (col, None) if func.upper() == "CUMSUM" else col
+            total = {"COUNT": "*"} if column == "*" else {"SUM": column}
+            if total not in inner_select:
+                inner_select.append(total)
+            partition = [k for k in group_keys if k != key_name]
+            if spec is None:
+                frame = "ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW"
+            else:
+                frame = f"RANGE BETWEEN INTERVAL {_interval_minutes(spec) - width} MINUTES PRECEDING AND CURRENT ROW"
+            # minute and buckets come out of the groups formatted
+            order = f"strptime({key_name}, '%Y-%m-%d %H:%M')" if key_name in ("minute", "bucket") \
+                else f"{key_name}::TIMESTAMP"
+            select.append(
+                f'SUM("{_output_name(*next(iter(total.items())))}") OVER ('
+                f'{"PARTITION BY " + ", ".join(partition) + " " if partition else ""}'
+                f'ORDER BY {order} {frame}) AS "{_aggregate_name(func, col)}"'
+            )
+    # The window key and partitions have to be among the groups' columns
+    for k in q.get("group_by", []):
+        if k not in inner_select:
+            inner_select.append(k)
+
+    groups_q = {**q, "select": inner_select, "order_by": [], "limit": None, "offset": None}
+    groups_sql = assemble_sql(groups_q, dark_launch=dark_launch, catalog=catalog)
+    sql = f"SELECT {', '.join(select)} FROM ({groups_sql}) AS groups {_order_by_to_sql(_window_order_by(q))} {_limit_to_sql(q)}"
+    return sql.strip()
+
+
+# z-score for the 95% confidence intervals reported by approximate queries
+APPROX_Z = 1.96
+
+
+def _approximate_aggregate(func, col):
+    """
+    Returns (estimate, variance) SQL for an aggregate evaluated on the
+    weighted events_sample table, or None if it can't be estimated.
+
+    The sample is Bernoulli within each stratum so each row's inclusion
+    probability is 1 / weight, and the Horvitz-Thompson variance of a
+    weighted total is SUM(weight * (weight - 1) * y^2).
+    """
+    func = func.upper()
+    if func == "COUNT" and col == "*":
+        return "SUM(weight)", "SUM(weight * (weight - 1))"
+    elif func == "COUNT":
+        return (f"SUM(IF({col} IS NULL, 0, weight))",
+                f"SUM(IF({col} IS NULL, 0, weight * (weight - 1)))")
+    elif func == "SUM":
+        return f"SUM(weight * {col})", f"SUM(weight * (weight - 1) * {col} * {col})"
+    elif func == "AVG":
+        # Ratio estimator R = Y / N, with the linearized variance
+        # SUM(w(w-1)(y - R)^2) / N^2 expanded so it stays single pass
+        total = f"SUM(IF({col} IS NULL, 0, weight))"
+        ratio = f"(SUM(weight * {col}) / {total})"
+        variance = (
+            f"(SUM(weight * (weight - 1) * {col} * {col})"
+            f" - 2 * {ratio} * SUM(weight * (weight - 1) * {col})"
+            f" + {ratio} * {ratio} * SUM(IF({col} IS NULL, 0, weight * (weight - 1))))"
+            f" / ({total} * {total})"
+        )
+        return ratio, variance
+    return None
+
+
+def approximate_query(q):
+    """
+    Constructs queries that estimate COUNT, SUM and AVG aggregations from the
+    stratified events_sample table. Each estimate is followed by a
+    "<name>_ci95" column holding the half-width of its 95% confidence interval.
+    """
+    if q.get("from") != "events":
+        return False
+
+    select = q.get("select", [])
+    parts = []
+    aliases = {}
+    for item in select:
+        if isinstance(item, str) or _is_bucket(item):
+            parts.append(_select_to_sql([item]))
+        elif isinstance(item, dict):
+            for func, col in item.items():
+                estimate = _approximate_aggregate(func, col)
+                if estimate is None:
+                    return False
+                estimate_sql, variance_sql = estimate
+                name = "count_star()" if col == "*" else f"{func.lower()}({col})"
+                aliases[f"{func}({col})".upper()] = name
+                parts.append(f'{estimate_sql} AS "{name}"')
+                parts.append(f'{APPROX_Z} * SQRT(GREATEST({variance_sql}, 0)) AS "{name}_ci95"')
+
+    # Raw projections have nothing to estimate, so run them exactly
+    if not aliases:
+        return False
+
+    # ORDER BY on an aggregate has to refer to the weighted estimate
+    order_by = [
+        {**o, "col": f'"{aliases[o["col"].replace(" ", "").upper()]}"'}
+        if o["col"].replace(" ", "").upper() in aliases else o
+        for o in q.get("order_by", [])
+    ]
+
+    select_sql = ", ".join(parts)
+    where_sql = _where_to_sql(q.get("where"))
+    group_by_sql = _group_by_to_sql(q.get("group_by"))
     order_by_sql = _order_by_to_sql(order_by)
-    sql = f"SELECT {select_sql} FROM {specialized_tbl} {where_sql} {group_by_sql} {order_by_sql}"
+    limit_sql = _limit_to_sql(q)
+    sql = f"SELECT {select_sql} FROM events_sample {where_sql} {group_by_sql} {order_by_sql} {limit_sql}"
     return sql.strip()
 
 
-def assemble_sql(q, dark_launch=False):
+# Columns with per-minute sketch rollups built by load_data, the HyperLogLog
+# precision (2^p registers, ~1.04 / sqrt(2^p) relative error) and how many
+# heavy hitters are kept per minute and type
+SKETCH_COLUMNS = ["user_id", "publisher_id"]
+HLL_PRECISION = 10
+TOPK_CAPACITY = 64
+
+
+def sketch_query(q, sketches):
+    """
+    Constructs queries that answer a COUNT_DISTINCT or TOP_K aggregation on
+    one of SKETCH_COLUMNS by merging the per-minute HyperLogLog registers or
+    heavy hitter counts that load_data stores in rollup tables. `sketches`
+    are the sketch tables the database has.
+    """
+    if q.get("from") != "events":
+        return False
+
+    select = q.get("select", [])
+    where = q.get("where", [])
+    group_by = q.get("group_by", [])
+    order_by = q.get("order_by", [])
+    # The sketch tables are keyed by minute and type
+    groupable = ["minute", "hour", "day", "week", "type"]
+
+    if any(cond.get("col") not in groupable for cond in where):
+        return False
+    if any(col not in groupable for col in group_by):
+        return False
+
+    aggregations = [item for item in select if isinstance(item, dict)]
+    if len(aggregations) != 1 or len(aggregations[0]) != 1:
+        return False
+    (func, arg), = aggregations[0].items()
+    func = func.upper()
+    if func == "COUNT_DISTINCT" and arg in SKETCH_COLUMNS:
+        col = arg
+    elif func == "TOP_K" and arg[0] in SKETCH_COLUMNS:
+        col, k = arg
+    else:
+        return False
+    if f"events_{col}_{'hll' if func == 'COUNT_DISTINCT' else 'topk'}" not in sketches:
+        return False
+    name = _aggregate_name(func, arg)
+
+    if any(isinstance(item, str) and item not in group_by for item in select):
+        return False
+    order_by_sql_items = []
+    for o in order_by:
+        if o["col"] in group_by:
+            order_by_sql_items.append(o)
+        elif o["col"].replace(" ", "").upper() == name.replace(" ", "").upper():
+            order_by_sql_items.append({**o, "col": f'"{name}"'})
+        else:
+            return False
+
+    keys = "".join(f"{col}, " for col in group_by)
+    outer_group_by_sql = _group_by_to_sql(group_by)
+    where_sql = _where_to_sql(where)
+    order_by_sql = _order_by_to_sql(order_by_sql_items)
+    limit_sql = _limit_to_sql(q)
+
+    if func == "COUNT_DISTINCT":
+        m = 2 ** HLL_PRECISION
+        alpha = 0.7213 / (1 + 1.079 / m)
+        # Registers merge by MAX. Registers that never saw a value count as
+        # zero, and small cardinalities use the linear counting correction.
+        aggregate_sql = (
+            f"ROUND(CASE WHEN raw <= {2.5 * m} AND zeros > 0 "
+            f"THEN {m} * LN({m} / zeros) ELSE raw END)::BIGINT"
+        )
+        select_sql = ", ".join(
+            _select_to_sql([item]) if isinstance(item, str) else f'{aggregate_sql} AS "{name}"'
+            for item in select
+        )
+        sql = f"""
+            WITH registers AS (
+                SELECT {keys}register, MAX(rho) AS rho
+                FROM events_{col}_hll {where_sql}
+                GROUP BY {keys}register
+            ),
+            estimates AS (
+                SELECT
+                    {keys}
+                    {alpha * m * m}::DOUBLE / ({m} - COUNT(*) + COALESCE(SUM(POW(0.5, rho)), 0)) AS raw,
+                    {m} - COUNT(*) AS zeros
+                FROM registers
+                {outer_group_by_sql}
+            )
+            SELECT {select_sql} FROM estimates {order_by_sql} {limit_sql}
+        """
+    else:
+        # Heavy hitter counts merge by summing the per-minute counters
+        aggregate_sql = f"list(value ORDER BY n DESC, value DESC)[1:{k}]"
+        select_sql = ", ".join(
+            _select_to_sql([item]) if isinstance(item, str) else f'{aggregate_sql} AS "{name}"'
+            for item in select
+        )
+        sql = f"""
+            WITH counts AS (
+                SELECT {keys}value, SUM(count) AS n
+                FROM events_{col}_topk {where_sql}
+                GROUP BY {keys}value
+            )
+            SELECT {select_sql} FROM counts {outer_group_by_sql} {order_by_sql} {limit_sql}
+        """
+    return " ".join(sql.split())
+
+
+# Columns with per-minute quantile sketches built by load_data, the columns
+# they are also kept by, and their relative accuracy. A value goes to the bin
+# whose bounds grow by a factor of (1 + a) / (1 - a) from the previous bin's
+# (DDSketch), so the bin's estimate is within a of every value in it, and
+# sketches merge by summing their bin counts.
+QUANTILE_COLUMNS = ["bid_price", "total_price"]
+QUANTILE_DIMENSIONS = ["country", "advertiser_id"]
+QUANTILE_ACCURACY = 0.01
+QUANTILE_GAMMA = (1 + QUANTILE_ACCURACY) / (1 - QUANTILE_ACCURACY)
+# The bin of zero and negative values, which estimate as 0
+QUANTILE_ZERO_BIN = -32768
+
+
+def quantile_table(col, dimension=None):
+    return f"events_{col}_quantiles" + (f"_by_{dimension}" if dimension else "")
+
+
+def quantile_bin_sql(col):
+    return (f"CASE WHEN {col} IS NULL THEN NULL "
+            f"WHEN {col} > 0 THEN CEIL(LN({col}) / {math.log(QUANTILE_GAMMA)})::SMALLINT "
+            f"ELSE {QUANTILE_ZERO_BIN} END")
+
+
+def _quantile_value_sql(bin_sql):
+    # The midpoint of a bin
+    return (f"CASE WHEN {bin_sql} = {QUANTILE_ZERO_BIN} THEN 0.0 "
+            f"ELSE 2 * POW({QUANTILE_GAMMA}, {bin_sql}) / {QUANTILE_GAMMA + 1} END")
+
+
+def _quantile_of(func, arg):
+    """(column, quantile) of a MEDIAN or QUANTILE aggregation."""
+    if func.upper() == "MEDIAN":
+        return arg, 0.5
+    col, p = arg
+    if isinstance(p, bool) or not isinstance(p, (int, float)) or not 0 <= p <= 1:
+        raise ValueError(f"Invalid quantile {p!r} for {col}, expected a number from 0 to 1")
+    return col, p
+
+
+def quantile_sketch_query(q, sketches):
+    """
+    Constructs queries that estimate MEDIAN and QUANTILE aggregations of one
+    of QUANTILE_COLUMNS by merging the per-minute bin counts that load_data
+    stores in rollup tables, by minute and type and optionally one of
+    QUANTILE_DIMENSIONS. `sketches` are the sketch tables the database has.
+    """
+    if q.get("from") != "events":
+        return False
+
+    select = q.get("select", [])
+    where = q.get("where", [])
+    group_by = q.get("group_by", [])
+    order_by = q.get("order_by", [])
+    groupable = ["minute", "hour", "day", "week", "type", *QUANTILE_DIMENSIONS]
+
+    if any(cond.get("col") not in groupable for cond in where):
+        return False
+    if any(col not in groupable for col in group_by):
+        return False
+    # Each dimension has its own tables
+    dimensions = ({cond["col"] for cond in where} | set(group_by)) & set(QUANTILE_DIMENSIONS)
+    if len(dimensions) > 1:
+        return False
+
+    aggregations = [(func, arg) for item in select if isinstance(item, dict) for func, arg in item.items()]
+    if not aggregations or any(func.upper() not in ("MEDIAN", "QUANTILE") for func, _ in aggregations):
+        return False
+    quantiles = {_aggregate_name(func, arg): _quantile_of(func, arg) for func, arg in aggregations}
+    columns = {col for col, _ in quantiles.values()}
+    if len(columns) != 1 or not columns <= set(QUANTILE_COLUMNS):
+        return False
+    (col,) = columns
+    table = quantile_table(col, next(iter(dimensions), None))
+    if table not in sketches:
+        return False
+
+    if any(isinstance(item, str) and item not in group_by for item in select):
+        return False
+    aliases = {name.replace(" ", "").upper(): name for name in quantiles}
+    order_by_sql_items = []
+    for o in order_by:
+        if o["col"] in group_by:
+            order_by_sql_items.append(o)
+        elif o["col"].replace(" ", "").upper() in aliases:
+            order_by_sql_items.append({**o, "col": f'"{aliases[o["col"].replace(" ", "").upper()]}"'})
+        else:
+            return False
+
+    keys = "".join(f"{col}, " for col in group_by)
+    partition_sql = f"PARTITION BY {', '.join(group_by)}" if group_by else ""
+    parts = []
+    for item in select:
+        if isinstance(item, str):
+            parts.append(_select_to_sql([item]))
+            continue
+        for func, arg in item.items():
+            name = _aggregate_name(func, arg)
+            _, p = quantiles[name]
+            # Interpolates between the rows around the quantile's rank like
+            # QUANTILE_CONT, each estimated by its bin's midpoint. Ranks count
+            # from 1, and the NULL bin sorts last where MIN skips it.
+            rank = f"1 + {p} * (ANY_VALUE(total) - 1)"
+            low, high = (_quantile_value_sql(f"MIN(bin) FILTER (WHERE cumulative >= {f}(1 + {p} * (total - 1)))")
+                         for f in ("FLOOR", "CEIL"))
+            parts.append(f'{low} + ({rank} - FLOOR({rank})) * ({high} - {low}) AS "{name}"')
+    sql = f"""
+        WITH bins AS (
+            SELECT {keys}bin, SUM(count) AS n
+            FROM {table} {_where_to_sql(where)}
+            GROUP BY {keys}bin
+        ),
+        ranks AS (
+            SELECT
+                *,
+                SUM(n) OVER ({partition_sql} ORDER BY bin ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) AS cumulative,
+                SUM(n) FILTER (WHERE bin IS NOT NULL) OVER ({partition_sql}) AS total
+            FROM bins
+        )
+        SELECT {", ".join(parts)} FROM ranks {_group_by_to_sql(group_by)} {_order_by_to_sql(order_by_sql_items)} {_limit_to_sql(q)}
+    """
+    return " ".join(sql.split())
+
+
+# Partial aggregates per aggregation, and how the coordinator merges them
+PARTIALS = {
+    "SUM": (["SUM"], "SUM({0})"),
+    "COUNT": (["COUNT"], "SUM({0})"),
+    "AVG": (["SUM", "COUNT"], "SUM({0}) / SUM({1})"),
+    "MIN": (["MIN"], "MIN({0})"),
+    "MAX": (["MAX"], "MAX({0})"),
+}
+
+
+def partial_query(q):
+    """
+    Splits `q` into the partial query each shard or standing query batch
+    runs and the select list, ORDER BY and LIMIT that merge the partial rows
+    (read from `partials`), or returns None if an aggregation can't be
+    merged from partials.
+    """
+    select = q.get("select", [])
+    group_by = q.get("group_by", [])
+    aggregations = [(func, col) for item in select if isinstance(item, dict) and not _is_bucket(item)
+                    for func, col in item.items()]
+
+    if not aggregations:
+        # Projections: each shard returns its own top rows, the merge
+        # sorts them again
+        limit = None if q.get("limit") is None else int(q["limit"]) + int(q.get("offset") or 0)
+        shard_q = {**q, "limit": limit, "offset": None}
+        return shard_q, "*", _order_by_to_sql(q.get("order_by")) + " " + _limit_to_sql(q)
+
+    # Each shard groups by every key, including those that aren't selected
+    keys = [*group_by, *(item for item in select if (isinstance(item, str) or _is_bucket(item)) and item not in group_by)]
+    shard_select = list(keys)
+    merged = []
+    aliases = {}
+    for item in select:
+        if isinstance(item, str):
+            merged.append(item)
+        elif _is_bucket(item):
+            merged.append("bucket")
+        else:
+            for func, col in item.items():
+                if func.upper() not in PARTIALS:
+                    return None
+                partials, merge = PARTIALS[func.upper()]
+                positions = []
+                for partial in partials:
+                    positions.append(f"p{len(shard_select) - len(keys)}")
+                    shard_select.append({partial: col})
+                name = _output_name(func, col)
+                aliases[f"{func}({col})".upper()] = name
+                merged.append(f'{merge.format(*positions)} AS "{name}"')
+
+    shard_q = {**q, "select": shard_select, "order_by": [], "limit": None, "offset": None}
+    order_by = [
+        {**o, "col": f'"{aliases[o["col"].replace(" ", "").upper()]}"'}
+        if o["col"].replace(" ", "").upper() in aliases else o
+        for o in q.get("order_by", [])
+    ]
+    merge_keys = ", ".join("bucket" if _is_bucket(key) else key for key in keys)
+    group_by_sql = f"GROUP BY {merge_keys}" if group_by else ""
+    return shard_q, ", ".join(merged), f"{group_by_sql} {_order_by_to_sql(order_by)} {_limit_to_sql(q)}"
+
+
+def _route_to_partitions(q, partitions):
+    """
+    Routes the type filters of a query on the events view to the per-type
+    partitions. Returns the FROM clause and the remaining conditions.
+    """
+    where = q.get("where", [])
+    type_conds = [cond for cond in where if cond["col"] == "type"]
+    types = [t for t in partitions if all(type_matches(t, cond) for cond in type_conds)]
+    if not type_conds or not types or len(types) == len(partitions):
+        return q["from"], where
+    # The partitions only hold rows of their type, so the filters are implied
+    rest = [cond for cond in where if cond["col"] != "type"]
+    if len(types) == 1:
+        return f"events_{types[0]}", rest
+    union = " UNION ALL ".join(f"SELECT * FROM events_{t}" for t in types)
+    return f"({union}) AS events", rest
+
+
+def _columns_of(q):
+    """Every column `q` selects, aggregates, filters, groups or orders by."""
+    columns = set()
+    for item in q.get("select", []):
+        if isinstance(item, str):
+            columns.add(item)
+        elif isinstance(item, dict) and not _is_bucket(item):
+            for col in item.values():
+                columns.add(col[0] if isinstance(col, list) else col)
+    columns.update(cond["col"] for cond in q.get("where", []))
+    columns.update(col for col in q.get("group_by", []) if isinstance(col, str))
+    columns.update(o["col"] for o in q.get("order_by", []))
+    return columns
+
+
+def assemble_sql(q, dark_launch=False, approximate=False, catalog=None):
+    if _window_aggregates(q):
+        return window_query(q, dark_launch, catalog)
+    from_tbl = q["from"]
+    where = q.get("where")
+    if catalog is not None and catalog["partitions"] and from_tbl == "events":
+        from_tbl, where = _route_to_partitions(q, catalog["partitions"])
+    if catalog is not None and catalog["cold_columns"] and q["from"] == "events" \
+            and (_columns_of(q) & set(catalog["cold_columns"]) or "*" in q.get("select", [])):
+        # Only queries that need a cold column pay for the join. A "*"
+        # projection needs all of them.
+        from_tbl = f"(SELECT * EXCLUDE (row_id) FROM {from_tbl} JOIN events_cold USING (row_id)) AS events"
+
+    where_sql = _where_to_sql(where)
+    if catalog is not None:
+        entries = matching_stats(q.get("where"), catalog)
+        if not entries:
+            # Nothing can match. A constant false filter lets DuckDB skip the
+            # scan while still returning the right columns (and the single
+            # row of an ungrouped aggregation).
+            where_sql = "WHERE false"
+        else:
+            # Matching rows lie in a narrower ts range than the whole table,
+            # which the ts zone maps can prune on since events is sorted by ts
+            ts_range = ts_bounds(entries, catalog)
+            if ts_range is not None:
+                low, high = ts_range
+                where_sql = (where_sql + " AND " if where_sql else "WHERE ") + \
+                    f"ts BETWEEN TIMESTAMP '{low}' AND TIMESTAMP '{high}'"
+
+    # A standing query's result is kept up to date in its state table
+    if dark_launch and catalog is not None and standing_key(q) in catalog["standing"]:
+        return catalog["standing"][standing_key(q)]
+
     # check if query is optimized
-    if dark_launch:
-        optimized_sql = optimize_bid_price_or_impression_count_query(q)
+    if dark_launch and where_sql != "WHERE false":
+        levels = catalog["rollups"] if catalog is not None else ["minute"]
+        optimized_sql = optimize_bid_price_or_impression_count_query(q, levels)
         if optimized_sql:
             return optimized_sql.strip()
 
+        # When only impressions carry a bid_price, bid_price aggregations
+        # without a type filter are impression queries in disguise, as long
+        # as no group is made up of other types only
+        only_bid_price = all(
+            col == "bid_price"
+            for item in q.get("select", []) if isinstance(item, dict)
+            for col in item.values()
+        )
+        has_type_filter = any(cond.get("col") == "type" for cond in q.get("where", []))
+        if catalog is not None and only_bid_price and not has_type_filter and bid_price_only_on_impressions(catalog) \
+                and impressions_in_every_group(q, catalog):
+            impression_filter = {"col": "type", "op": "eq", "val": "impression"}
+            optimized_sql = optimize_bid_price_or_impression_count_query(
+                {**q, "where": [*q.get("where", []), impression_filter]}, levels)
+            if optimized_sql:
+                return optimized_sql.strip()
+
+    # Opt-in estimates from the sketch rollups or the stratified sample, for
+    # queries that no exact rollup answers. Without them, queries run exactly.
+    if approximate and catalog is not None and where_sql != "WHERE false":
+        approximate_sql = sketch_query(q, catalog["sketches"]) or quantile_sketch_query(q, catalog["sketches"]) \
+            or catalog["sample"] and approximate_query(q)
+        if approximate_sql:
+            return approximate_sql
+
     select_sql = _select_to_sql(q.get("select", []))
-    from_tbl = q["from"]
-    where_sql = _where_to_sql(q.get("where"))
     group_by_sql = _group_by_to_sql(q.get("group_by"))
     order_by_sql = _order_by_to_sql(q.get("order_by"))
-    sql = f"SELECT {select_sql} FROM {from_tbl} {where_sql} {group_by_sql} {order_by_sql}"
+    limit_sql = _limit_to_sql(q)
+    sql = f"SELECT {select_sql} FROM {from_tbl} {where_sql} {group_by_sql} {order_by_sql} {limit_sql}"
     return sql.strip()
 
 
@@ -209,19 +847,21 @@ def _val_to_sql(col, op, val):
             return f"'{val}'::event_type"
         elif col == "country":
             return f"COUNTRY_TO_INT('{val}')"
+        elif col in NUMERIC_COLUMNS:
+            # A number literal compares with any numeric type, while a string
+            # fails to cast when it's out of range of a --compact column
+            return _number_to_sql(col, val)
         else:
             return f"'{val}'"
     match op:
         case "eq" | "neq":
             return quote(val)
         case "lt" | "lte" | "gt" | "gte":
-            if col == "type":
-                # This is a deviation from the baseline. If you gave the baseline
-                # one of these ops it would put val directly into the SQL. But this
-                # was a bug anyway for col == "type" since type *was* a VARCHAR and
-                # its vals needed to be quoted.
-                return quote(val)
-            return val
+            # This is a deviation from the baseline. If you gave the baseline
+            # one of these ops it would put val directly into the SQL, which
+            # only worked for numeric columns. Dates, timestamps, countries
+            # and types need quoting like any other op.
+            return quote(val)
         case "between":
             low, high = val
             return quote(low) + " AND " + quote(high)
@@ -230,6 +870,27 @@ def _val_to_sql(col, op, val):
             return f"({comma_separated})"
 
 
+def _number_to_sql(col, val):
+    """
+    The SQL number literal of `val`, a number or a string of one such as
+    "42", "2.5" or "1e-05". Integers are parsed as such to keep large ids
+    exact.
+    """
+    number = None
+    if isinstance(val, (int, float)) and not isinstance(val, bool):
+        number = val
+    elif isinstance(val, str):
+        for parse in (int, float):
+            try:
+                number = parse(val)
+                break
+            except ValueError:
+                pass
+    if number is None or not math.isfinite(number):
+        raise ValueError(f"Invalid value {val!r} for {col}")
+    return repr(number)
+
+
 def _where_to_sql(where):
     if not where:
         return ""
@@ -251,10 +912,12 @@ def _where_to_sql(where):
     return "WHERE " + " AND ".join(parts)
 
 
-def _select_to_sql(select):
+def _select_to_sql(select, bucket_col="ts"):
     parts = []
     for item in select:
-        if isinstance(item, str):
+        if _is_bucket(item):
+            parts.append(f"STRFTIME({_bucket_to_sql(item, bucket_col)}, '%Y-%m-%d %H:%M') AS bucket")
+        elif isinstance(item, str):
             if item == "minute":
                 parts.append("STRFTIME(minute, '%Y-%m-%d %H:%M') AS minute")
             elif item == "country":
@@ -263,16 +926,76 @@ def _select_to_sql(select):
                 parts.append(item)
         elif isinstance(item, dict):
             for func, col in item.items():
-                parts.append(f"{func.upper()}({col})")
+                if func.upper() == "COUNT_DISTINCT":
+                    parts.append(f'COUNT(DISTINCT {col}) AS "{_aggregate_name(func, col)}"')
+                elif func.upper() == "TOP_K":
+                    # Most frequent values first, ties broken by larger value
+                    col, k = col
+                    parts.append(
+                        f"list_transform(list_reverse_sort(list_transform(map_entries(histogram({col})), "
+                        f"e -> struct_pack(n := e.value, v := e.key)))[1:{k}], e -> e.v) "
+                        f'AS "{_aggregate_name(func, [col, k])}"'
+                    )
+                elif func.upper() == "QUANTILE":
+                    col, p = _quantile_of(func, col)
+                    parts.append(f'QUANTILE_CONT({col}, {p}) AS "{_aggregate_name(func, [col, p])}"')
+                else:
+                    parts.append(f"{func.upper()}({col})")
     return ", ".join(parts)
 
 
+def _aggregate_name(func, col):
+    # Output column name for the aggregations DuckDB doesn't name for us
+    if func.upper() == "TOP_K":
+        return f"top_k({col[0]}, {col[1]})"
+    if func.upper() == "QUANTILE":
+        return f"quantile({col[0]}, {col[1]})"
+    if func.upper() == "MOVING_SUM":
+        return f"moving_sum({col[0]}, {col[1]})"
+    return f"{func.lower()}({col})"
+
+
 def _group_by_to_sql(group_by):
     if not group_by: return ""
-    return "GROUP BY " + ", ".join(group_by)
+    return "GROUP BY " + ", ".join("bucket" if _is_bucket(col) else col for col in group_by)
+
+
+def _is_bucket(item):
+    return isinstance(item, dict) and "bucket" in item
+
+
+def _bucket_to_sql(item, col):
+    """
+    SQL for a {"bucket": "<n><unit>"} time bucket of `col`, with unit m, h,
+    d or w. Buckets are whole minutes, so bucketing ts or its minute agrees.
+    """
+    spec = item["bucket"]
+    units = {"m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+    n, unit = spec[:-1], spec[-1:]
+    if not n.isdigit() or int(n) == 0 or unit not in units:
+        raise ValueError(f"Invalid bucket {spec!r}, expected e.g. '15m', '6h', '1d' or '2w'")
+    return f"time_bucket(INTERVAL '{int(n)} {units[unit]}', {col})"
 
 
 def _order_by_to_sql(order_by):
     if not order_by: return ""
-    parts = [f"{o['col']} {o.get('dir', 'asc').upper()}" for o in order_by]
+    parts = [f"{_order_col_to_sql(o['col'])} {o.get('dir', 'asc').upper()}" for o in order_by]
     return "ORDER BY " + ", ".join(parts)
+
+
+def _order_col_to_sql(col):
+    # Aggregations that aren't DuckDB functions are ordered by their alias
+    if col.upper().startswith(("COUNT_DISTINCT(", "TOP_K(", "QUANTILE(", "CUMSUM(", "MOVING_SUM(")):
+        return f'"{col.lower()}"'
+    return col
+
+
+def _limit_to_sql(q):
+    # With ORDER BY, DuckDB turns ORDER BY ... LIMIT into a top-N that only
+    # keeps LIMIT + OFFSET rows instead of sorting everything
+    parts = []
+    if q.get("limit") is not None:
+        parts.append(f"LIMIT {int(q['limit'])}")
+    if q.get("offset"):
+        parts.append(f"OFFSET {int(q['offset'])}")
+    return " ".join(parts)
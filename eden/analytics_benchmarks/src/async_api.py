@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Asyncio Query API
+-----------------
+
+Runs JSON queries against the preprocessed database from async code. Queries
+the assembler routes to a rollup (or answers without a scan) and queries
+that scan events run in separate lanes, each with its own bounded pool of
+worker threads, so one slow scan can't starve the cheap queries. Each lane
+rejects new queries once too many are waiting, and a query that runs past
+its timeout is interrupted inside DuckDB.
+
+Usage:
+  python async_api.py [--timeout SECONDS]
+"""
+
+import argparse
+import asyncio
+import re
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import duckdb
+import numpy as np
+
+from assembler import assemble_sql
+from catalog import load_catalog
+from inputs import queries
+from main import DB_PATH
+
+# Tables that are small enough to count as cheap to query
+ROLLUP_TABLE = re.compile(r"FROM (events_bids_\w+|events_\w+_(hll|topk|quantiles\w*))\b")
+# How many recent wait times to keep per lane for percentiles
+WAIT_WINDOW = 10_000
+# Seconds between interrupts of a timed-out query until its worker is free.
+# An interrupt that arrives before DuckDB starts the query is lost.
+INTERRUPT_RETRY_S = 0.01
+
+
+class QueryRejected(Exception):
+    """Raised when a lane already has too many queries waiting."""
+
+
+class QueryTimeout(Exception):
+    """Raised when a query doesn't finish within its timeout."""
+
+
+def lane_of(sql):
+    if ROLLUP_TABLE.search(sql) or "WHERE false" in sql:
+        return "rollup"
+    return "base"
+
+
+class AsyncQueryEngine:
+    def __init__(self, con, catalog=None, rollup_workers=4, base_workers=2, max_waiting=64):
+        self.con = con
+        self.catalog = catalog
+        self.max_waiting = max_waiting
+        self.lock = threading.Lock()
+        self.lanes = {
+            name: {
+                "executor": ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-lane"),
+                "waiting": 0,
+                "max_waiting_seen": 0,
+                "completed": 0,
+                "rejected": 0,
+                "timed_out": 0,
+                "wait_times_ms": deque(maxlen=WAIT_WINDOW),
+            }
+            for name, workers in (("rollup", rollup_workers), ("base", base_workers))
+        }
+
+    async def query(self, q, timeout=None, approximate=False):
+        """
+        Runs `q` and returns (column names, rows). Raises QueryRejected if
+        its lane is full and QueryTimeout if it takes longer than `timeout`
+        seconds, counting time spent waiting for a worker.
+        """
+        sql = assemble_sql(q, dark_launch=True, approximate=approximate, catalog=self.catalog)
+        lane = self.lanes[lane_of(sql)]
+        with self.lock:
+            if lane["waiting"] >= self.max_waiting:
+                lane["rejected"] += 1
+                raise QueryRejected(f"{lane_of(sql)} lane has {lane['waiting']} queries waiting")
+            lane["waiting"] += 1
+            lane["max_waiting_seen"] = max(lane["max_waiting_seen"], lane["waiting"])
+
+        # Each query gets its own connection so it can be interrupted alone
+        cur = self.con.cursor()
+        submitted = time.time()
+        timed_out = threading.Event()
+
+        def execute():
+            # Once a worker picks the query up, it owns the waiting count
+            # and the cursor, even if the query times out
+            with self.lock:
+                lane["waiting"] -= 1
+                lane["wait_times_ms"].append((time.time() - submitted) * 1000)
+            try:
+                if timed_out.is_set():
+                    raise QueryTimeout(f"query exceeded {timeout}s: {sql}")
+                cur.execute("SET timezone = 'America/Los_Angeles';")
+                res = cur.execute(sql)
+                # Finished despite the interrupts, so at least skip the fetch
+                if timed_out.is_set():
+                    raise QueryTimeout(f"query exceeded {timeout}s: {sql}")
+                cols = [d[0] for d in res.description]
+                return cols, res.fetchall()
+            finally:
+                cur.close()
+
+        job = lane["executor"].submit(execute)
+        future = asyncio.wrap_future(job)
+        # Nobody awaits a timed-out query, so consume its outcome here
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        done, _ = await asyncio.wait({future}, timeout=timeout)
+        if not done:
+            with self.lock:
+                lane["timed_out"] += 1
+                if job.cancel():
+                    # Never started, so the worker won't touch it
+                    lane["waiting"] -= 1
+                    cur.close()
+                    raise QueryTimeout(f"query exceeded {timeout}s: {sql}")
+            timed_out.set()
+            loop = asyncio.get_running_loop()
+
+            def interrupt():
+                # Until the worker lets go of the query, as the first
+                # interrupt may come between its check and DuckDB starting
+                if future.done():
+                    return
+                try:
+                    cur.interrupt()
+                except duckdb.Error:
+                    # Finished and closed in the meantime
+                    return
+                loop.call_later(INTERRUPT_RETRY_S, interrupt)
+
+            interrupt()
+            raise QueryTimeout(f"query exceeded {timeout}s: {sql}")
+        result = future.result()
+        with self.lock:
+            lane["completed"] += 1
+        return result
+
+    def metrics(self):
+        with self.lock:
+            return {
+                name: {
+                    "queue_depth": lane["waiting"],
+                    "max_queue_depth": lane["max_waiting_seen"],
+                    "completed": lane["completed"],
+                    "rejected": lane["rejected"],
+                    "timed_out": lane["timed_out"],
+                    "wait_p50_ms": float(np.percentile(lane["wait_times_ms"], 50)) if lane["wait_times_ms"] else None,
+                    "wait_p99_ms": float(np.percentile(lane["wait_times_ms"], 99)) if lane["wait_times_ms"] else None,
+                }
+                for name, lane in self.lanes.items()
+            }
+
+    def close(self):
+        for lane in self.lanes.values():
+            lane["executor"].shutdown(wait=True, cancel_futures=True)
+
+
+async def run_all(queries, timeout):
+    con = duckdb.connect(DB_PATH, read_only=True)
+    engine = AsyncQueryEngine(con, catalog=load_catalog(con))
+
+    async def one(i, q):
+        t0 = time.time()
+        try:
+            _, rows = await engine.query(q, timeout=timeout)
+            print(f"✅ Query {i}: {len(rows)} rows in {time.time() - t0:.3f}s", file=sys.stderr)
+        except (QueryRejected, QueryTimeout) as e:
+            print(f"❌ Query {i}: {e}", file=sys.stderr)
+
+    await asyncio.gather(*(one(i, q) for i, q in enumerate(queries, 1)))
+    print(engine.metrics())
+    engine.close()
+    con.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the benchmark queries concurrently through the asyncio API."
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="Per-query timeout in seconds"
+    )
+
+    args = parser.parse_args()
+    asyncio.run(run_all(queries, args.timeout))
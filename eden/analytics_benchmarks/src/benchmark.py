@@ -3,12 +3,23 @@ import sys
 import subprocess
 import csv
 import argparse
+import json
+from datetime import datetime
 import tempfile
 import numpy as np
 import shutil
 import glob
+import time
+import duckdb
+import client
 from inputs import queries
 
+# One JSON line per run with its query times and memory and I/O usage. Kept
+# outside tmp, which preprocessing deletes.
+HISTORY_PATH = "benchmark-history.jsonl"
+# Written by main.py for the run that just finished
+RESOURCES_PATH = "tmp/resources.json"
+
 def parse_float(s: str):
     try:
         return float(s), True
@@ -32,11 +43,165 @@ def rows_equal(row, expected_row) -> bool:
             return False
     return True
 
+def approximate_errors(approx_csv, exact_csv):
+    """
+    Compares an approximate result against the exact one, matching rows on
+    their group key columns. Returns None if the query ran exactly.
+    """
+    with open(approx_csv, "r") as f:
+        approx_header, *approx_rows = list(csv.reader(f))
+    with open(exact_csv, "r") as f:
+        exact_header, *exact_rows = list(csv.reader(f))
+
+    estimates = [c for c in approx_header if f"{c}_ci95" in approx_header]
+    if not estimates:
+        return None
+    keys = [c for c in approx_header if c not in estimates and not c.endswith("_ci95")]
+
+    def key_of(row, header):
+        return tuple(row[header.index(k)] for k in keys)
+
+    exact_by_key = {key_of(row, exact_header): row for row in exact_rows}
+    rel_errors = []
+    covered = 0
+    for row in approx_rows:
+        exact_row = exact_by_key.get(key_of(row, approx_header))
+        if exact_row is None:
+            continue
+        for c in estimates:
+            estimate, _ = parse_float(row[approx_header.index(c)])
+            ci, _ = parse_float(row[approx_header.index(f"{c}_ci95")])
+            exact, _ = parse_float(exact_row[exact_header.index(c)])
+            if estimate is None or exact is None:
+                continue
+            rel_errors.append(abs(estimate - exact) / np.maximum(abs(exact), 1e-12))
+            covered += abs(estimate - exact) <= ci or values_close(str(estimate), str(exact))
+    approx_keys = {key_of(row, approx_header) for row in approx_rows}
+    return {
+        "mean_rel_error": float(np.mean(rel_errors)) if rel_errors else 0.0,
+        "max_rel_error": float(np.max(rel_errors)) if rel_errors else 0.0,
+        "ci_coverage": covered / len(rel_errors) if rel_errors else 1.0,
+        "missing_groups": len(set(exact_by_key) - approx_keys),
+    }
+
+def run_main(data_dir, out_dir, extra_args):
+    process = subprocess.run(
+        ["python3", "main.py", "--data-dir", data_dir, "--out-dir", out_dir] + extra_args,
+        check=True,
+        capture_output=True,
+        text=True)
+    main_output = process.stdout.splitlines()
+    # Remove "\nSummary:\n" and "Total time: ..."
+    return [float(line.split(' ')[1][:-1]) for line in main_output[2:-1]]
+
+def storage_report(db_path="tmp/baseline.duckdb"):
+    """
+    Storage size and the time to scan every column of each table holding
+    events rows (the table itself, its per-type partitions and the side
+    table of cold columns). Sizes count whole blocks, so blocks shared
+    between small tables count once per table.
+    """
+    con = duckdb.connect(db_path, read_only=True)
+    tables = [row[0] for row in con.execute(
+        "SELECT table_name FROM duckdb_tables() WHERE table_name = 'events' OR table_name = 'events_cold' "
+        "OR table_name IN ('events_click', 'events_impression', 'events_serve', 'events_purchase') ORDER BY table_name"
+    ).fetchall()]
+    block_size = con.execute("SELECT block_size FROM pragma_database_size()").fetchone()[0]
+    report = {}
+    for table in tables:
+        blocks = con.execute(f"SELECT COUNT(DISTINCT block_id) FROM pragma_storage_info('{table}') WHERE block_id >= 0").fetchone()[0]
+        t0 = time.time()
+        con.execute(f"SELECT SUM(hash(COLUMNS(*))) FROM {table}").fetchall()
+        report[table] = {"bytes": blocks * block_size, "scan_s": time.time() - t0}
+    con.close()
+    return report
+
+def compact_ingest_check(data_dir, db_path="tmp/baseline.duckdb"):
+    """
+    Streams two batches into a copy of the compact database with ingest.py:
+    rows from the data, which have to fit, and the same rows with an id
+    and a price just outside the narrowed types, which have to be rejected
+    without changing events. Returns the problems found.
+    """
+    import ingest
+
+    with tempfile.TemporaryDirectory() as scratch:
+        shutil.copy(db_path, f"{scratch}/check.duckdb")
+        con = duckdb.connect(f"{scratch}/check.duckdb")
+        con.execute("SET timezone = 'America/Los_Angeles';")
+        types = {row[0]: row[1] for row in con.execute("DESCRIBE events").fetchall()}
+        with open(sorted(glob.glob(f"{data_dir}/events_part_*.csv"))[0], newline="") as f:
+            rows = [row for _, row in zip(range(100), csv.DictReader(f))]
+        misfit = {}
+        # One past the largest value of the narrowed type
+        limits = {"UTINYINT": 2 ** 8, "USMALLINT": 2 ** 16}
+        for col in ["advertiser_id", "publisher_id", "user_id"]:
+            if types[col] in limits:
+                misfit[col] = str(limits[types[col]])
+                break
+        if types["bid_price"].startswith("DECIMAL"):
+            scale = int(types["bid_price"].rstrip(")").split(",")[1])
+            misfit["bid_price"] = "1." + "0" * scale + "1"
+
+        problems = []
+        for name, batch in [("fitting", rows), ("misfit", [{**row, **misfit} for row in rows])]:
+            path = f"{scratch}/{name}.csv"
+            with open(path, "w", newline="") as f:
+                w = csv.DictWriter(f, fieldnames=rows[0].keys())
+                w.writeheader()
+                w.writerows(batch)
+            (before,) = con.execute("SELECT COUNT(*) FROM events").fetchone()
+            try:
+                ingest.ingest_batch(con, [path])
+                if name == "misfit" and misfit:
+                    problems.append(f"a batch with {misfit} was ingested")
+            except (ValueError, duckdb.Error) as e:
+                if name == "fitting":
+                    problems.append(f"a batch of loaded rows failed: {e}")
+                elif not isinstance(e, ValueError):
+                    problems.append(f"a batch with {misfit} failed without a clear error: {e}")
+            (after,) = con.execute("SELECT COUNT(*) FROM events").fetchone()
+            if name == "misfit" and after != before:
+                problems.append(f"the rejected batch changed events from {before} to {after} rows")
+        con.close()
+    return problems
+
+def read_resources():
+    # Stage and query usage of the last main.py run, None if it recorded none
+    try:
+        with open(RESOURCES_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def append_history(record):
+    with open(HISTORY_PATH, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+def run_server(url, out_dir, approximate=False):
+    # Same timing as main.py: execution and fetch, but not writing the CSV
+    os.makedirs(out_dir, exist_ok=True)
+    times = []
+    for i, q in enumerate(queries, 1):
+        t0 = time.time()
+        cols, rows = client.query(q, url, approximate)
+        rows = list(rows)
+        times.append(time.time() - t0)
+        with open(f"{out_dir}/q{i}.csv", "w", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(cols)
+            w.writerows(rows)
+    return times
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run benchmark and validate results")
     parser.add_argument("mode", choices=["lite", "full"], help="Which dataset to run against")
     parser.add_argument("--runs", type=int, default=1, help="How many runs to perform")
     parser.add_argument("--skip-preprocessing", action="store_true", help="Skip the first run's preprocessing (e.g. if the code hasn't changed since last benchmark)")
+    parser.add_argument("--approximate", action="store_true", help="Also run the queries in approximate mode and report speedup and error against the exact results")
+    parser.add_argument("--compact", action="store_true", help="Preprocess with main.py --compact and report table size, scan time and query times against the plain layout")
+    parser.add_argument("--resources", action="store_true", help="Have main.py sample peak memory and bytes read per query and stage, which costs some time while queries run")
+    parser.add_argument("--server", metavar="URL", help="Send the queries to a running server.py (e.g. http://127.0.0.1:8765) instead of starting main.py; preprocessing is up to the server")
     args = parser.parse_args()
 
     data_type = args.mode
@@ -45,11 +210,23 @@ if __name__ == "__main__":
     
     # Create tmp directory
     tmp_dir = "tmp"
+    approx_dir = f"{tmp_dir}/approx"
+
+    layout_args = []
+    if args.compact and not args.server:
+        # The plain layout first, for the before and after comparison
+        print("Running preprocessing for the plain layout")
+        plain_times = run_main(data_dir, f"{tmp_dir}/plain", [])
+        plain_storage = storage_report()
+        layout_args = ["--compact"]
 
     all_times = []
+    all_usage = []
+    all_approx_times = []
+    all_approx_errors = []
     for run in range(1, args.runs + 1):
         # Execute queries in main.py
-        if args.skip_preprocessing or run > 1:
+        if (args.skip_preprocessing and not layout_args) or args.server or run > 1:
             pattern = "tmp/*.csv"
             files_to_delete = glob.glob(pattern)
             for file_path in files_to_delete:
@@ -60,15 +237,22 @@ if __name__ == "__main__":
             shutil.rmtree(tmp_dir, ignore_errors=True)
             os.mkdir(tmp_dir)
             maybe_skip_preprocessing = []
-        process = subprocess.run(
-            ["python3", "main.py", "--data-dir", data_dir, "--out-dir", tmp_dir] + maybe_skip_preprocessing,
-            check=True,
-            capture_output=True,
-            text=True)
-        main_output = process.stdout.splitlines()
-        # Remove "\nSummary:\n" and "Total time: ..."
-        times = [float(line.split(' ')[1][:-1]) for line in main_output[2:-1]]
+        if args.server:
+            if args.approximate:
+                all_approx_times.append(run_server(args.server, approx_dir, approximate=True))
+            times = run_server(args.server, tmp_dir)
+        else:
+            if args.approximate:
+                # The approximate run goes first so its preprocessing builds the sample
+                approx_times = run_main(data_dir, approx_dir, ["--approximate"] + layout_args + maybe_skip_preprocessing)
+                all_approx_times.append(approx_times)
+                maybe_skip_preprocessing = ["--skip-preprocessing"]
+            if os.path.exists(RESOURCES_PATH):
+                os.remove(RESOURCES_PATH)
+            times = run_main(data_dir, tmp_dir, layout_args + maybe_skip_preprocessing + (["--resources"] if args.resources else []))
         all_times.append(times)
+        usage = None if args.server else read_resources()
+        all_usage.append(usage)
 
         # Check results
         for i in range(1, len(queries) + 1):
@@ -100,6 +284,22 @@ if __name__ == "__main__":
                         print(f"Query {i} failed: row count {len(rows)} != expected {len(expected_rows)}")
                         raise Exception("Row number mismatch")
         print(f"Run {run} passed, total {np.sum(times):.3f}s")
+        append_history({
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "mode": data_type,
+            "run": run,
+            "args": layout_args + maybe_skip_preprocessing + (["--server", args.server] if args.server else []),
+            "total_s": float(np.sum(times)),
+            "times_s": times,
+            "stages": usage["stages"] if usage else [],
+            "queries": usage["queries"] if usage else [],
+        })
+
+        if args.approximate:
+            all_approx_errors.append([
+                approximate_errors(f"{approx_dir}/q{i}.csv", f"{tmp_dir}/q{i}.csv")
+                for i in range(1, len(queries) + 1)
+            ])
 
     print(f"Results from {args.runs} {"run" if args.runs == 1 else "runs"}:")
     for i in range(len(queries)):
@@ -107,9 +307,49 @@ if __name__ == "__main__":
         avg = np.mean(this_query_times)
         min = this_query_times.min()
         max = this_query_times.max()
-        print(f"Q{i}: average {avg:.3f}s\tmin {min:.3f}s\tmax {max:.3f}s")
+        peaks = [run_usage["queries"][i]["peak_rss_bytes"] for run_usage in all_usage
+                 if run_usage and run_usage["queries"][i].get("peak_rss_bytes") is not None]
+        peak = f"\tpeak RSS {np.max(peaks) / 2**20:.1f} MiB" if peaks else ""
+        print(f"Q{i}: average {avg:.3f}s\tmin {min:.3f}s\tmax {max:.3f}s{peak}")
     total_times = np.sum(all_times, axis=1)
     avg = np.mean(total_times)
     min = total_times.min()
     max = total_times.max()
     print(f"Stats of the total times: average {avg:.3f}s\tmin {min:.3f}s\tmax {max:.3f}s")
+    for run_usage in all_usage:
+        if run_usage and run_usage["stages"]:
+            print("Preprocessing (peak RSS, peak DuckDB memory, peak temp files, bytes read):")
+            for stage in run_usage["stages"]:
+                print(f"{stage['name']}: {(stage['peak_rss_bytes'] or 0) / 2**20:.1f} MiB"
+                      f"\t{(stage['peak_duckdb_bytes'] or 0) / 2**20:.1f} MiB"
+                      f"\t{(stage['peak_temp_bytes'] or 0) / 2**20:.1f} MiB"
+                      f"\t{(stage['read_bytes'] or 0) / 2**20:.1f} MiB")
+            break
+    print(f"History appended to {HISTORY_PATH}")
+
+    if args.approximate:
+        print("Approximate mode (speedup over exact, relative error, 95% CI coverage):")
+        for i in range(len(queries)):
+            speedups = [exact[i] / np.maximum(approx[i], 1e-9) for exact, approx in zip(all_times, all_approx_times)]
+            errors = [run_errors[i] for run_errors in all_approx_errors]
+            if errors[0] is None:
+                print(f"Q{i}: ran exactly\tspeedup {np.mean(speedups):.2f}x")
+                continue
+            print(f"Q{i}: speedup {np.mean(speedups):.2f}x"
+                  f"\tmean rel error {np.mean([e['mean_rel_error'] for e in errors]):.4%}"
+                  f"\tmax rel error {np.max([e['max_rel_error'] for e in errors]):.4%}"
+                  f"\tCI coverage {np.mean([e['ci_coverage'] for e in errors]):.1%}"
+                  f"\tmissing groups {errors[0]['missing_groups']}")
+
+    if layout_args:
+        compact_storage = storage_report()
+        print("Compact layout (plain -> compact):")
+        for table in sorted(set(plain_storage) | set(compact_storage)):
+            before = plain_storage.get(table, {"bytes": 0, "scan_s": 0.0})
+            after = compact_storage.get(table, {"bytes": 0, "scan_s": 0.0})
+            print(f"{table}: {before['bytes'] / 2**20:.1f} MiB -> {after['bytes'] / 2**20:.1f} MiB"
+                  f"\tscan {before['scan_s']:.3f}s -> {after['scan_s']:.3f}s")
+        for i in range(len(queries)):
+            print(f"Q{i}: {plain_times[i]:.3f}s -> average {np.mean([run_times[i] for run_times in all_times]):.3f}s")
+        problems = compact_ingest_check(data_dir)
+        print("Compact ingest check: " + ("ok" if not problems else "FAILED, " + "; ".join(problems)))
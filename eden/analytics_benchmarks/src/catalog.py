@@ -0,0 +1,223 @@
+# Ingest-time statistics catalog
+#
+# load_data (see build_catalog in main.py) records row counts and min/max ts
+# per CSV part and per (day, type, country). The planner in assembler.py uses these to skip
+# DuckDB for provably empty results, to tighten ts ranges so the ts zone
+# maps can prune row groups, to find more queries that a rollup can answer,
+# and to estimate result sizes.
+
+import json
+from datetime import date, timedelta
+
+TABLE_NAME = "events"
+# Values of the event_type enum in declaration order, which is also how
+# the enum compares
+EVENT_TYPES = ["click", "impression", "serve", "purchase"]
+# Time granularities of the bid rollups, finest first
+ROLLUP_LEVELS = ["minute", "hour", "day", "week"]
+# Registered standing queries, see standing.py
+STANDING_TABLE = "standing_queries"
+
+
+def load_catalog(con):
+    """
+    Reads the catalog written by build_catalog into memory, or returns None
+    if the database predates it.
+    """
+    tables = {row[0] for row in con.execute("SELECT table_name FROM duckdb_tables()").fetchall()}
+    if f"{TABLE_NAME}_stats" not in tables:
+        return None
+    stats = [
+        {
+            "day": day.isoformat(),
+            "type": type,
+            "country": country,
+            "rows": rows,
+            "bid_price_rows": bid_price_rows,
+            "min_ts": min_ts,
+            "max_ts": max_ts,
+        }
+        for day, type, country, rows, bid_price_rows, min_ts, max_ts
+        in con.execute(f"SELECT * FROM {TABLE_NAME}_stats").fetchall()
+    ]
+    parts = con.execute(f"SELECT * FROM {TABLE_NAME}_stats_parts").fetchall()
+    # load_data --partition-by-type replaces the events table with a view
+    # over one table per type
+    views = {row[0] for row in con.execute("SELECT view_name FROM duckdb_views()").fetchall()}
+    partitions = [t for t in EVENT_TYPES if TABLE_NAME in views and f"{TABLE_NAME}_{t}" in tables]
+    # Levels of the bid rollup hierarchy, finest first
+    rollups = [level for level in ROLLUP_LEVELS if f"{TABLE_NAME}_bids_{level}s" in tables]
+    # load_data --compact moves these columns to a side table
+    cold_columns = [
+        row[0] for row in con.execute(
+            "SELECT column_name FROM duckdb_columns() WHERE table_name = ? AND column_name != 'row_id'",
+            [f"{TABLE_NAME}_cold"],
+        ).fetchall()
+    ]
+    # load_data --approximate builds the sample and the sketch rollups
+    sample = f"{TABLE_NAME}_sample" in tables
+    sketches = sorted(
+        t for t in tables
+        if t.startswith(f"{TABLE_NAME}_") and (t.endswith(("_hll", "_topk")) or "_quantiles" in t)
+    )
+    # SQL that reads each standing query's result from its state table
+    standing = dict(con.execute(f"SELECT key, read_sql FROM {STANDING_TABLE}").fetchall()) \
+        if STANDING_TABLE in tables else {}
+    return {"stats": stats, "parts": parts, "partitions": partitions, "rollups": rollups, "cold_columns": cold_columns,
+            "sample": sample, "sketches": sketches, "standing": standing}
+
+
+def standing_key(q):
+    # The same query with its keys in any order is the same standing query
+    return json.dumps(q, sort_keys=True)
+
+
+def _week_of(day):
+    # Weeks start on Monday, like DATE_TRUNC('week', ts)
+    d = date.fromisoformat(day)
+    return (d - timedelta(days=d.weekday())).isoformat()
+
+
+def _compare(x, op, val):
+    match op:
+        case "eq":
+            return x == val
+        case "neq":
+            return x != val
+        case "lt":
+            return x < val
+        case "lte":
+            return x <= val
+        case "gt":
+            return x > val
+        case "gte":
+            return x >= val
+        case "between":
+            low, high = val
+            return low <= x <= high
+        case "in":
+            return x in val
+    return True
+
+
+def type_matches(event_type, cond):
+    """Whether `event_type` satisfies a condition on the type column."""
+    # Compare enum positions so that lt/gt follow the enum's order
+    position = EVENT_TYPES.index
+    val = cond["val"]
+    if cond["op"] in ("between", "in"):
+        val = [position(v) for v in val]
+    else:
+        val = position(val)
+    return _compare(position(event_type), cond["op"], val)
+
+
+def _may_match(entry, cond):
+    """
+    Whether rows summarized by a catalog entry may satisfy `cond`. Exact for
+    day, week, type and country, conservative for hour and minute and always
+    True for columns the catalog doesn't track.
+    """
+    col, op, val = cond["col"], cond["op"], cond["val"]
+    if col == "type":
+        return type_matches(entry["type"], cond)
+    elif col in ("day", "country"):
+        return _compare(entry[col], op, val)
+    elif col == "week":
+        return _compare(_week_of(entry["day"]), op, val)
+    elif col in ("hour", "minute"):
+        # Only the day part of the timestamp can be checked
+        day = entry["day"]
+        match op:
+            case "eq":
+                return day == val[:10]
+            case "lt" | "lte":
+                return day <= val[:10]
+            case "gt" | "gte":
+                return day >= val[:10]
+            case "between":
+                return val[0][:10] <= day <= val[1][:10]
+            case "in":
+                return day in {v[:10] for v in val}
+    return True
+
+
+def matching_stats(where, catalog):
+    """Catalog entries that may contain rows satisfying every condition."""
+    return [
+        entry for entry in catalog["stats"]
+        if all(_may_match(entry, cond) for cond in where or [])
+    ]
+
+
+def ts_bounds(entries, catalog):
+    """
+    (min_ts, max_ts) covering every row in `entries`, or None if that is no
+    narrower than the whole table.
+    """
+    low = min(entry["min_ts"] for entry in entries)
+    high = max(entry["max_ts"] for entry in entries)
+    if low <= min(e["min_ts"] for e in catalog["stats"]) and high >= max(e["max_ts"] for e in catalog["stats"]):
+        return None
+    return low, high
+
+
+def bid_price_only_on_impressions(catalog):
+    """
+    Whether bid_price is set on exactly the impression rows, in which case
+    SUM and AVG of bid_price don't need a type filter to use the rollups.
+    """
+    return all(
+        entry["bid_price_rows"] == (entry["rows"] if entry["type"] == "impression" else 0)
+        for entry in catalog["stats"]
+    )
+
+
+def impressions_in_every_group(q, catalog):
+    """
+    Whether every group of `q` has impression rows, so that filtering to
+    impressions drops no group. Only decided for groups and filters on day
+    and week, which the catalog tracks exactly. An ungrouped aggregation
+    always returns its one row.
+    """
+    group_by = q.get("group_by", [])
+    if not group_by:
+        return True
+    exact = ("day", "week")
+    if not all(isinstance(col, str) and col in exact for col in group_by) \
+            or any(cond["col"] not in exact for cond in q.get("where", [])):
+        return False
+    entries = matching_stats(q.get("where"), catalog)
+
+    def group_of(entry):
+        return tuple(entry["day"] if col == "day" else _week_of(entry["day"]) for col in group_by)
+
+    return {group_of(entry) for entry in entries} == \
+        {group_of(entry) for entry in entries if entry["type"] == "impression" and entry["rows"] > 0}
+
+
+def estimate_result_rows(q, catalog):
+    """Upper estimate of how many rows `q` returns."""
+    entries = matching_stats(q.get("where"), catalog)
+    rows = sum(entry["rows"] for entry in entries)
+    group_by = q.get("group_by", [])
+    has_aggregation = any(isinstance(item, dict) for item in q.get("select", []))
+    if q.get("limit") is not None:
+        rows = min(rows, int(q["limit"]))
+    if not group_by:
+        return 1 if has_aggregation else rows
+
+    days = {entry["day"] for entry in entries}
+    estimate = 1
+    for col in group_by:
+        if col in ("day", "type", "country"):
+            estimate *= len({entry[col] for entry in entries})
+        elif col == "week":
+            estimate *= len({_week_of(day) for day in days})
+        elif col == "hour":
+            estimate *= 24 * len(days)
+        elif col == "minute":
+            estimate *= 24 * 60 * len(days)
+        else:
+            estimate *= rows
+    return min(estimate, rows)
@@ -0,0 +1,31 @@
+# Client for the query server in server.py
+
+import csv
+import io
+import json
+from urllib.request import Request, urlopen
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+
+
+def query(q, url=DEFAULT_URL, approximate=False):
+    """
+    Sends the JSON query `q` to the server. Returns the column names and an
+    iterator over the result rows (as strings), which are read from the
+    connection as the server streams them.
+    """
+    request = Request(
+        f"{url}/query" + ("?approximate=1" if approximate else ""),
+        data=json.dumps(q).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    response = urlopen(request)
+    reader = csv.reader(io.TextIOWrapper(response, encoding="utf-8", newline=""))
+    cols = next(reader)
+    return cols, reader
+
+
+def metrics(url=DEFAULT_URL):
+    """Latency histogram and percentiles collected by the server."""
+    with urlopen(f"{url}/metrics") as response:
+        return json.load(response)
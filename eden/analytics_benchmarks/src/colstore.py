@@ -0,0 +1,204 @@
+# NumPy column store for the bid_price/impression rollup queries
+#
+# export_columns writes events_bids_minutes_prefix to one .npy file per
+# column. load_columns memory-maps them, so every process that loads them
+# shares the same pages of the OS page cache, and answer() evaluates the
+# queries optimize_bid_price_or_impression_count_query would send to the
+# minute rollup without going through DuckDB: the rollup is sorted by minute
+# and every coarser time column rises with it, so time filters become
+# searchsorted ranges, ungrouped sums become prefix sum differences and
+# groups become np.add.reduceat over contiguous runs.
+#
+# ingest.py keeps appending to the rollup, so the export records what it was
+# taken from in a manifest and load_columns ignores exports that no longer
+# match the table.
+
+import json
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+
+from assembler import _is_bucket, optimize_bid_price_or_impression_count_query
+
+COLUMN_DIR = Path("tmp/columns")
+MANIFEST = "manifest.json"
+TEMPORALS = ["minute", "hour", "day", "week"]
+# time_bucket's default origin, a Monday, in epoch seconds
+BUCKET_ORIGIN = 946857600
+BUCKET_SECONDS = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+AGGREGATE_NAMES = {
+    "COUNT(*)": "count_star()",
+    "SUM(BID_PRICE)": "sum(bid_price)",
+    "AVG(BID_PRICE)": "avg(bid_price)",
+}
+
+
+def export_columns(con, column_dir=COLUMN_DIR):
+    """
+    Writes the minute rollup and its prefix sums as .npy files. Times are
+    epoch seconds of the naive local timestamps. prefix_* have a leading
+    zero, so the sum over rows [lo, hi) is prefix[hi] - prefix[lo].
+    """
+    column_dir.mkdir(parents=True, exist_ok=True)
+    columns = con.execute("""
+        SELECT
+            epoch(minute)::BIGINT AS minute,
+            epoch(hour)::BIGINT AS hour,
+            epoch(day)::BIGINT AS day,
+            epoch(week)::BIGINT AS week,
+            sum_bid_price::DOUBLE AS sum_bid_price,
+            count_impressions::BIGINT AS count_impressions,
+            prefix_sum_bid_price::DOUBLE AS prefix_sum_bid_price,
+            prefix_count_impressions::BIGINT AS prefix_count_impressions
+        FROM events_bids_minutes_prefix
+        ORDER BY minute
+    """).fetchnumpy()
+    for name, values in columns.items():
+        values = np.asarray(values)
+        # The first row is the zero row the prefix sums start from
+        np.save(column_dir / f"{name}.npy", values if name.startswith("prefix_") else values[1:])
+    # Written last, so an interrupted export has no manifest
+    (column_dir / MANIFEST).write_text(json.dumps(rollup_version(con)))
+
+
+def rollup_version(con):
+    # Changes whenever ingest.py adds minutes or impressions to the rollup
+    rows, max_minute, impressions = con.execute("""
+        SELECT COUNT(*), epoch(MAX(minute))::BIGINT, MAX(prefix_count_impressions)::BIGINT
+        FROM events_bids_minutes_prefix
+    """).fetchone()
+    return {"rows": rows, "max_minute": max_minute, "impressions": impressions}
+
+
+def load_columns(con, column_dir=COLUMN_DIR):
+    """
+    Memory-maps the exported columns, or returns None if there are none or
+    they were exported from an older version of the minute rollup.
+    """
+    manifest = column_dir / MANIFEST
+    if not manifest.exists() or json.loads(manifest.read_text()) != rollup_version(con):
+        return None
+    return {path.stem: np.load(path, mmap_mode="r") for path in column_dir.glob("*.npy")}
+
+
+def _epoch(val):
+    return int(np.datetime64(val.replace(" ", "T"), "s").astype(np.int64))
+
+
+def _time_range(keys, cond, lo, hi):
+    """Narrows the row range [lo, hi) to rows whose sorted `keys` match `cond`."""
+    op, val = cond["op"], cond["val"]
+    if op == "between":
+        low, high = _epoch(val[0]), _epoch(val[1])
+    elif op in ("eq", "gte", "gt"):
+        low, high = _epoch(val), None
+    else:
+        low, high = None, _epoch(val)
+    if op == "eq":
+        high = low
+    if low is not None:
+        lo = max(lo, int(np.searchsorted(keys, low, side="right" if op == "gt" else "left")))
+    if high is not None:
+        hi = min(hi, int(np.searchsorted(keys, high, side="left" if op == "lt" else "right")))
+    return lo, max(lo, hi)
+
+
+def _format(col, seconds):
+    t = datetime(1970, 1, 1) + timedelta(seconds=int(seconds))
+    if col in ("minute", "bucket"):
+        return t.strftime("%Y-%m-%d %H:%M")
+    elif col in ("day", "week"):
+        return t.date()
+    return t
+
+
+def answer(q, columns):
+    """
+    Returns (column names, rows) for `q`, or None if it isn't a query the
+    minute rollup answers.
+    """
+    if columns is None or not optimize_bid_price_or_impression_count_query(q):
+        return None
+    select = q.get("select", [])
+    group_by = q.get("group_by", [])
+    if any((isinstance(item, str) or _is_bucket(item)) and item not in group_by for item in select):
+        return None
+
+    # Range conditions on the sorted time columns narrow [lo, hi), the rest
+    # become a mask over that range
+    lo, hi = 0, len(columns["minute"])
+    masks = []
+    for cond in q.get("where", []):
+        if cond["col"] not in TEMPORALS:
+            continue
+        keys = columns[cond["col"]]
+        if cond["op"] in ("neq", "in"):
+            masks.append(cond)
+        else:
+            lo, hi = _time_range(keys, cond, lo, hi)
+    mask = None
+    for cond in masks:
+        keys = np.asarray(columns[cond["col"]][lo:hi])
+        values = [_epoch(v) for v in (cond["val"] if cond["op"] == "in" else [cond["val"]])]
+        matches = np.isin(keys, values)
+        matches = matches if cond["op"] == "in" else ~matches
+        mask = matches if mask is None else mask & matches
+
+    sums = columns["sum_bid_price"][lo:hi]
+    counts = columns["count_impressions"][lo:hi]
+    if group_by:
+        key = group_by[0]
+        if _is_bucket(key):
+            width = BUCKET_SECONDS[key["bucket"][-1]] * int(key["bucket"][:-1])
+            keys = BUCKET_ORIGIN + (np.asarray(columns["minute"][lo:hi]) - BUCKET_ORIGIN) // width * width
+        else:
+            keys = np.asarray(columns[key][lo:hi])
+        if mask is not None:
+            keys, sums, counts = keys[mask], np.asarray(sums)[mask], np.asarray(counts)[mask]
+        # Keys rise with minute, so each group is a contiguous run
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.array([], dtype=np.int64)
+        group_keys = keys[starts]
+        group_sums = np.add.reduceat(sums, starts) if len(starts) else np.array([])
+        group_counts = np.add.reduceat(counts, starts) if len(starts) else np.array([], dtype=np.int64)
+    elif mask is None:
+        # One range, answered from the prefix sums
+        group_keys = [None]
+        group_sums = [columns["prefix_sum_bid_price"][hi] - columns["prefix_sum_bid_price"][lo]]
+        group_counts = [int(columns["prefix_count_impressions"][hi] - columns["prefix_count_impressions"][lo])]
+    else:
+        group_keys = [None]
+        group_sums = [np.sum(np.asarray(sums)[mask])]
+        group_counts = [int(np.sum(np.asarray(counts)[mask]))]
+
+    names = []
+    for item in select:
+        if _is_bucket(item):
+            names.append("bucket")
+        elif isinstance(item, str):
+            names.append(item)
+        else:
+            for func, col in item.items():
+                names.append(AGGREGATE_NAMES[f"{func}({col})".upper()])
+    key_name = "bucket" if group_by and _is_bucket(group_by[0]) else (group_by[0] if group_by else None)
+    rows = []
+    for k, s, c in zip(group_keys, group_sums, group_counts):
+        # Like SQL, an aggregate over no rows is NULL except for COUNT
+        row = {
+            "count_star()": int(c),
+            "sum(bid_price)": float(s) if c else None,
+            "avg(bid_price)": float(s) / int(c) if c else None,
+        }
+        if key_name is not None:
+            row[key_name] = _format(key_name, k)
+        rows.append(row)
+
+    # Python's sort is stable, so sorting by the last key first sorts by all.
+    # Only an ungrouped result, which is a single row, can hold NULLs.
+    for o in reversed(q.get("order_by", [])):
+        col = AGGREGATE_NAMES.get(o["col"].replace(" ", "").upper(), o["col"])
+        rows.sort(key=lambda row: row[col], reverse=o.get("dir", "asc").lower() == "desc")
+    offset = int(q.get("offset") or 0)
+    limit = q.get("limit")
+    rows = rows[offset:] if limit is None else rows[offset:offset + int(limit)]
+    return names, [tuple(row[name] for name in names) for row in rows]
@@ -3,6 +3,10 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
+from timeseries import downsampled_series
+
+# Plots are 10 inches wide at matplotlib's default 100 dpi
+PLOT_WIDTH_PX = 1000
 
 def histogram_events_by_time_block(time_block):
     con = duckdb.connect(database='tmp/baseline.duckdb')
@@ -34,18 +38,9 @@ def histogram_events_by_time_block(time_block):
 def histogram_events_over_time(time_block):
     con = duckdb.connect(database='tmp/baseline.duckdb')
     con.execute("SET timezone = 'America/Los_Angeles';")
-    query = f"""
-    SELECT
-        {time_block} AS which,
-        COUNT(*) AS count
-    FROM
-        events
-    GROUP BY
-        {time_block}
-    ORDER BY
-        {time_block};
-    """
-    df = con.execute(query).fetchdf()
+    # Downsample inside DuckDB so fine-grained buckets over long ranges
+    # still plot a bounded number of points
+    df = downsampled_series(con, PLOT_WIDTH_PX, time_block).rename(columns={"value": "count"})
     con.close()
 
     # Plotting with Seaborn and Matplotlib
@@ -65,3 +60,4 @@ histogram_events_by_time_block("hour")
 histogram_events_over_time("week")
 histogram_events_over_time("day")
 histogram_events_over_time("hour")
+histogram_events_over_time("minute")
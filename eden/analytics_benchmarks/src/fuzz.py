@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Query Fuzzer
+------------
+
+Generates random valid JSON queries from the grammar assemble_sql supports
+(filters with every op on every column, aggregations, group by, time buckets,
+order by, limit and offset), runs each as the baseline SQL and as the
+dark_launch SQL against the preprocessed database, and checks that both return
+the same rows with benchmark.py's tolerance. Reports the speedup of the
+dark_launch SQL per query shape, and writes every query's timings to
+<out-dir>/fuzz.csv and the queries that disagree to <out-dir>/failures.json.
+
+Usage:
+  python fuzz.py --out-dir ./out [--queries 200] [--seed 0] [--repeat 3]
+"""
+
+import argparse
+import csv
+import json
+import random
+import re
+import sys
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+from pathlib import Path
+
+import duckdb
+import numpy as np
+
+from assembler import assemble_sql, _is_bucket
+from benchmark import rows_equal
+from catalog import load_catalog, EVENT_TYPES
+from main import DB_PATH, TABLE_NAME
+
+OPS = ["eq", "neq", "lt", "lte", "gt", "gte", "between", "in"]
+TEMPORALS = ["minute", "hour", "day", "week"]
+GROUP_COLUMNS = [*TEMPORALS, "type", "country", "advertiser_id", "publisher_id"]
+FILTER_COLUMNS = [*GROUP_COLUMNS, "user_id", "bid_price", "total_price"]
+AGGREGATIONS = [
+    ("SUM", "bid_price"), ("AVG", "bid_price"), ("MIN", "bid_price"), ("MAX", "bid_price"),
+    ("SUM", "total_price"), ("AVG", "total_price"), ("COUNT", "*"),
+    ("COUNT_DISTINCT", "user_id"), ("TOP_K", ["publisher_id", 3]),
+    ("MEDIAN", "bid_price"), ("QUANTILE", ["total_price", 0.95]),
+]
+BUCKETS = ["15m", "1h", "6h", "1d", "1w"]
+# Standing query state tables are reported as one table, "standing"
+# Orders the rows of a "*" projection, as no two events share all of these
+STAR_ORDER = ["ts", "user_id", "advertiser_id", "publisher_id", "type"]
+FROM_TABLE = re.compile(r"\bFROM (events\w*|standing(?=_))")
+
+
+def domain(con, catalog):
+    """Values the generator draws filter literals from."""
+    days = sorted({entry["day"] for entry in catalog["stats"]})
+    ranges = {
+        col: con.execute(f"SELECT MIN({col}), MAX({col}) FROM {TABLE_NAME}").fetchone()
+        for col in ["advertiser_id", "publisher_id", "user_id", "bid_price", "total_price"]
+    }
+    return {
+        "days": days,
+        "countries": sorted({entry["country"] for entry in catalog["stats"]}),
+        "ranges": {col: (float(low), float(high)) for col, (low, high) in ranges.items()},
+    }
+
+
+def random_value(rng, col, d):
+    if col == "type":
+        return rng.choice(EVENT_TYPES)
+    elif col == "country":
+        return rng.choice(d["countries"])
+    elif col in TEMPORALS:
+        day = date.fromisoformat(rng.choice(d["days"]))
+        if col == "day":
+            return day.isoformat()
+        elif col == "week":
+            return (day - timedelta(days=day.weekday())).isoformat()
+        elif col == "hour":
+            return f"{day} {rng.randrange(24):02d}:00:00"
+        return f"{day} {rng.randrange(24):02d}:{rng.randrange(60):02d}:00"
+    low, high = d["ranges"][col]
+    if col.endswith("_id"):
+        return str(rng.randint(int(low), int(high)))
+    return f"{rng.uniform(low, high):.2f}"
+
+
+def _sort_key(col, val):
+    # Keeps between bounds in order
+    return float(val) if col not in TEMPORALS and col not in ("type", "country") else \
+        EVENT_TYPES.index(val) if col == "type" else val
+
+
+def random_condition(rng, d):
+    col = rng.choice(FILTER_COLUMNS)
+    op = rng.choice(OPS)
+    if op == "between":
+        val = sorted([random_value(rng, col, d), random_value(rng, col, d)], key=lambda v: _sort_key(col, v))
+    elif op == "in":
+        val = [random_value(rng, col, d) for _ in range(rng.randint(1, 3))]
+    else:
+        val = random_value(rng, col, d)
+    return {"col": col, "op": op, "val": val}
+
+
+def random_query(rng, d):
+    q = {"from": "events"}
+    if rng.random() < 0.1:
+        # A projection, ordered by everything it selects so that LIMIT is
+        # deterministic
+        select = rng.sample(["ts", "type", "country", "advertiser_id", "bid_price"], rng.randint(1, 3))
+        q["select"] = select
+        q["where"] = [random_condition(rng, d) for _ in range(rng.randint(1, 3))]
+        q["order_by"] = [{"col": col, "dir": rng.choice(["asc", "desc"])} for col in select]
+        if rng.random() < 0.3:
+            # Every column, which a --compact layout has to join back. The
+            # order doesn't name a cold column, so only the "*" asks for them.
+            q["select"] = ["*"]
+            q["order_by"] = [{"col": col, "dir": rng.choice(["asc", "desc"])} for col in STAR_ORDER]
+        q["limit"] = rng.choice([10, 100])
+        return q
+
+    keys = rng.sample(GROUP_COLUMNS, rng.choice([0, 1, 1, 2]))
+    if rng.random() < 0.15:
+        keys = [{"bucket": rng.choice(BUCKETS)}]
+    aggregations = rng.sample(AGGREGATIONS, rng.randint(1, 2))
+    # Impression counts and bid_price sums are what the rollups answer, so
+    # they are worth generating more often
+    if rng.random() < 0.4:
+        aggregations = rng.sample([("SUM", "bid_price"), ("COUNT", "*"), ("AVG", "bid_price")], rng.randint(1, 2))
+    q["select"] = [*keys, *({func: col} for func, col in aggregations)]
+    where = [random_condition(rng, d) for _ in range(rng.choice([0, 1, 1, 2, 3]))]
+    if rng.random() < 0.4:
+        where.append({"col": "type", "op": "eq", "val": "impression"})
+    if where:
+        q["where"] = where
+    if keys:
+        q["group_by"] = keys
+    if keys and rng.random() < 0.5:
+        func, col = rng.choice(aggregations)
+        name = f"{func}({col[0]}, {col[1]})" if isinstance(col, list) else f"{func}({col})"
+        order_by = [{"col": name, "dir": rng.choice(["asc", "desc"])}]
+        if rng.random() < 0.5:
+            # With every key in ORDER BY the LIMIT picks the same groups
+            # whichever SQL runs
+            order_by += [{"col": "bucket" if _is_bucket(key) else key, "dir": "asc"} for key in keys]
+            q["limit"] = rng.choice([1, 5, 20])
+            if rng.random() < 0.3:
+                q["offset"] = rng.choice([1, 5])
+        q["order_by"] = order_by
+    return q
+
+
+def _kind(cols):
+    kinds = ["bucket" if _is_bucket(col) else "time" if col in TEMPORALS else "other" for col in cols]
+    return "+".join(sorted(set(kinds))) or "-"
+
+
+def shape(q, sql):
+    """
+    What the speedups are reported by: the table the SQL reads, the
+    aggregations, and whether it groups and filters by time or other columns.
+    """
+    aggregations = sorted({func.upper() for item in q["select"] if isinstance(item, dict) and not _is_bucket(item)
+                           for func in item})
+    table = FROM_TABLE.search(sql).group(1) if FROM_TABLE.search(sql) else "?"
+    return (f"{table} | {'+'.join(aggregations) or 'projection'} | by {_kind(q.get('group_by', []))} "
+            f"| where {_kind(cond['col'] for cond in q.get('where', []) if cond['col'] != 'type')}")
+
+
+def timed(con, sql, repeat):
+    """The rows of `sql` and its fastest time over `repeat` runs."""
+    best = None
+    for _ in range(repeat):
+        t0 = time.time()
+        rows = con.execute(sql).fetchall()
+        dt = time.time() - t0
+        best = dt if best is None else min(best, dt)
+    return rows, best
+
+
+def _comparable(rows):
+    # Same row order for both results, since ties under ORDER BY may come
+    # back in either order
+    return sorted([str(v) for v in row] for row in rows)
+
+
+def run(out_dir, n_queries, seed, repeat):
+    out_dir.mkdir(parents=True, exist_ok=True)
+    con = duckdb.connect(DB_PATH, read_only=True)
+    con.execute("SET timezone = 'America/Los_Angeles';")
+    catalog = load_catalog(con)
+    d = domain(con, catalog)
+    rng = random.Random(seed)
+
+    results = []
+    failures = []
+    for i in range(1, n_queries + 1):
+        q = random_query(rng, d)
+        baseline_sql = assemble_sql(q)
+        if catalog is not None and catalog["cold_columns"] and "*" in q["select"]:
+            # The baseline reads every column of a --compact layout's events,
+            # as the plain layout has them
+            cold_join = f"SELECT * EXCLUDE (row_id) FROM {TABLE_NAME} JOIN {TABLE_NAME}_cold USING (row_id)"
+            baseline_sql = FROM_TABLE.sub(f"FROM ({cold_join}) AS {TABLE_NAME}", baseline_sql, count=1)
+        optimized_sql = assemble_sql(q, dark_launch=True, catalog=catalog)
+        try:
+            expected, baseline_s = timed(con, baseline_sql, repeat)
+        except duckdb.Error as e:
+            # Not a valid query after all, e.g. a literal out of a column's range
+            print(f"🟨 Query {i} is invalid: {e}", file=sys.stderr)
+            continue
+        try:
+            rows, optimized_s = timed(con, optimized_sql, repeat)
+        except duckdb.Error as e:
+            print(f"❌ Query {i} fails with dark_launch: {e}", file=sys.stderr)
+            failures.append({"query": q, "sql": optimized_sql, "error": str(e)})
+            continue
+        rows, expected = _comparable(rows), _comparable(expected)
+        if len(rows) != len(expected) or not all(rows_equal(a, b) for a, b in zip(rows, expected)):
+            print(f"❌ Query {i} returns different rows with dark_launch:\n{q}", file=sys.stderr)
+            failures.append({"query": q, "sql": optimized_sql, "rows": len(rows), "expected_rows": len(expected)})
+            continue
+        results.append({
+            "query": i,
+            "shape": shape(q, optimized_sql),
+            # Every rewrite but a rollup only adds filters to the same scan
+            "rollup": FROM_TABLE.search(optimized_sql).group(1) != TABLE_NAME,
+            "baseline_s": baseline_s,
+            "dark_launch_s": optimized_s,
+            "speedup": baseline_s / max(optimized_s, 1e-9),
+            "json": json.dumps(q),
+        })
+    con.close()
+
+    with (out_dir / "fuzz.csv").open("w", newline="") as f:
+        w = csv.DictWriter(f, fieldnames=["query", "shape", "rollup", "baseline_s", "dark_launch_s", "speedup", "json"])
+        w.writeheader()
+        w.writerows(results)
+    (out_dir / "failures.json").write_text(json.dumps(failures, indent=2))
+
+    by_shape = defaultdict(list)
+    for r in results:
+        by_shape[r["shape"]].append(r["speedup"])
+    print(f"\nSpeedup of dark_launch by shape ({len(results)} queries agree, {len(failures)} disagree):")
+    for s, speedups in sorted(by_shape.items(), key=lambda item: -np.median(item[1])):
+        print(f"{s}: n={len(speedups)}\tmedian {np.median(speedups):.2f}x\tmin {np.min(speedups):.2f}x\tmax {np.max(speedups):.2f}x")
+    for label, rollup in [("On a rollup", True), ("On events", False)]:
+        speedups = [r["speedup"] for r in results if r["rollup"] == rollup]
+        if speedups:
+            print(f"{label}: {len(speedups)} queries, median speedup {np.median(speedups):.2f}x, "
+                  f"p10 {np.percentile(speedups, 10):.2f}x, p90 {np.percentile(speedups, 90):.2f}x")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check random queries give the same results with and without dark_launch, and where it's faster."
+    )
+    parser.add_argument(
+        "--out-dir",
+        type=Path,
+        required=True,
+        help="Where to write the timings and failing queries"
+    )
+    parser.add_argument(
+        "--queries",
+        type=int,
+        default=200,
+        help="How many random queries to generate"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the generator, to reproduce a run"
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Runs of each SQL, of which the fastest is timed"
+    )
+
+    args = parser.parse_args()
+    failures = run(args.out_dir, args.queries, args.seed, args.repeat)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Database Generations
+--------------------
+
+Builds each preprocessed database as a new generation file next to the one
+readers are using, then publishes it by atomically replacing the CURRENT
+pointer. Readers (see GenerationReader and server.py --generations) keep
+serving the old generation while the new one builds, swap once it's warmed
+up, and close and delete the old file when its last in-flight query ends.
+
+If the data directory only gained CSV parts since the current generation,
+the new generation starts as a copy of it and only the new parts are
+ingested. Otherwise it's loaded from scratch.
+
+Usage:
+  python generations.py --data-dir ./data [--approximate] [--partition-by-type] [--compact]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import duckdb
+
+from catalog import load_catalog
+from inputs import queries
+from main import load_data
+from warmup import warm_up
+
+GENERATION_DIR = Path("tmp/generations")
+# Seconds between readers' checks for a new generation
+POLL_INTERVAL_S = 1.0
+
+
+def generation_path(n, generation_dir=GENERATION_DIR):
+    return generation_dir / f"gen_{n}.duckdb"
+
+
+def current_generation(generation_dir=GENERATION_DIR):
+    """The published generation number, or None before the first one."""
+    try:
+        return int((generation_dir / "CURRENT").read_text())
+    except FileNotFoundError:
+        return None
+
+
+def _sources(data_dir):
+    return {
+        str(p.resolve()): [p.stat().st_size, p.stat().st_mtime]
+        for p in sorted(data_dir.glob("events_part_*.csv"))
+    }
+
+
+def build_generation(data_dir, approximate=False, partition_by_type=False, compact=False,
+                     generation_dir=GENERATION_DIR):
+    """
+    Builds and publishes the next generation from `data_dir`. Returns its
+    number, or the current one if nothing changed.
+    """
+    # Imported here because ingest.py imports server.py, which imports this
+    from ingest import ingest_batch
+
+    generation_dir.mkdir(parents=True, exist_ok=True)
+    current = current_generation(generation_dir)
+    n = 0 if current is None else current + 1
+    path = generation_path(n, generation_dir)
+    options = {"approximate": approximate, "partition_by_type": partition_by_type, "compact": compact}
+    sources = _sources(data_dir)
+
+    previous = None
+    if current is not None:
+        previous = json.loads(generation_path(current, generation_dir).with_suffix(".json").read_text())
+    new_paths = []
+    if previous is not None and previous["options"] == options \
+            and all(sources.get(p) == stat for p, stat in previous["sources"].items()):
+        new_paths = [Path(p) for p in sources if p not in previous["sources"]]
+        if not new_paths:
+            print(f"🟩 Generation {current} is up to date", file=sys.stderr)
+            return current
+
+    path.unlink(missing_ok=True)
+    if new_paths:
+        # Readers only hold the current generation read only, so it can be
+        # copied while they query it
+        print(f"🟩 Building generation {n} from generation {current} and {len(new_paths)} new parts ...", file=sys.stderr)
+        shutil.copyfile(generation_path(current, generation_dir), path)
+        con = duckdb.connect(path)
+        con.execute("SET timezone = 'America/Los_Angeles';")
+        # Also refreshes the sample and sketches of an --approximate load
+        ingest_batch(con, new_paths)
+    else:
+        print(f"🟩 Building generation {n} ...", file=sys.stderr)
+        con = duckdb.connect(path)
+        con.execute("SET timezone = 'America/Los_Angeles';")
+        load_data(con, data_dir, approximate=approximate, partition_by_type=partition_by_type, compact=compact)
+    con.execute("CHECKPOINT;")
+    con.close()
+
+    path.with_suffix(".json").write_text(json.dumps({"options": options, "sources": sources}))
+    # Publish by replacing the pointer, which readers see whole or not at all
+    tmp_pointer = generation_dir / "CURRENT.tmp"
+    tmp_pointer.write_text(str(n))
+    os.replace(tmp_pointer, generation_dir / "CURRENT")
+    print(f"🟩 Published generation {n}", file=sys.stderr)
+
+    # Readers delete the generation they swap away from once it drains.
+    # Anything older than the previous generation has no readers left that
+    # will swap, so clean it up here.
+    for old in generation_dir.glob("gen_*.duckdb"):
+        if int(old.stem.split("_")[1]) < n - 1:
+            old.unlink(missing_ok=True)
+            old.with_suffix(".json").unlink(missing_ok=True)
+    return n
+
+
+class GenerationReader:
+    """
+    Serves queries from the current generation. acquire() pins the
+    generation a query runs against, and refresh() swaps to a newly published
+    one, closing and deleting the old generation once no query pins it.
+    """
+
+    def __init__(self, generation_dir=GENERATION_DIR, workload=queries):
+        self.generation_dir = generation_dir
+        self.workload = workload
+        self.lock = threading.Lock()
+        self.current = None
+        if not self.refresh():
+            raise FileNotFoundError(f"No published generation in {generation_dir}")
+
+    def refresh(self):
+        """Swaps to the published generation if it's newer. Returns whether it did."""
+        n = current_generation(self.generation_dir)
+        if n is None or (self.current is not None and self.current["n"] == n):
+            return False
+        con = duckdb.connect(generation_path(n, self.generation_dir), read_only=True)
+        con.execute("SET timezone = 'America/Los_Angeles';")
+        catalog = load_catalog(con)
+        # Warm the new generation before any query sees it
+        warm_up(con, self.workload, catalog)
+        with self.lock:
+            old, self.current = self.current, {"n": n, "con": con, "catalog": catalog, "in_flight": 0}
+            if old is not None:
+                self._retire_if_drained(old)
+        print(f"🟩 Serving generation {n}", file=sys.stderr)
+        return True
+
+    def watch(self, interval=POLL_INTERVAL_S):
+        while True:
+            time.sleep(interval)
+            self.refresh()
+
+    @contextmanager
+    def acquire(self):
+        """A cursor and catalog of the current generation, pinned until exit."""
+        with self.lock:
+            generation = self.current
+            generation["in_flight"] += 1
+        cur = generation["con"].cursor()
+        try:
+            cur.execute("SET timezone = 'America/Los_Angeles';")
+            yield cur, generation["catalog"]
+        finally:
+            cur.close()
+            with self.lock:
+                generation["in_flight"] -= 1
+                self._retire_if_drained(generation)
+
+    def _retire_if_drained(self, generation):
+        # Called with the lock held
+        if generation is self.current or generation["in_flight"] > 0:
+            return
+        generation["con"].close()
+        path = generation_path(generation["n"], self.generation_dir)
+        path.unlink(missing_ok=True)
+        path.with_suffix(".json").unlink(missing_ok=True)
+        path.with_suffix(".duckdb.wal").unlink(missing_ok=True)
+
+    def close(self):
+        with self.lock:
+            self.current["con"].close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build and publish the next database generation while readers keep serving the current one."
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        required=True,
+        help="The folder where the input CSV is provided"
+    )
+    parser.add_argument(
+        "--approximate",
+        action="store_true",
+        help="Also build the sample and sketches for approximate queries"
+    )
+    parser.add_argument(
+        "--partition-by-type",
+        action="store_true",
+        help="Store each event type in its own table behind an events view"
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Move cold wide columns to a side table and store the rest in the narrowest types the data allows"
+    )
+
+    args = parser.parse_args()
+    build_generation(args.data_dir, args.approximate, args.partition_by_type, args.compact)
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+Streaming Ingest
+----------------
+
+Tails a spool directory for CSV files in the events_part_*.csv format and
+appends each micro-batch to the preprocessed database in one transaction,
+refreshing the catalog, the bid rollups and the --approximate sample and
+sketches only for the days and minutes the batch touches. Producers should
+write files elsewhere and rename them into the spool so half-written files
+are never picked up. Ingested files are moved to <spool>/done, and files that
+fail to ingest to <spool>/rejected.
+
+With --port, the daemon also serves queries like server.py from its own
+connection (DuckDB allows one writing process per file), and /metrics reports
+the ingest rate and freshness lag.
+
+Usage:
+  python ingest.py [--spool-dir tmp/spool] [--interval 1.0] [--port 8765]
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+
+import duckdb
+
+import server
+import standing
+from assembler import rollup_table
+from catalog import load_catalog, ROLLUP_LEVELS
+from main import DB_PATH, TABLE_NAME, build_sample, build_sketches, load_one_csv
+
+SPOOL_DIR = Path("tmp/spool")
+# Seconds between polls of the spool directory, which bounds how long an
+# event waits before its batch starts loading
+BATCH_INTERVAL_S = 1.0
+# Most files loaded in one batch, so a backlog can't make one batch slow
+MAX_BATCH_FILES = 16
+STATUS_PATH = Path("tmp/ingest_status.json")
+# The groups of standing queries each batch changed, one JSON line per group
+STANDING_CHANGES_PATH = Path("tmp/standing_changes.jsonl")
+
+
+def _in_batch(col, con):
+    # Literal bounds let the zone maps skip row groups, the IN list is exact
+    low, high = con.execute(f"SELECT MIN({col}), MAX({col}) FROM {TABLE_NAME}_batch").fetchone()
+    return (f"{col} BETWEEN '{low}' AND '{high}' "
+            f"AND {col} IN (SELECT DISTINCT {col} FROM {TABLE_NAME}_batch)")
+
+
+def refresh_catalog(con):
+    # Same statistics as build_catalog, for the batch's part and days
+    con.execute(f"""
+        INSERT INTO {TABLE_NAME}_stats_parts
+        SELECT part, COUNT(*) AS rows, MIN(ts) AS min_ts, MAX(ts) AS max_ts
+        FROM {TABLE_NAME}_batch
+        GROUP BY part
+        ORDER BY part;
+    """)
+    touched_days = _in_batch("day", con)
+    con.execute(f"DELETE FROM {TABLE_NAME}_stats WHERE {touched_days};")
+    con.execute(f"""
+        INSERT INTO {TABLE_NAME}_stats
+        SELECT
+            day,
+            type,
+            INT_TO_COUNTRY(country) AS country,
+            COUNT(*) AS rows,
+            COUNT(bid_price) AS bid_price_rows,
+            MIN(ts) AS min_ts,
+            MAX(ts) AS max_ts
+        FROM {TABLE_NAME}
+        WHERE {touched_days}
+        GROUP BY day, type, country
+        ORDER BY day;
+    """)
+
+
+def refresh_rollups(con):
+    # Rebuild the minutes the batch touched from events, then each coarser
+    # level from the one below, like load_data does for the whole table
+    touched_minutes = _in_batch("minute", con)
+    con.execute(f"DELETE FROM {rollup_table('minute')} WHERE {touched_minutes};")
+    con.execute(f"""
+        INSERT INTO {rollup_table('minute')}
+        SELECT
+            minute,
+            ANY_VALUE(hour) as hour,
+            ANY_VALUE(day) as day,
+            ANY_VALUE(week) as week,
+            SUM(bid_price) AS sum_bid_price,
+            SUM(CASE WHEN type = 'impression' THEN 1 ELSE 0 END) AS count_impressions,
+        FROM {TABLE_NAME}
+        WHERE {touched_minutes}
+        GROUP BY minute
+        HAVING count_impressions > 0;
+    """)
+    for finer, coarser in zip(ROLLUP_LEVELS, ROLLUP_LEVELS[1:]):
+        coarser_levels = ROLLUP_LEVELS[ROLLUP_LEVELS.index(coarser) + 1:]
+        touched = _in_batch(coarser, con)
+        con.execute(f"DELETE FROM {rollup_table(coarser)} WHERE {touched};")
+        con.execute(f"""
+            INSERT INTO {rollup_table(coarser)}
+            SELECT
+                {coarser},
+                {"".join(f"ANY_VALUE({level}) AS {level}, " for level in coarser_levels)}
+                SUM(sum_bid_price) AS sum_bid_price,
+                SUM(count_impressions) AS count_impressions,
+            FROM {rollup_table(finer)}
+            WHERE {touched}
+            GROUP BY {coarser}
+            ORDER BY {coarser};
+        """)
+
+    # Prefix sums change from the first touched minute on, which for a
+    # stream in ts order is only the newest few minutes
+    (first,) = con.execute(f"SELECT MIN(minute) FROM {TABLE_NAME}_batch").fetchone()
+    con.execute(f"DELETE FROM {TABLE_NAME}_bids_minutes_prefix WHERE minute >= '{first}';")
+    con.execute(f"""
+        INSERT INTO {TABLE_NAME}_bids_minutes_prefix
+        WITH before AS (
+            SELECT prefix_sum_bid_price, prefix_count_impressions
+            FROM {TABLE_NAME}_bids_minutes_prefix
+            ORDER BY minute DESC
+            LIMIT 1
+        )
+        SELECT
+            minute,
+            hour,
+            day,
+            week,
+            before.prefix_sum_bid_price + SUM(sum_bid_price) OVER (ORDER BY minute ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) AS prefix_sum_bid_price,
+            before.prefix_count_impressions + SUM(count_impressions) OVER (ORDER BY minute ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) AS prefix_count_impressions,
+            sum_bid_price,
+            count_impressions
+        FROM {rollup_table('minute')}, before
+        WHERE minute >= '{first}'
+        ORDER BY minute;
+    """)
+
+
+def refresh_approximate(con):
+    # The --approximate sample's strata of the days the batch touched and the
+    # sketches' rows of its minutes, so estimates include the streamed rows
+    build_sample(con, touched_days=_in_batch("day", con))
+    build_sketches(con, touched_minutes=_in_batch("minute", con))
+
+
+def compact_misfits(con):
+    """
+    The batch's values that the narrower types of a --compact layout can't
+    hold exactly, as (column, value, type). INSERT BY NAME would fail on
+    such an id and silently round such a price.
+    """
+    loaded = {row[0]: row[1] for row in con.execute(f"DESCRIBE {TABLE_NAME}_csv").fetchall()}
+    misfits = []
+    for col, narrow, *_ in con.execute(f"DESCRIBE {TABLE_NAME}").fetchall():
+        if col not in loaded or loaded[col] == narrow:
+            continue
+        (value,) = con.execute(f"""
+            SELECT ANY_VALUE({col}) FROM {TABLE_NAME}_csv
+            WHERE TRY_CAST({col} AS {narrow}) IS DISTINCT FROM {col}
+        """).fetchone()
+        if value is not None:
+            misfits.append((col, value, narrow))
+    return misfits
+
+
+def ingest_batch(con, csv_paths, on_change=None):
+    """
+    Appends the rows of `csv_paths` to events and refreshes the catalog,
+    rollups, sample, sketches and standing queries for them, atomically.
+    Returns (rows, newest event ts as epoch seconds). After the commit,
+    calls `on_change` with each standing query's name, columns and the new
+    rows of the groups the batch changed.
+    """
+    catalog = load_catalog(con)
+    (part,) = con.execute(f"SELECT COALESCE(MAX(part) + 1, 0) FROM {TABLE_NAME}_stats_parts").fetchone()
+    con.execute(f"CREATE OR REPLACE TEMP TABLE {TABLE_NAME}_csv AS SELECT * FROM {TABLE_NAME}_unsorted LIMIT 0;")
+    for i, csv_path in enumerate(csv_paths):
+        load_one_csv(con, csv_path, part + i, table=f"{TABLE_NAME}_csv")
+    rows, newest = con.execute(f"SELECT COUNT(*), epoch(MAX(ts)::TIMESTAMPTZ) FROM {TABLE_NAME}_csv").fetchone()
+    if rows == 0:
+        return 0, None
+    misfits = compact_misfits(con)
+    if misfits:
+        raise ValueError(
+            "The batch doesn't fit the --compact layout's column types ("
+            + ", ".join(f"{col} {value} in {narrow}" for col, value, narrow in misfits)
+            + "). Reload with main.py --compact to size them for it, or without --compact."
+        )
+
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        # Row ids continue where the table left off, for the side table of
+        # a --compact layout
+        cold = catalog["cold_columns"]
+        (last_row_id,) = con.execute(f"SELECT MAX(row_id) FROM {TABLE_NAME}").fetchone() if cold else (0,)
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE {TABLE_NAME}_batch AS
+            SELECT {last_row_id or 0} + row_number() OVER (ORDER BY ts) AS row_id, *
+            FROM {TABLE_NAME}_csv;
+        """)
+        columns = f"* EXCLUDE (part, {', '.join(cold)})" if cold else "* EXCLUDE (part, row_id)"
+        # Appending in ts order keeps the zone maps of a stream tight. BY
+        # NAME casts to the narrower types of a --compact layout, which
+        # compact_misfits checked the batch fits.
+        if catalog["partitions"]:
+            for event_type in catalog["partitions"]:
+                con.execute(f"""
+                    INSERT INTO {TABLE_NAME}_{event_type} BY NAME
+                    SELECT {columns} FROM {TABLE_NAME}_batch
+                    WHERE type = '{event_type}'
+                    ORDER BY ts;
+                """)
+        else:
+            con.execute(f"INSERT INTO {TABLE_NAME} BY NAME SELECT {columns} FROM {TABLE_NAME}_batch ORDER BY ts;")
+        if cold:
+            con.execute(f"""
+                INSERT INTO {TABLE_NAME}_cold
+                SELECT row_id, {", ".join(cold)} FROM {TABLE_NAME}_batch
+                ORDER BY row_id;
+            """)
+        refresh_catalog(con)
+        refresh_rollups(con)
+        refresh_approximate(con)
+        changes = standing.maintain(con, f"{TABLE_NAME}_batch")
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+    # Only once they're committed, so nothing that rolls back is emitted
+    if on_change is not None:
+        for name, (cols, changed) in changes.items():
+            on_change(name, cols, changed)
+    return rows, newest
+
+
+def ingest_files(con, csv_paths, rejected_dir, on_change=None):
+    """
+    Ingests `csv_paths` as one batch. If it fails, ingests each file on its
+    own, so one bad file doesn't hold back the others, and moves the files
+    that fail to `rejected_dir`. Returns the rows ingested, the newest event
+    ts, the files ingested and (file, error) of the files rejected.
+    """
+    try:
+        rows, newest = ingest_batch(con, csv_paths, on_change)
+        return rows, newest, csv_paths, []
+    except Exception as e:
+        if len(csv_paths) == 1:
+            print(f"🟥 Rejected {csv_paths[0].name}: {e}", file=sys.stderr)
+            csv_paths[0].replace(rejected_dir / csv_paths[0].name)
+            return 0, None, [], [(csv_paths[0], str(e))]
+    results = [ingest_files(con, [csv_path], rejected_dir, on_change) for csv_path in csv_paths]
+    return (
+        sum(rows for rows, _, _, _ in results),
+        max((newest for _, newest, _, _ in results if newest is not None), default=None),
+        [p for _, _, ingested, _ in results for p in ingested],
+        [r for _, _, _, rejected in results for r in rejected],
+    )
+
+
+def publish(status):
+    # Atomically replace the status file so readers never see half of it
+    tmp_path = STATUS_PATH.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(status))
+    tmp_path.replace(STATUS_PATH)
+    server.ingest_status = status
+
+
+def run(spool_dir, interval, port):
+    spool_dir.mkdir(parents=True, exist_ok=True)
+    (spool_dir / "done").mkdir(exist_ok=True)
+    (spool_dir / "rejected").mkdir(exist_ok=True)
+    con = duckdb.connect(DB_PATH)
+    con.execute("SET timezone = 'America/Los_Angeles';")
+    if port is not None:
+        threading.Thread(target=server.serve, args=(port, con), daemon=True).start()
+    # The server interrupts its connection during warm-up, so ingest uses
+    # its own
+    cur = con.cursor()
+    cur.execute("SET timezone = 'America/Los_Angeles';")
+
+    status = {"batches": 0, "rows": 0, "rows_per_s": None, "arrival_lag_s": None, "event_lag_s": None,
+              "rejected_files": 0, "last_error": None}
+
+    def emit(name, cols, changed):
+        # Re-emits the standing query groups a batch changed, for readers
+        # that follow the file instead of polling whole results
+        # The batch has committed, so a failure here mustn't reject its files
+        try:
+            with STANDING_CHANGES_PATH.open("a") as f:
+                for row in changed:
+                    f.write(json.dumps({"batch": status["batches"] + 1, "standing": name, **dict(zip(cols, row))},
+                                       default=str) + "\n")
+        except OSError as e:
+            print(f"🟨 Couldn't write the changes of standing query {name}: {e}", file=sys.stderr)
+            return
+        print(f"  - Standing query {name}: {len(changed)} groups changed", file=sys.stderr)
+
+    print(f"🟩 Watching {spool_dir} ...", file=sys.stderr)
+    try:
+        while True:
+            t0 = time.time()
+            csv_paths = sorted(spool_dir.glob("*.csv"))[:MAX_BATCH_FILES]
+            if csv_paths:
+                arrived = {p: p.stat().st_mtime for p in csv_paths}
+                rows, newest, ingested, rejected = ingest_files(cur, csv_paths, spool_dir / "rejected", on_change=emit)
+                for p in ingested:
+                    p.replace(spool_dir / "done" / p.name)
+                if server.con is not None and ingested:
+                    server.catalog = load_catalog(cur)
+                now = time.time()
+                status = {
+                    **status,
+                    "rejected_files": status["rejected_files"] + len(rejected),
+                    "last_error": f"{rejected[-1][0].name}: {rejected[-1][1]}" if rejected else status["last_error"],
+                }
+                if ingested:
+                    status = {
+                        **status,
+                        "batches": status["batches"] + 1,
+                        "rows": status["rows"] + rows,
+                        "rows_per_s": rows / (now - t0),
+                        # How long the oldest file in the batch waited to become
+                        # queryable, and how far behind the newest event is
+                        "arrival_lag_s": now - min(arrived[p] for p in ingested),
+                        "event_lag_s": now - newest if newest is not None else status["event_lag_s"],
+                    }
+                    print(f"✅ Batch of {len(ingested)} files: {rows} rows at {status['rows_per_s']:.0f} rows/s, "
+                          f"arrival lag {status['arrival_lag_s']:.3f}s", file=sys.stderr)
+                publish(status)
+            time.sleep(max(0.0, interval - (time.time() - t0)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cur.close()
+        con.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Append CSV micro-batches from a spool directory to the preprocessed database."
+    )
+    parser.add_argument(
+        "--spool-dir",
+        type=Path,
+        default=SPOOL_DIR,
+        help="Directory to pick up events_part_*.csv formatted files from"
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=BATCH_INTERVAL_S,
+        help="Seconds between polls of the spool directory"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=None,
+        help="Also serve queries on this local port, like server.py"
+    )
+
+    args = parser.parse_args()
+    run(args.spool_dir, args.interval, args.port)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Open-Loop Load Test
+-------------------
+
+Replays a weighted mix of the queries and extended_queries from inputs.py at
+Poisson arrival rates against N concurrent workers. Arrivals don't wait for
+earlier queries to finish, so latency is measured from each query's arrival
+and includes the time it queued for a worker. For every offered rate it
+records the achieved throughput and p50/p99 latency, reports the saturation
+point (the first rate the system can't keep up with) and plots the curve to
+plots/load_latency.png.
+
+Queries run in this process on their own cursors of one read-only connection
+like server.py's request threads, or, with --url, against a running server.
+
+Usage:
+  python loadtest.py [--rates 10,20,50,100] [--duration 10] [--workers 8] [--extended-share 0.2] [--url http://127.0.0.1:8765]
+"""
+
+import argparse
+import queue
+import random
+import sys
+import threading
+import time
+
+import duckdb
+import matplotlib.pyplot as plt
+import numpy as np
+
+import client
+from assembler import assemble_sql
+from catalog import load_catalog
+from inputs import queries, extended_queries
+from main import DB_PATH
+from warmup import warm_up
+
+DEFAULT_RATES = [10, 20, 50, 100, 200]
+DEFAULT_DURATION_S = 10.0
+DEFAULT_WORKERS = 8
+# Probability that an arrival is drawn from extended_queries instead of queries
+DEFAULT_EXTENDED_SHARE = 0.2
+# A rate is sustained while throughput keeps up with it and p99 stays below this
+DEFAULT_P99_SLO_MS = 1000.0
+# Fraction of the offered rate that must complete for it to count as kept up with
+KEEP_UP_FRACTION = 0.95
+PLOT_PATH = "plots/load_latency.png"
+
+
+def runnable(workload, execute):
+    """The queries of `workload` that run, skipping invalid ones."""
+    ok = []
+    for q in workload:
+        try:
+            execute(q)
+            ok.append(q)
+        except Exception as e:
+            print(f"🟨 Skipping a query that fails: {e}", file=sys.stderr)
+    return ok
+
+
+def local_executor(db_path):
+    """Runs queries like server.py does, one cursor per worker thread."""
+    con = duckdb.connect(db_path, read_only=True)
+    con.execute("SET timezone = 'America/Los_Angeles';")
+    catalog = load_catalog(con)
+    warm_up(con, queries, catalog)
+    local = threading.local()
+
+    def execute(q):
+        if not hasattr(local, "cur"):
+            local.cur = con.cursor()
+            local.cur.execute("SET timezone = 'America/Los_Angeles';")
+        return len(local.cur.execute(assemble_sql(q, dark_launch=True, catalog=catalog)).fetchall())
+
+    return execute
+
+
+def remote_executor(url):
+    def execute(q):
+        cols, rows = client.query(q, url)
+        return sum(1 for _ in rows)
+
+    return execute
+
+
+def run_rate(execute, draw, rate, duration, workers, rng):
+    """
+    Offers `rate` queries per second for `duration` seconds. Returns the
+    latencies (ms, inf for queries that didn't finish in time), the realized
+    arrival rate, the throughput while queries were arriving and the number
+    of errors.
+    """
+    arrivals = queue.Queue()
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def worker():
+        nonlocal errors
+        while (item := arrivals.get()) is not None:
+            arrived, q = item
+            try:
+                execute(q)
+            except Exception:
+                with lock:
+                    errors += 1
+                continue
+            finished = time.time()
+            with lock:
+                latencies.append((finished, (finished - arrived) * 1000))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for t in threads:
+        t.start()
+
+    # Open loop: arrivals follow the Poisson schedule whether or not the
+    # workers keep up
+    start = time.time()
+    offered = 0
+    next_arrival = start + rng.expovariate(rate)
+    while next_arrival < start + duration:
+        time.sleep(max(0.0, next_arrival - time.time()))
+        arrivals.put((next_arrival, draw()))
+        offered += 1
+        next_arrival += rng.expovariate(rate)
+
+    # Give the backlog as long as the run itself to drain, then drop what's
+    # left
+    deadline = time.time() + duration
+    while not arrivals.empty() and time.time() < deadline:
+        time.sleep(0.01)
+    while True:
+        try:
+            arrivals.get_nowait()
+        except queue.Empty:
+            break
+    for _ in threads:
+        arrivals.put(None)
+    for t in threads:
+        t.join(timeout=max(0.0, deadline - time.time()))
+
+    with lock:
+        done = list(latencies)
+        failed = errors
+    # Dropped queries and those still running never finished in time
+    unfinished = offered - len(done) - failed
+    # Completions after the last arrival are the backlog draining, which
+    # would flatter an overloaded system
+    throughput = sum(1 for finished, _ in done if finished <= start + duration) / duration
+    return [latency for _, latency in done] + [float("inf")] * unfinished, offered / duration, throughput, failed
+
+
+def plot(results, saturation, path=PLOT_PATH):
+    rates = [r["rate"] for r in results]
+    plt.figure(figsize=(10, 6))
+    # Unfinished queries make a percentile infinite, which isn't drawn
+    plt.plot(rates, [np.nan if r["p50_ms"] == float("inf") else r["p50_ms"] for r in results],
+             marker="o", label="p50")
+    plt.plot(rates, [np.nan if r["p99_ms"] == float("inf") else r["p99_ms"] for r in results],
+             marker="o", label="p99")
+    if saturation is not None:
+        plt.axvline(saturation, color="red", linestyle="--", label=f"saturation ({saturation:g}/s)")
+    plt.xscale("log")
+    plt.yscale("log")
+    plt.xlabel("Offered load (queries/s)")
+    plt.ylabel("Latency (ms)")
+    plt.title("Latency versus offered load")
+    plt.legend()
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close()
+
+
+def run(rates, duration, workers, extended_share, p99_slo_ms, url, seed):
+    execute = remote_executor(url) if url else local_executor(DB_PATH)
+    base = runnable(queries, execute)
+    extended = runnable(extended_queries, execute)
+    rng = random.Random(seed)
+
+    def draw():
+        # Each query of a list is equally likely, the lists by extended_share
+        return rng.choice(extended if rng.random() < extended_share else base)
+
+    results = []
+    saturation = None
+    for rate in rates:
+        print(f"🟦 Offering {rate:g} queries/s for {duration:g}s ...", file=sys.stderr)
+        latencies, arrival_rate, throughput, errors = run_rate(execute, draw, rate, duration, workers, rng)
+        r = {
+            "rate": rate,
+            "throughput": throughput,
+            # Without interpolation, which would turn inf into nan
+            "p50_ms": float(np.percentile(latencies, 50, method="higher")) if latencies else float("inf"),
+            "p99_ms": float(np.percentile(latencies, 99, method="higher")) if latencies else float("inf"),
+            "errors": errors,
+        }
+        results.append(r)
+        print(f"✅ {throughput:.1f} queries/s | p50 {r['p50_ms']:.1f}ms | p99 {r['p99_ms']:.1f}ms | errors {errors}",
+              file=sys.stderr)
+        # Compared with the realized arrival rate so Poisson noise doesn't
+        # count as falling behind
+        if saturation is None and (throughput < KEEP_UP_FRACTION * arrival_rate or r["p99_ms"] > p99_slo_ms):
+            saturation = rate
+
+    plot(results, saturation)
+    print("\nSummary:")
+    for r in results:
+        print(f"{r['rate']:g}/s: throughput {r['throughput']:.1f}/s\tp50 {r['p50_ms']:.1f}ms\tp99 {r['p99_ms']:.1f}ms")
+    sustained = [r["rate"] for r in results if saturation is None or r["rate"] < saturation]
+    if saturation is None:
+        print(f"No saturation up to {rates[-1]:g}/s")
+    else:
+        print(f"Saturates at {saturation:g}/s, highest sustained rate {max(sustained):g}/s" if sustained
+              else f"Saturates at {saturation:g}/s, the lowest rate offered")
+    print(f"Plot written to {PLOT_PATH}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure latency against offered load with Poisson arrivals and concurrent workers."
+    )
+    parser.add_argument(
+        "--rates",
+        type=lambda s: [float(r) for r in s.split(",")],
+        default=DEFAULT_RATES,
+        help="Comma separated arrival rates to offer, in queries per second"
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=DEFAULT_DURATION_S,
+        help="Seconds to offer each rate for"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of queries run concurrently"
+    )
+    parser.add_argument(
+        "--extended-share",
+        type=float,
+        default=DEFAULT_EXTENDED_SHARE,
+        help="Fraction of arrivals drawn from extended_queries instead of queries"
+    )
+    parser.add_argument(
+        "--p99-slo-ms",
+        type=float,
+        default=DEFAULT_P99_SLO_MS,
+        help="p99 latency above which a rate counts as saturated"
+    )
+    parser.add_argument(
+        "--url",
+        default=None,
+        help="Send queries to a running server.py instead of running them in this process"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the arrival times and query choices"
+    )
+
+    args = parser.parse_args()
+    run(args.rates, args.duration, args.workers, args.extended_share, args.p99_slo_ms, args.url, args.seed)
@@ -12,14 +12,23 @@ Usage:
 """
 
 import duckdb
+import json
 import time
+from contextlib import contextmanager
 from pathlib import Path
 import csv
 import argparse
 import sys
-from assembler import assemble_sql
+from assembler import assemble_sql, rollup_table, quantile_table, quantile_bin_sql, SKETCH_COLUMNS, HLL_PRECISION, \
+    TOPK_CAPACITY, QUANTILE_COLUMNS, QUANTILE_DIMENSIONS
+from catalog import load_catalog, estimate_result_rows, EVENT_TYPES, ROLLUP_LEVELS
 from inputs import queries, extended_queries, aggregate_test_queries
-import numpy as np
+from warmup import warm_up
+from colstore import answer, export_columns, load_columns
+from tuning import apply_profile, load_profile, query_class
+import resources
+import standing
+import tracing
 # from judges import queries
 
 
@@ -27,14 +36,38 @@ import numpy as np
 # Configuration
 # -------------------
 DB_PATH = Path("tmp/baseline.duckdb")
+# Memory and I/O usage of the last run's stages and queries, for benchmark.py
+RESOURCES_PATH = Path("tmp/resources.json")
 TABLE_NAME = "events"
+# Fraction of each (type, day) stratum kept in the approximate query sample,
+# and the minimum rows kept per stratum so rare strata still get estimates
+SAMPLE_RATE = 0.01
+SAMPLE_MIN_ROWS = 1000
+# Wide columns no query in inputs.py filters or groups by, which
+# load_data --compact moves to a side table joined by row_id
+COLD_COLUMNS = ["auction_id"]
+# Parts and stages an unfinished load_data committed, see read_checkpoints
+CHECKPOINT_TABLE = f"{TABLE_NAME}_ingest_checkpoints"
 
 
 # -------------------
 # Load Data
 # -------------------
-def load_one_csv(con, csv_path: Path):
+def create_types(con):
     con.execute(f"""
+        DROP TYPE IF EXISTS event_type;
+        CREATE TYPE event_type AS ENUM ({", ".join(f"'{t}'" for t in EVENT_TYPES)});
+    """)
+    # Custom country code encoding that takes advantage of ISO 3166-1 alpha-2
+    con.execute(f"""
+        CREATE OR REPLACE MACRO COUNTRY_TO_INT(country) AS (ascii(country[1]) - 65) * 26 + ascii(country[2]) - 65;
+        CREATE OR REPLACE MACRO INT_TO_COUNTRY(i) AS CONCAT(chr(i // 26 + 65), chr(i % 26 + 65));
+    """)
+
+
+def load_one_csv(con, csv_path: Path, part: int, row_filter=None, table=f"{TABLE_NAME}_unsorted"):
+    # Returns the number of rows loaded
+    (rows,) = con.execute(f"""
         WITH raw AS (
           SELECT *
           FROM read_csv(
@@ -68,7 +101,7 @@ def load_one_csv(con, csv_path: Path):
             COUNTRY_TO_INT(country)                   AS country,
           FROM raw
         )
-        INSERT INTO {TABLE_NAME}_unsorted
+        INSERT INTO {table}
         SELECT
           ts,
           DATE_TRUNC('week', ts)   AS week,
@@ -82,25 +115,411 @@ def load_one_csv(con, csv_path: Path):
           bid_price,
           user_id,
           total_price,
-          country
-        FROM casted;
+          country,
+          {part} AS part
+        FROM casted
+        {f"WHERE {row_filter}" if row_filter else ""};
+    """).fetchone()
+    return rows
+
+def build_catalog(con):
+    # Per-part and per-(day, type, country) row counts and ts ranges for the
+    # planner, see catalog.py
+    con.execute(f"""
+        CREATE OR REPLACE TABLE {TABLE_NAME}_stats_parts AS
+        SELECT part, COUNT(*) AS rows, MIN(ts) AS min_ts, MAX(ts) AS max_ts
+        FROM {TABLE_NAME}_unsorted
+        GROUP BY part
+        ORDER BY part;
+    """)
+    con.execute(f"""
+        CREATE OR REPLACE TABLE {TABLE_NAME}_stats AS
+        SELECT
+            day,
+            type,
+            INT_TO_COUNTRY(country) AS country,
+            COUNT(*) AS rows,
+            COUNT(bid_price) AS bid_price_rows,
+            MIN(ts) AS min_ts,
+            MAX(ts) AS max_ts
+        FROM {TABLE_NAME}
+        GROUP BY day, type, country
+        ORDER BY day;
     """)
 
-def load_data(con, data_dir: Path):
-    csv_files = list(data_dir.glob("events_part_*.csv"))
 
-    if csv_files:
-        print(f"🟩 Loading {len(csv_files)} CSV parts from {data_dir} ...", file=sys.stderr)
-        # Alphabetical order to match VARCHAR comparison/ordering
+def compact_types(con):
+    """
+    The narrowest types that hold every loaded value of the numeric columns,
+    as {column: type}: unsigned integers where there are no negative ids and
+    DECIMALs for prices with few decimal places. Columns that don't fit
+    keep their type.
+    """
+    types = {}
+    for col in ["advertiser_id", "publisher_id", "user_id"]:
+        low, high = con.execute(f"SELECT MIN({col}), MAX({col}) FROM {TABLE_NAME}_unsorted").fetchone()
+        if low is None or low < 0:
+            continue
+        for name, limit in [("UTINYINT", 2 ** 8), ("USMALLINT", 2 ** 16), ("UINTEGER", 2 ** 32)]:
+            if high < limit:
+                types[col] = name
+                break
+    for col in ["bid_price", "total_price"]:
+        # Fewest decimal places that round trip every value
+        scales = ", ".join(f"bool_and({col} = ROUND({col}, {scale}))" for scale in range(7))
+        high, *exact = con.execute(f"SELECT MAX(ABS({col})), {scales} FROM {TABLE_NAME}_unsorted").fetchone()
+        if high is None or True not in exact:
+            continue
+        scale = exact.index(True)
+        digits = len(str(int(high))) + scale
+        # DECIMAL(9) is stored in 4 bytes and DECIMAL(18) in 8
+        for width in (9, 18):
+            if digits <= width:
+                types[col] = f"DECIMAL({width}, {scale})"
+                break
+    return types
+
+
+def replace_rows(con, table, query, touched=None):
+    # Builds `table` from `query`, or with `touched`, replaces only its rows
+    # matching that condition, which `query` has to select by itself. An
+    # absent table isn't created then, as there's nothing to keep current.
+    if touched is None:
+        con.execute(f"CREATE OR REPLACE TABLE {table} AS {query}")
+    elif con.execute("SELECT 1 FROM duckdb_tables() WHERE table_name = ?", [table]).fetchone():
+        con.execute(f"DELETE FROM {table} WHERE {touched};")
+        con.execute(f"INSERT INTO {table} {query}")
+
+
+def build_sample(con, touched_days=None):
+    # Bernoulli sample within each (type, day) stratum. Hashing auction_id
+    # rather than calling random() keeps the sample identical across runs
+    # and thread counts. weight is the inverse inclusion probability.
+    # ingest.py resamples the strata of the days a batch touched.
+    compact = con.execute(f"SELECT 1 FROM duckdb_tables() WHERE table_name = '{TABLE_NAME}_cold'").fetchone()
+    scope = f"WHERE {touched_days}" if touched_days else ""
+    replace_rows(con, f"{TABLE_NAME}_sample", f"""
+        WITH strata AS (
+            SELECT
+                type,
+                day,
+                LEAST(1.0, GREATEST({SAMPLE_RATE}, {SAMPLE_MIN_ROWS} / COUNT(*))) AS p
+            FROM {TABLE_NAME}
+            {scope}
+            GROUP BY type, day
+        )
+        SELECT e.*, 1.0 / s.p AS weight
+        FROM {TABLE_NAME} e JOIN strata s USING (type, day)
+        {f"JOIN {TABLE_NAME}_cold c USING (row_id)" if compact else ""}
+        WHERE (hash({"c" if compact else "e"}.auction_id) % 1000000) / 1000000.0 < s.p
+        ORDER BY ts;
+    """, touched_days)
+
+
+def build_sketches(con, touched_minutes=None):
+    # Every sketch row summarizes one minute, so ingest.py rebuilds only
+    # the minutes a batch touched
+    m = 2 ** HLL_PRECISION
+    scope = f"AND {touched_minutes}" if touched_minutes else ""
+    for col in SKETCH_COLUMNS:
+        # HyperLogLog registers per minute and type. The low bits of the hash
+        # pick the register, and rho is the position of the lowest set bit of
+        # the rest. Only touched registers are stored.
+        replace_rows(con, f"{TABLE_NAME}_{col}_hll", f"""
+            WITH hashed AS (
+                SELECT minute, hour, day, week, type, hash({col}) AS h
+                FROM {TABLE_NAME}
+                WHERE {col} IS NOT NULL {scope}
+            )
+            SELECT
+                minute,
+                ANY_VALUE(hour) AS hour,
+                ANY_VALUE(day) AS day,
+                ANY_VALUE(week) AS week,
+                type,
+                (h & {m - 1})::USMALLINT AS register,
+                MAX(CASE WHEN h >> {HLL_PRECISION} = 0 THEN {64 - HLL_PRECISION + 1}
+                         ELSE bit_count(xor(h >> {HLL_PRECISION}, (h >> {HLL_PRECISION}) - 1)) END)::UTINYINT AS rho
+            FROM hashed
+            GROUP BY minute, type, register
+            ORDER BY minute;
+        """, touched_minutes)
+        # Heavy hitter summaries: the TOPK_CAPACITY most frequent values per
+        # minute and type with their counts, merged later by summing
+        replace_rows(con, f"{TABLE_NAME}_{col}_topk", f"""
+            WITH counts AS (
+                SELECT
+                    minute,
+                    ANY_VALUE(hour) AS hour,
+                    ANY_VALUE(day) AS day,
+                    ANY_VALUE(week) AS week,
+                    type,
+                    {col} AS value,
+                    COUNT(*) AS count
+                FROM {TABLE_NAME}
+                WHERE {col} IS NOT NULL {scope}
+                GROUP BY minute, type, {col}
+            )
+            SELECT * FROM counts
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY minute, type ORDER BY count DESC, value DESC) <= {TOPK_CAPACITY}
+            ORDER BY minute;
+        """, touched_minutes)
+    for col in QUANTILE_COLUMNS:
+        # Quantile sketches: how many values fall in each of the log spaced
+        # bins, per minute and type and once more per minute, type and each
+        # dimension. NULLs get a NULL bin, which keeps the groups without
+        # values.
+        for dimension in [None, *QUANTILE_DIMENSIONS]:
+            keys = f"type, {dimension}" if dimension else "type"
+            replace_rows(con, quantile_table(col, dimension), f"""
+                SELECT
+                    minute,
+                    ANY_VALUE(hour) AS hour,
+                    ANY_VALUE(day) AS day,
+                    ANY_VALUE(week) AS week,
+                    {keys},
+                    {quantile_bin_sql(col)} AS bin,
+                    COUNT(*) AS count
+                FROM {TABLE_NAME}
+                {f"WHERE {touched_minutes}" if touched_minutes else ""}
+                GROUP BY minute, {keys}, bin
+                ORDER BY minute;
+            """, touched_minutes)
+
+
+def drop_sample_and_sketches(con):
+    # Left by an earlier --approximate load, they would answer from old data
+    con.execute(f"DROP TABLE IF EXISTS {TABLE_NAME}_sample;")
+    for col in SKETCH_COLUMNS:
+        con.execute(f"DROP TABLE IF EXISTS {TABLE_NAME}_{col}_hll;")
+        con.execute(f"DROP TABLE IF EXISTS {TABLE_NAME}_{col}_topk;")
+    for col in QUANTILE_COLUMNS:
+        for dimension in [None, *QUANTILE_DIMENSIONS]:
+            con.execute(f"DROP TABLE IF EXISTS {quantile_table(col, dimension)};")
+
+
+def drop_relation(con, name):
+    # DROP TABLE and DROP VIEW both fail on the other kind of relation
+    if con.execute("SELECT 1 FROM duckdb_views() WHERE view_name = ?", [name]).fetchone():
+        con.execute(f"DROP VIEW {name};")
+    else:
+        con.execute(f"DROP TABLE IF EXISTS {name};")
+
+
+def sort_events(con, partition_by_type=False, compact=False):
+    # Returns the number of rows sorted into events.
+    # We have thought about ordering by something more granular
+    # than ts and secondly sort by something else, but there are
+    # no good columns that we think would benefit from being in
+    # the zonemap because they are either too common (type) or
+    # too random (ids).
+    drop_relation(con, TABLE_NAME)
+    for event_type in EVENT_TYPES:
+        drop_relation(con, f"{TABLE_NAME}_{event_type}")
+    drop_relation(con, f"{TABLE_NAME}_cold")
+    source = f"{TABLE_NAME}_unsorted"
+    columns = "* EXCLUDE (part)"
+    if compact:
+        # Cold columns go to a side table that assemble_sql joins back
+        # by row_id when a query needs them, and the rest get the
+        # narrowest types the data allows
+        source = f"{TABLE_NAME}_numbered"
         con.execute(f"""
-            DROP TYPE IF EXISTS event_type;
-            CREATE TYPE event_type AS ENUM ('click', 'impression', 'serve', 'purchase');
+            CREATE OR REPLACE TEMP TABLE {source} AS
+            SELECT row_number() OVER (ORDER BY ts) AS row_id, * EXCLUDE (part)
+            FROM {TABLE_NAME}_unsorted;
         """)
-        # Custom country code encoding that takes advantage of ISO 3166-1 alpha-2
         con.execute(f"""
-            CREATE OR REPLACE MACRO COUNTRY_TO_INT(country) AS (ascii(country[1]) - 65) * 26 + ascii(country[2]) - 65;
-            CREATE OR REPLACE MACRO INT_TO_COUNTRY(i) AS CONCAT(chr(i // 26 + 65), chr(i % 26 + 65));
+            CREATE TABLE {TABLE_NAME}_cold AS
+            SELECT row_id, {", ".join(COLD_COLUMNS)} FROM {source}
+            ORDER BY row_id;
         """)
+        narrowed = ", ".join(f"{col}::{type} AS {col}" for col, type in compact_types(con).items())
+        columns = f"* EXCLUDE ({', '.join(COLD_COLUMNS)})" + (f" REPLACE ({narrowed})" if narrowed else "")
+    if partition_by_type:
+        # Every query filters on type, so store each type separately
+        # (each sorted by ts) and expose them as one events view.
+        # assemble_sql routes type filters straight to the partitions.
+        rows = 0
+        for event_type in EVENT_TYPES:
+            rows += con.execute(f"""
+                CREATE TABLE {TABLE_NAME}_{event_type} AS
+                SELECT {columns} FROM {source}
+                WHERE type = '{event_type}'
+                ORDER BY ts;
+            """).fetchone()[0]
+        union = " UNION ALL ".join(f"SELECT * FROM {TABLE_NAME}_{event_type}" for event_type in EVENT_TYPES)
+        con.execute(f"CREATE VIEW {TABLE_NAME} AS {union};")
+    else:
+        (rows,) = con.execute(f"""
+            CREATE TABLE {TABLE_NAME} AS
+            SELECT {columns} FROM {source}
+            ORDER BY ts;
+        """).fetchone()
+    if compact:
+        con.execute(f"DROP TABLE {source};")
+    return rows
+
+
+def build_rollups(con):
+    # Create temporally pre-grouped tables for faster queries
+    # For queries that match
+    # SELECT (aggregation on bid price)
+    # FROM events
+    # WHERE type = 'impression' AND temporals are coarser than minute granularity
+    # GROUP BY (some time interval)
+    # ORDER BY (any column in the pre-grouped table)
+    t1 = time.time()
+    (rows,) = con.execute(f"""
+        CREATE OR REPLACE TABLE {TABLE_NAME}_bids_minutes AS
+        SELECT
+            minute,
+            ANY_VALUE(hour) as hour,
+            ANY_VALUE(day) as day,
+            ANY_VALUE(week) as week,
+            SUM(bid_price) AS sum_bid_price,
+            SUM(CASE WHEN type = 'impression' THEN 1 ELSE 0 END) AS count_impressions,
+        FROM {TABLE_NAME}
+        GROUP BY minute
+        HAVING count_impressions > 0;
+    """).fetchone()
+    tracing.record("rollup_minute", t1, rows=rows)
+
+    # Each coarser rollup re-aggregates the one below it, so day and
+    # week queries read a row per day or week instead of every minute
+    for finer, coarser in zip(ROLLUP_LEVELS, ROLLUP_LEVELS[1:]):
+        coarser_levels = ROLLUP_LEVELS[ROLLUP_LEVELS.index(coarser) + 1:]
+        t1 = time.time()
+        (rows,) = con.execute(f"""
+            CREATE OR REPLACE TABLE {rollup_table(coarser)} AS
+            SELECT
+                {coarser},
+                {"".join(f"ANY_VALUE({level}) AS {level}, " for level in coarser_levels)}
+                SUM(sum_bid_price) AS sum_bid_price,
+                SUM(count_impressions) AS count_impressions,
+            FROM {rollup_table(finer)}
+            GROUP BY {coarser}
+            ORDER BY {coarser};
+        """).fetchone()
+        tracing.record(f"rollup_{coarser}", t1, rows=rows)
+
+    # Create a prefix sum table for EVEN faster queries brr
+    # For queries that match the above condition
+    t1 = time.time()
+    (rows,) = con.execute(f"""
+        CREATE OR REPLACE TABLE {TABLE_NAME}_bids_minutes_prefix AS
+        WITH base AS (
+            SELECT
+                minute,
+                ANY_VALUE(hour) as hour,
+                ANY_VALUE(day) as day,
+                ANY_VALUE(week) as week,
+                SUM(bid_price) AS sum_bid_price,
+                SUM(CASE WHEN type = 'impression' THEN 1 ELSE 0 END) AS count_impressions
+            FROM {TABLE_NAME}
+            GROUP BY minute
+            HAVING count_impressions > 0
+        ),
+        with_zero AS (
+            SELECT TIMESTAMP '1970-01-01 00:00:00' AS minute,
+                   TIMESTAMP '1970-01-01 00:00:00' AS hour,
+                   TIMESTAMP '1970-01-01 00:00:00' AS day,
+                   TIMESTAMP '1970-01-01 00:00:00' AS week,
+                   0.0 AS sum_bid_price,
+                   0 AS count_impressions
+            UNION ALL
+            SELECT * FROM base
+        )
+        SELECT
+            minute,
+            hour,
+            day,
+            week,
+            SUM(sum_bid_price) OVER (ORDER BY minute ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) AS prefix_sum_bid_price,
+            SUM(count_impressions) OVER (ORDER BY minute ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) AS prefix_count_impressions,
+            sum_bid_price,
+            count_impressions
+        FROM with_zero
+        ORDER BY minute;
+    """).fetchone()
+    tracing.record("rollup_prefix", t1, rows=rows)
+
+
+@contextmanager
+def transaction(con):
+    # The block's statements commit together or not at all, so a crash
+    # never leaves a stage half done
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        yield
+    except BaseException:
+        con.execute("ROLLBACK;")
+        raise
+    con.execute("COMMIT;")
+
+
+def ingest_config(csv_files, **options):
+    # What a checkpoint is valid for: the same options and input files,
+    # by size and modification time
+    return json.dumps({
+        **options,
+        "parts": [[str(p), p.stat().st_size, p.stat().st_mtime_ns] for p in csv_files],
+    }, sort_keys=True)
+
+
+def read_checkpoints(con, config):
+    """
+    The checkpoints an unfinished load_data with the same config left, as
+    {(stage, part): rows}. Checkpoints of any other config are discarded, so
+    the load starts over.
+    """
+    if con.execute("SELECT 1 FROM duckdb_tables() WHERE table_name = ?", [CHECKPOINT_TABLE]).fetchone():
+        checkpoints = con.execute(f"SELECT stage, part, rows, config FROM {CHECKPOINT_TABLE}").fetchall()
+        if checkpoints and all(c == config for *_, c in checkpoints):
+            return {(stage, part): rows for stage, part, rows, _ in checkpoints}
+    con.execute(f"""
+        CREATE OR REPLACE TABLE {CHECKPOINT_TABLE} (
+          stage VARCHAR,
+          part INTEGER,
+          rows BIGINT,
+          config VARCHAR,
+          done_at TIMESTAMP);
+    """)
+    return {}
+
+
+def checkpoint(con, config, stage, part=None, rows=None):
+    con.execute(f"INSERT INTO {CHECKPOINT_TABLE} VALUES (?, ?, ?, ?, now());", [stage, part, rows, config])
+
+
+def load_data(con, data_dir: Path, approximate=False, partition_by_type=False, row_filter=None, compact=False,
+              profile=None):
+    """
+    Loads the CSV parts into events and builds everything derived from it,
+    with the tuned DuckDB settings of each stage from `profile` (by default
+    the one tuning.py saved). Returns the seconds each stage took.
+
+    Each part and each later stage commits with a checkpoint, so a load
+    that dies halfway resumes from the first unfinished part or stage when
+    run again with the same options and files.
+    """
+    csv_files = sorted(data_dir.glob("events_part_*.csv"))
+    if not csv_files:
+        raise FileNotFoundError(f"No events_part_*.csv found in {data_dir}")
+    profile = load_profile() if profile is None else profile
+    timings = {}
+    config = ingest_config(csv_files, approximate=approximate, partition_by_type=partition_by_type,
+                           row_filter=row_filter, compact=compact)
+    done = read_checkpoints(con, config)
+    if done:
+        print(f"🟨 Resuming an unfinished load ({len(done)} checkpoints) ...", file=sys.stderr)
+
+    print(f"🟩 Loading {len(csv_files)} CSV parts from {data_dir} ...", file=sys.stderr)
+    apply_profile(con, "load", profile)
+    window = resources.begin("load")
+    t0 = time.time()
+    if not done:
+        create_types(con)
         # TODO timestamp with tz or not?
         con.execute(f"""
             CREATE OR REPLACE TABLE {TABLE_NAME}_unsorted (
@@ -116,139 +535,189 @@ def load_data(con, data_dir: Path):
               bid_price DOUBLE,
               user_id BIGINT,
               total_price DOUBLE,
-              country USMALLINT);
-        """)
-        con.execute("SET preserve_insertion_order = false;")
-        for csv_path in sorted(csv_files):
-            print(f"  - Loading {csv_path} ...", file=sys.stderr)
-            load_one_csv(con, csv_path)
-        con.execute("SET preserve_insertion_order = true;")
-
-        print(f"🟩 Loading complete", file=sys.stderr)
-        print(f"🟩 Sorting ...", file=sys.stderr)
-        # We have thought about ordering by something more granular
-        # than ts and secondly sort by something else, but there are
-        # no good columns that we think would benefit from being in
-        # the zonemap because they are either too common (type) or
-        # too random (ids).
-        con.execute(f"""
-            CREATE OR REPLACE TABLE {TABLE_NAME} AS
-            SELECT * FROM {TABLE_NAME}_unsorted
-            ORDER BY ts;
-        """)
-        print(f"🟩 Sorting complete", file=sys.stderr)
-
-        # Create temporally pre-grouped tables for faster queries
-        # For queries that match
-        # SELECT (aggregation on bid price)
-        # FROM events
-        # WHERE type = 'impression' AND temporals are coarser than minute granularity
-        # GROUP BY (some time interval)
-        # ORDER BY (any column in the pre-grouped table)
-        con.execute(f"""
-            CREATE OR REPLACE TABLE {TABLE_NAME}_bids_minutes AS
-            SELECT
-                minute,
-                ANY_VALUE(hour) as hour,
-                ANY_VALUE(day) as day,
-                ANY_VALUE(week) as week,
-                SUM(bid_price) AS sum_bid_price,
-                SUM(CASE WHEN type = 'impression' THEN 1 ELSE 0 END) AS count_impressions,
-            FROM {TABLE_NAME}
-            GROUP BY minute
-            HAVING count_impressions > 0;
+              country USMALLINT,
+              part USMALLINT);
         """)
+    # A part counts as loaded only if events_unsorted still holds the rows
+    # its checkpoint recorded
+    loaded = dict(con.execute(f"SELECT part, COUNT(*) FROM {TABLE_NAME}_unsorted GROUP BY part").fetchall())
+    # Once a part or stage is redone, every stage after it is too
+    redo = False
+    con.execute("SET preserve_insertion_order = false;")
+    for part, csv_path in enumerate(csv_files):
+        if ("load_csv", part) in done and done[("load_csv", part)] == loaded.get(part):
+            print(f"  - Skipping {csv_path}, already loaded", file=sys.stderr)
+            continue
+        redo = True
+        print(f"  - Loading {csv_path} ...", file=sys.stderr)
+        with tracing.span("load_csv", part=part, path=str(csv_path), bytes=csv_path.stat().st_size) as s:
+            with transaction(con):
+                # Rows of an earlier attempt at this part, if any
+                con.execute(f"DELETE FROM {TABLE_NAME}_unsorted WHERE part = {part};")
+                s["rows"] = loaded[part] = load_one_csv(con, csv_path, part, row_filter)
+                checkpoint(con, config, "load_csv", part, s["rows"])
+    con.execute("SET preserve_insertion_order = true;")
+    (total,) = con.execute(f"SELECT COUNT(*) FROM {TABLE_NAME}_unsorted").fetchone()
+    if total != sum(loaded.values()):
+        raise RuntimeError(f"{TABLE_NAME}_unsorted holds {total} rows, the parts' checkpoints "
+                           f"{sum(loaded.values())}. Delete {DB_PATH} to load from scratch.")
 
-        # Create a prefix sum table for EVEN faster queries brr
-        # For queries that match the above condition
-        con.execute(f"""
-            CREATE OR REPLACE TABLE {TABLE_NAME}_bids_minutes_prefix AS
-            WITH base AS (
-                SELECT
-                    minute,
-                    ANY_VALUE(hour) as hour,
-                    ANY_VALUE(day) as day,
-                    ANY_VALUE(week) as week,
-                    SUM(bid_price) AS sum_bid_price,
-                    SUM(CASE WHEN type = 'impression' THEN 1 ELSE 0 END) AS count_impressions
-                FROM {TABLE_NAME}
-                GROUP BY minute
-                HAVING count_impressions > 0
-            ),
-            with_zero AS (
-                SELECT TIMESTAMP '1970-01-01 00:00:00' AS minute,
-                       TIMESTAMP '1970-01-01 00:00:00' AS hour,
-                       TIMESTAMP '1970-01-01 00:00:00' AS day,
-                       TIMESTAMP '1970-01-01 00:00:00' AS week,
-                       0.0 AS sum_bid_price,
-                       0 AS count_impressions
-                UNION ALL
-                SELECT * FROM base
-            )
-            SELECT
-                minute,
-                hour,
-                day,
-                week,
-                SUM(sum_bid_price) OVER (ORDER BY minute ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) AS prefix_sum_bid_price,
-                SUM(count_impressions) OVER (ORDER BY minute ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) AS prefix_count_impressions,
-                sum_bid_price,
-                count_impressions
-            FROM with_zero
-            ORDER BY minute;
-        """)
+    timings["load"] = time.time() - t0
+    tracing.record("load", t0, parts=len(csv_files))
+    usage = resources.end(window)
+    print(f"🟩 Loading complete in {timings['load']:.3f}s {resources.describe(usage)}", file=sys.stderr)
 
+    def catalog_and_rollups():
+        with tracing.span("catalog"):
+            build_catalog(con)
+        build_rollups(con)
+
+    # (stage, what it does, its build, the tuned profile it runs with)
+    stages = [
+        ("sort", "Sorting", lambda: sort_events(con, partition_by_type, compact), "sort"),
+        ("rollups", "Collecting statistics and rollups", catalog_and_rollups, "rollups"),
+    ]
+    if approximate:
+        stages += [
+            ("sample", "Sampling", lambda: build_sample(con), "rollups"),
+            ("sketches", "Building sketches", lambda: build_sketches(con), "rollups"),
+        ]
     else:
-        raise FileNotFoundError(f"No events_part_*.csv found in {data_dir}")
+        drop_sample_and_sketches(con)
+    if standing.registered(con):
+        stages.append(("standing", "Rebuilding standing queries", lambda: standing.rebuild(con), "rollups"))
+    for stage, title, build, profile_stage in stages:
+        if not redo and (stage, None) in done:
+            print(f"🟩 {title}: already done, skipping", file=sys.stderr)
+            timings[stage] = 0.0
+            continue
+        redo = True
+        print(f"🟩 {title} ...", file=sys.stderr)
+        apply_profile(con, profile_stage, profile)
+        window = resources.begin(stage)
+        t0 = time.time()
+        with tracing.span(stage) as s:
+            with transaction(con):
+                rows = build()
+                if stage == "sort":
+                    s["rows"] = rows
+                    if rows != total:
+                        raise RuntimeError(f"Sorting produced {rows} rows from {total} loaded")
+                checkpoint(con, config, stage, rows=rows)
+        timings[stage] = time.time() - t0
+        usage = resources.end(window)
+        print(f"🟩 {title} complete in {timings[stage]:.3f}s {resources.describe(usage)}", file=sys.stderr)
+
+    # Finished, so the next load starts from scratch
+    con.execute(f"DROP TABLE {CHECKPOINT_TABLE};")
+    return timings
 
 
 # -------------------
 # Run Queries
 # -------------------
-def run(queries, data_dir: Path, out_dir: Path, skip_preprocessing):
+def run(queries, data_dir: Path, out_dir: Path, skip_preprocessing, approximate=False, partition_by_type=False, compact=False,
+        numpy_engine=False, trace_path=None, memory_ceiling=None, report_resources=False):
+    if trace_path is not None:
+        tracing.start()
+    # The sampler competes with the queries it measures, so it only runs
+    # when asked for
+    if memory_ceiling is not None or report_resources:
+        resources.start(memory_ceiling)
     # Ensure directories exist
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
     out_dir.mkdir(parents=True, exist_ok=True)
 
     con = duckdb.connect(DB_PATH)
     con.execute("SET timezone = 'America/Los_Angeles';")
+    resources.watch(con)
     if not skip_preprocessing:
-        load_data(con, data_dir)
+        with tracing.span("load_data", data_dir=str(data_dir)):
+            load_data(con, data_dir, approximate=approximate, partition_by_type=partition_by_type, compact=compact)
 
+    resources.watch(None)
     con.close()
     con = duckdb.connect(DB_PATH, read_only=True)
     con.execute("SET timezone = 'America/Los_Angeles';")
+    resources.watch(con)
+    catalog = load_catalog(con)
+    columns = None
+    if numpy_engine:
+        # Reused only while they match the rollup, which ingest.py updates
+        columns = load_columns(con) if skip_preprocessing else None
+        if columns is None:
+            with tracing.span("export_columns"):
+                export_columns(con)
+            columns = load_columns(con)
 
-    # Prevent coldstart by executing some sample queries
-    for q in np.random.choice(extended_queries, size=25, replace=False):
-        sql = assemble_sql(q)
-        con.execute(sql)
+    # Prevent coldstart by reading exactly what the queries will read
+    with tracing.span("warm_up") as s:
+        statements, planned, dt = warm_up(con, queries, catalog, approximate)
+        s["statements"] = statements
+    print(f"🟩 Warm-up: {statements}/{planned} statements in {dt:.3f}s", file=sys.stderr)
 
     out_dir.mkdir(parents=True, exist_ok=True)
     results = []
     for i, q in enumerate(queries, 1):
-        sql = assemble_sql(q, dark_launch=True)
+        query_t0 = time.time()
+        with tracing.span("assemble", query=i) as s:
+            sql = assemble_sql(q, dark_launch=True, approximate=approximate, catalog=catalog)
+            s["sql"] = sql
         print(f"\n🟦 Query {i}:\n{q}\n", file=sys.stderr)
+        if catalog is not None:
+            print(f"Estimated rows: {estimate_result_rows(q, catalog)}", file=sys.stderr)
+        apply_profile(con, query_class(sql))
+        # Memory is measured through writing the CSV, which holds every row
+        window = resources.begin(f"query {i}")
+        # The reported time is execution and fetch, as before tracing
         t0 = time.time()
-        res = con.execute(sql)
-        cols = [d[0] for d in res.description]
-        rows = res.fetchall()
+        result = None
+        if columns is not None:
+            with tracing.span("numpy_engine", query=i):
+                result = answer(q, columns)
+        if result is not None:
+            cols, rows = result
+        else:
+            with tracing.span("execute", query=i):
+                res = con.execute(sql)
+            with tracing.span("fetch", query=i) as s:
+                cols = [d[0] for d in res.description]
+                rows = res.fetchall()
+                s["rows"] = len(rows)
         dt = time.time() - t0
 
         print(f"✅ Rows: {len(rows)} | Time: {dt:.3f}s", file=sys.stderr)
 
         out_path = out_dir / f"q{i}.csv"
-        with out_path.open("w", newline="") as f:
-            w = csv.writer(f)
-            w.writerow(cols)
-            w.writerows(rows)
+        with tracing.span("write", query=i, rows=len(rows)) as s:
+            with out_path.open("w", newline="") as f:
+                w = csv.writer(f)
+                w.writerow(cols)
+                w.writerows(rows)
+            s["bytes"] = out_path.stat().st_size
+        usage = resources.end(window)
+        tracing.record("query", query_t0, query=i, rows=len(rows), **usage)
 
-        results.append({"query": i, "rows": len(rows), "time": dt})
+        results.append({"query": i, "rows": len(rows), "time": dt, "usage": usage})
+    resources.stop()
     con.close()
+    if trace_path is not None:
+        tracing.write(trace_path)
+        print(f"🟩 Trace written to {trace_path}", file=sys.stderr)
+
+    stages = [m for m in resources.measured() if not m["name"].startswith("query ")]
+    if report_resources:
+        RESOURCES_PATH.write_text(json.dumps({
+            "stages": stages,
+            "queries": [{"query": r["query"], "time": r["time"], **r["usage"]} for r in results],
+        }))
+    # Stages go to stderr, benchmark.py reads the query lines from stdout
+    for stage in stages:
+        print(f"🟩 {stage['name']}: {resources.describe(stage)}", file=sys.stderr)
 
     print("\nSummary:")
     for r in results:
-        print(f"Q{r['query']}: {r['time']:.3f}s ({r['rows']} rows)")
+        print(f"Q{r['query']}: {r['time']:.3f}s ({r['rows']} rows) {resources.describe(r['usage'])}".rstrip())
     print(f"Total time: {sum(r['time'] for r in results):.3f}s")
 
 
@@ -277,7 +746,57 @@ if __name__ == "__main__":
         help="Skip preprocessing and just run the queries"
     )
 
+    parser.add_argument(
+        "--approximate",
+        action="store_true",
+        help="Estimate COUNT/SUM/AVG queries from a stratified sample, with 95%% confidence intervals, and COUNT_DISTINCT/TOP_K/MEDIAN/QUANTILE from sketches"
+    )
+    parser.add_argument(
+        "--partition-by-type",
+        action="store_true",
+        help="Store each event type in its own table behind an events view"
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Move cold wide columns to a side table and store the rest in the narrowest types the data allows"
+    )
+    parser.add_argument(
+        "--numpy-engine",
+        action="store_true",
+        help="Answer bid_price/impression rollup queries from memory-mapped NumPy columns instead of DuckDB"
+    )
+
+    parser.add_argument(
+        "--trace",
+        type=Path,
+        default=None,
+        help="Write a Chrome trace of the load, assembly, execution, fetch and CSV writing spans to this file"
+    )
+
+    parser.add_argument(
+        "--memory-ceiling",
+        type=resources.parse_size,
+        default=None,
+        help="Abort with an error once the process's RSS exceeds this size (e.g. 8GB), instead of swapping"
+    )
+
+    parser.add_argument(
+        "--resources",
+        action="store_true",
+        help="Sample peak memory and count bytes read per stage and query, written to tmp/resources.json"
+    )
+
     args = parser.parse_args()
-    run(queries, args.data_dir, args.out_dir, args.skip_preprocessing)
+    try:
+        run(queries, args.data_dir, args.out_dir, args.skip_preprocessing, args.approximate, args.partition_by_type,
+            args.compact, args.numpy_engine, args.trace, args.memory_ceiling, args.resources)
+    except (KeyboardInterrupt, duckdb.InterruptException, resources.MemoryCeilingExceeded):
+        # A crossed memory ceiling interrupts whatever was running
+        exceeded = resources.exceeded()
+        if exceeded is None:
+            raise
+        print(f"❌ {exceeded}", file=sys.stderr)
+        sys.exit(1)
     # run(extended_queries, args.data_dir, args.out_dir, args.skip_preprocessing)
     # run(aggregate_test_queries, args.data_dir, args.out_dir, args.skip_preprocessing)
@@ -0,0 +1,201 @@
+# Memory and I/O accounting
+#
+# A background thread samples this process's RSS and DuckDB's own memory and
+# temp file usage (duckdb_memory()) every SAMPLE_INTERVAL_S, from start()
+# until stop(). Until then, nothing runs and measurement windows are empty. begin() opens a
+# measurement window over a stage or query and end() returns its peaks and
+# the bytes the process read meanwhile (/proc/self/io: rchar counts every
+# read including page cache hits, read_bytes only those from storage).
+#
+# With a ceiling, crossing it interrupts the watched DuckDB connection and the
+# main thread, and end() raises MemoryCeilingExceeded naming the stage,
+# instead of letting the machine swap.
+
+import _thread
+import os
+import threading
+
+import duckdb
+
+# Seconds between samples. Shorter catches briefer peaks but costs more CPU
+# and disturbs the timings of whatever runs meanwhile.
+SAMPLE_INTERVAL_S = 0.1
+MIB = 2 ** 20
+
+_lock = threading.Lock()
+_windows = []
+_sampler = None
+_stop = None
+_con = None
+_cur = None
+_ceiling_bytes = None
+_exceeded = None
+_measured = []
+
+
+class MemoryCeilingExceeded(MemoryError):
+    pass
+
+
+def rss_bytes():
+    # Resident pages, from /proc/self/statm on Linux
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+def io_bytes():
+    """(rchar, read_bytes) of this process so far, or Nones off Linux."""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["read_bytes"])
+    except (OSError, KeyError):
+        return None, None
+
+
+def parse_size(size):
+    """Bytes in a size like '4GB', '512MiB' or '1000000'."""
+    units = {"kb": 10 ** 3, "mb": 10 ** 6, "gb": 10 ** 9, "tb": 10 ** 12,
+             "kib": 2 ** 10, "mib": 2 ** 20, "gib": 2 ** 30, "tib": 2 ** 40, "b": 1}
+    size = size.strip().lower()
+    for unit, factor in sorted(units.items(), key=lambda item: -len(item[0])):
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * factor)
+    return int(size)
+
+
+def start(ceiling_bytes=None):
+    global _sampler, _stop, _ceiling_bytes, _exceeded
+    _ceiling_bytes = ceiling_bytes
+    _exceeded = None
+    _stop = threading.Event()
+    _sampler = threading.Thread(target=_sample, daemon=True)
+    _sampler.start()
+
+
+def stop():
+    global _sampler
+    if _sampler is not None:
+        _stop.set()
+        _sampler.join()
+        _sampler = None
+    watch(None)
+
+
+def watch(con):
+    """Samples DuckDB's memory from, and on a crossed ceiling interrupts, `con`."""
+    global _con, _cur
+    with _lock:
+        if _cur is not None:
+            _cur.close()
+        _con = con
+        # Its own cursor, so sampling doesn't wait for the running query
+        _cur = con.cursor() if con is not None else None
+
+
+def _duckdb_usage():
+    # Called with the lock held
+    if _cur is None:
+        return None, None
+    try:
+        return _cur.execute(
+            "SELECT SUM(memory_usage_bytes)::BIGINT, SUM(temporary_storage_bytes)::BIGINT FROM duckdb_memory()"
+        ).fetchone()
+    except duckdb.Error:
+        return None, None
+
+
+def _sample():
+    global _exceeded
+    while not _stop.wait(SAMPLE_INTERVAL_S):
+        with _lock:
+            if not _windows:
+                continue
+            rss = rss_bytes()
+            memory, temp = _duckdb_usage()
+            for window in _windows:
+                _update_peaks(window, rss, memory, temp)
+            if _ceiling_bytes is not None and rss is not None and rss > _ceiling_bytes and _exceeded is None:
+                _exceeded = (_windows[-1]["name"], rss)
+                if _con is not None:
+                    _con.interrupt()
+                # Stops Python-side work like a large fetchall too
+                _thread.interrupt_main()
+
+
+def _update_peaks(window, rss, memory, temp):
+    for key, value in (("peak_rss_bytes", rss), ("peak_duckdb_bytes", memory), ("peak_temp_bytes", temp)):
+        if value is not None:
+            window[key] = max(window.get(key) or 0, value)
+
+
+def begin(name):
+    """Opens a measurement window, or returns None when accounting is off."""
+    if _sampler is None:
+        return None
+    rchar, read_bytes = io_bytes()
+    window = {"name": name, "rchar": rchar, "read_bytes": read_bytes}
+    with _lock:
+        _update_peaks(window, rss_bytes(), *_duckdb_usage())
+        _windows.append(window)
+    return window
+
+
+def end(window):
+    """
+    Closes `window` and returns its usage: peak RSS, peak DuckDB memory and
+    temp file bytes, and bytes read. Raises MemoryCeilingExceeded if the
+    ceiling was crossed during it.
+    """
+    if window is None:
+        return {}
+    rchar, read_bytes = io_bytes()
+    with _lock:
+        _update_peaks(window, rss_bytes(), *_duckdb_usage())
+        _windows.remove(window)
+        exceeded = _exceeded
+    usage = {
+        "peak_rss_bytes": window.get("peak_rss_bytes"),
+        "peak_duckdb_bytes": window.get("peak_duckdb_bytes"),
+        "peak_temp_bytes": window.get("peak_temp_bytes"),
+        "read_bytes": rchar - window["rchar"] if rchar is not None else None,
+        "storage_read_bytes": read_bytes - window["read_bytes"] if read_bytes is not None else None,
+    }
+    _measured.append({"name": window["name"], **usage})
+    if exceeded is not None:
+        raise MemoryCeilingExceeded(_ceiling_message(*exceeded))
+    return usage
+
+
+def measured():
+    """Every window closed so far with its name and usage, oldest first."""
+    return list(_measured)
+
+
+def _ceiling_message(name, rss):
+    return (f"{name} reached {rss / MIB:.1f}MiB of RSS, over the memory ceiling of "
+            f"{_ceiling_bytes / MIB:.1f}MiB. Raise --memory-ceiling or lower DuckDB's memory_limit "
+            f"so it spills to its temp directory instead.")
+
+
+def exceeded():
+    """
+    The MemoryCeilingExceeded behind an interruption, or None if the ceiling
+    wasn't crossed and the interruption came from elsewhere.
+    """
+    return MemoryCeilingExceeded(_ceiling_message(*_exceeded)) if _exceeded is not None else None
+
+
+def describe(usage):
+    """One line summary of a usage returned by end(), empty when accounting is off."""
+    if not usage:
+        return ""
+
+    def mib(key):
+        return f"{usage[key] / MIB:.1f}MiB" if usage.get(key) is not None else "n/a"
+
+    return (f"(peak RSS {mib('peak_rss_bytes')}, DuckDB {mib('peak_duckdb_bytes')}, "
+            f"temp {mib('peak_temp_bytes')}, read {mib('read_bytes')}, {mib('storage_read_bytes')} from storage)")
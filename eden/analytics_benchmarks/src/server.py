@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Query Server
+------------
+
+Keeps a read-only connection to the preprocessed database open (along with
+DuckDB's buffer pool and the stats catalog) and serves JSON queries in the
+inputs.py format over HTTP, so clients stop paying startup and warm-up on
+every request. Run main.py once without --skip-preprocessing first.
+
+Endpoints:
+  POST /query[?approximate=1]  body is a JSON query, responds with CSV
+                               rows streamed as they are fetched
+  GET  /metrics                latency histogram and percentiles as JSON
+
+With --generations, serves the latest generation published by
+generations.py instead and swaps to new ones as they are published.
+
+Usage:
+  python server.py [--port 8765] [--generations]
+"""
+
+import argparse
+import csv
+import io
+import json
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import duckdb
+import numpy as np
+
+from assembler import assemble_sql
+from catalog import load_catalog
+from generations import GenerationReader
+from inputs import queries
+from main import DB_PATH
+from warmup import warm_up
+
+DEFAULT_PORT = 8765
+# Rows fetched from DuckDB and written to the socket at a time
+FETCH_BATCH_ROWS = 10_000
+# Upper bounds (ms) of the latency histogram buckets, the last one catches the rest
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float("inf")]
+# How many recent latencies to keep for percentiles
+LATENCY_WINDOW = 10_000
+
+con = None
+catalog = None
+# Set by ingest.py when it serves queries from its own connection
+ingest_status = None
+# Set with --generations
+generations = None
+metrics_lock = threading.Lock()
+bucket_counts = [0] * len(LATENCY_BUCKETS_MS)
+recent_latencies_ms = deque(maxlen=LATENCY_WINDOW)
+
+
+def cursor():
+    # Each request thread gets its own connection to the shared database
+    # instance, so they share the buffer pool but not transaction state
+    cur = con.cursor()
+    cur.execute("SET timezone = 'America/Los_Angeles';")
+    return cur
+
+
+@contextmanager
+def snapshot():
+    # The connection and catalog one request runs against from start to end
+    if generations is not None:
+        with generations.acquire() as (cur, snapshot_catalog):
+            yield cur, snapshot_catalog
+    else:
+        cur = cursor()
+        try:
+            yield cur, catalog
+        finally:
+            cur.close()
+
+
+def record_latency(latency_ms):
+    with metrics_lock:
+        bucket = next(i for i, bound in enumerate(LATENCY_BUCKETS_MS) if latency_ms <= bound)
+        bucket_counts[bucket] += 1
+        recent_latencies_ms.append(latency_ms)
+
+
+def metrics():
+    with metrics_lock:
+        latencies = np.array(recent_latencies_ms)
+        return {
+            "count": int(sum(bucket_counts)),
+            "buckets_ms": [
+                {"le": "inf" if bound == float("inf") else bound, "count": count}
+                for bound, count in zip(LATENCY_BUCKETS_MS, bucket_counts)
+            ],
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "ingest": ingest_status,
+        }
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if urlparse(self.path).path != "/metrics":
+            self.send_error(404)
+            return
+        body = json.dumps(metrics()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/query":
+            self.send_error(404)
+            return
+        approximate = parse_qs(url.query).get("approximate", ["0"])[0] == "1"
+
+        t0 = time.time()
+        with snapshot() as (cur, snapshot_catalog):
+            try:
+                q = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                sql = assemble_sql(q, dark_launch=True, approximate=approximate, catalog=snapshot_catalog)
+                res = cur.execute(sql)
+            except (ValueError, KeyError, duckdb.Error) as e:
+                self.send_error(400, explain=str(e))
+                return
+
+            # No Content-Length, the response ends when the connection closes
+            self.send_response(200)
+            self.send_header("Content-Type", "text/csv")
+            self.end_headers()
+            buf = io.StringIO()
+            w = csv.writer(buf)
+            w.writerow([d[0] for d in res.description])
+            while rows := res.fetchmany(FETCH_BATCH_ROWS):
+                w.writerows(rows)
+                self.wfile.write(buf.getvalue().encode())
+                buf.seek(0)
+                buf.truncate()
+            self.wfile.write(buf.getvalue().encode())
+        record_latency((time.time() - t0) * 1000)
+
+    def log_message(self, format, *args):
+        # Keep per-request logging off the hot path
+        pass
+
+
+def serve(port, connection=None, use_generations=False):
+    """
+    Serves queries until interrupted, from `connection` if given (which the
+    caller keeps ownership of), from the published generations or else from
+    a read-only connection.
+    """
+    global con, catalog, generations
+    if use_generations:
+        generations = GenerationReader()
+        threading.Thread(target=generations.watch, daemon=True).start()
+    else:
+        con = connection or duckdb.connect(DB_PATH, read_only=True)
+        con.execute("SET timezone = 'America/Los_Angeles';")
+        catalog = load_catalog(con)
+        # Expect a workload like the benchmark queries
+        warm_up(con, queries, catalog)
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), QueryHandler)
+    print(f"🟩 Serving {'generations' if use_generations else DB_PATH} on http://127.0.0.1:{port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if use_generations:
+            generations.close()
+        elif connection is None:
+            con.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve JSON queries over HTTP from a long-running DuckDB connection."
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=DEFAULT_PORT,
+        help="Local port to listen on"
+    )
+    parser.add_argument(
+        "--generations",
+        action="store_true",
+        help="Serve the generations published by generations.py, swapping to each new one"
+    )
+
+    args = parser.parse_args()
+    serve(args.port, use_generations=args.generations)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Sharded Storage
+---------------
+
+Splits events into several DuckDB files, either by day range or by hash of
+auction_id, and loads each shard in its own process. Queries are answered by
+a coordinator that attaches every shard, runs a partial aggregate on each
+(SUM and COUNT in place of AVG) and merges the partials.
+
+Usage:
+  python shards.py --data-dir ./data --out-dir ./out [--shards 4] [--shard-by day]
+"""
+
+import argparse
+import csv
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+
+import duckdb
+
+from assembler import assemble_sql, partial_query, _is_bucket
+from catalog import load_catalog, matching_stats
+from inputs import queries
+from main import create_types, load_data
+
+SHARD_DIR = Path("tmp/shards")
+DEFAULT_SHARDS = 4
+FROM_TABLE = re.compile(r"\bFROM (events\w*)\b")
+
+
+def shard_paths(n_shards):
+    return [SHARD_DIR / f"shard_{i}.duckdb" for i in range(n_shards)]
+
+
+def shard_filters(data_dir, n_shards, shard_by):
+    """Row filter on the parsed CSV columns that selects each shard's rows."""
+    if shard_by == "auction":
+        return [f"hash(auction_id) % {n_shards} = {i}" for i in range(n_shards)]
+
+    # Contiguous day ranges of equal length, so that shards can be skipped
+    # by day filters
+    con = duckdb.connect()
+    con.execute("SET timezone = 'America/Los_Angeles';")
+    first, last = con.execute(f"""
+        SELECT
+            MIN(DATE(to_timestamp(TRY_CAST(ts AS DOUBLE) / 1000.0))),
+            MAX(DATE(to_timestamp(TRY_CAST(ts AS DOUBLE) / 1000.0)))
+        FROM read_csv('{data_dir / "events_part_*.csv"}', HEADER = TRUE, ALL_VARCHAR = TRUE)
+    """).fetchone()
+    con.close()
+    days_per_shard = -(-((last - first).days + 1) // n_shards)
+    filters = []
+    for i in range(n_shards):
+        low = first + timedelta(days=i * days_per_shard)
+        high = low + timedelta(days=days_per_shard)
+        conds = []
+        # The outermost shards are open ended
+        if i > 0:
+            conds.append(f"DATE(ts) >= DATE '{low}'")
+        if i < n_shards - 1:
+            conds.append(f"DATE(ts) < DATE '{high}'")
+        filters.append(" AND ".join(conds) or "true")
+    return filters
+
+
+def load_shard(path, data_dir, row_filter, threads):
+    con = duckdb.connect(path)
+    con.execute("SET timezone = 'America/Los_Angeles';")
+    # Shards load side by side, so split the cores between them
+    con.execute(f"SET threads = {threads};")
+    # A tuned profile is for a load that has the machine to itself
+    load_data(con, data_dir, row_filter=row_filter, profile={})
+    con.close()
+
+
+def load_shards(data_dir, n_shards, shard_by):
+    SHARD_DIR.mkdir(parents=True, exist_ok=True)
+    paths = shard_paths(n_shards)
+    filters = shard_filters(data_dir, n_shards, shard_by)
+    threads = max(1, (os.cpu_count() or 1) // n_shards)
+    print(f"🟩 Loading {n_shards} shards by {shard_by} ...", file=sys.stderr)
+    with ProcessPoolExecutor(max_workers=n_shards) as pool:
+        for future in [pool.submit(load_shard, path, data_dir, f, threads) for path, f in zip(paths, filters)]:
+            future.result()
+    print(f"🟩 Shards complete", file=sys.stderr)
+
+
+def open_shards(paths):
+    """
+    A coordinator connection with every shard attached read only as
+    shard_<i>, and each shard's catalog.
+    """
+    con = duckdb.connect()
+    con.execute("SET timezone = 'America/Los_Angeles';")
+    # Assembled SQL refers to the type and macros unqualified
+    create_types(con)
+    catalogs = []
+    for i, path in enumerate(paths):
+        con.execute(f"ATTACH '{path}' AS shard_{i} (READ_ONLY);")
+        con.execute(f"USE shard_{i};")
+        catalogs.append(load_catalog(con))
+    con.execute("USE memory;")
+    return con, catalogs
+
+
+def _qualify(sql, i):
+    return FROM_TABLE.sub(lambda m: f"FROM shard_{i}.{m.group(1)}", sql)
+
+
+def scatter_gather_sql(q, catalogs):
+    """
+    One statement that runs a partial query on every shard that may hold
+    matching rows and merges the results, so DuckDB schedules the shards'
+    scans across all cores. Queries whose aggregations can't be merged from
+    partials read the union of the shards instead.
+    """
+    split = partial_query(q)
+    if split is None:
+        union = " UNION ALL ".join(f"SELECT * FROM shard_{i}.events" for i in range(len(catalogs)))
+        return FROM_TABLE.sub(f"FROM ({union}) AS events", assemble_sql(q), count=1)
+    shard_q, merge_select, merge_rest = split
+
+    # Shards whose catalog rules out every row are skipped, but one is
+    # kept so ungrouped aggregations still return their row
+    shards = [i for i, c in enumerate(catalogs) if c is None or matching_stats(q.get("where"), c)] or [0]
+    # The merge refers to keys by name and to partial aggregates by position
+    keys = [item for item in shard_q["select"] if isinstance(item, str) or _is_bucket(item)]
+    names = ["bucket" if _is_bucket(key) else key for key in keys]
+    names += [f"p{j}" for j in range(len(shard_q["select"]) - len(keys))]
+    columns = "" if merge_select == "*" else f"AS s({', '.join(names)})"
+    union = " UNION ALL ".join(
+        f"SELECT * FROM ({_qualify(assemble_sql(shard_q, dark_launch=True, catalog=catalogs[i]), i)}) {columns}"
+        for i in shards
+    )
+    return f"WITH partials AS ({union}) SELECT {merge_select} FROM partials {merge_rest}".strip()
+
+
+def run(queries, data_dir, out_dir, n_shards, shard_by, skip_preprocessing):
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if not skip_preprocessing:
+        load_shards(data_dir, n_shards, shard_by)
+    con, catalogs = open_shards(shard_paths(n_shards))
+
+    results = []
+    for i, q in enumerate(queries, 1):
+        sql = scatter_gather_sql(q, catalogs)
+        print(f"\n🟦 Query {i}:\n{q}\n", file=sys.stderr)
+        t0 = time.time()
+        res = con.execute(sql)
+        cols = [d[0] for d in res.description]
+        rows = res.fetchall()
+        dt = time.time() - t0
+
+        print(f"✅ Rows: {len(rows)} | Time: {dt:.3f}s", file=sys.stderr)
+
+        with (out_dir / f"q{i}.csv").open("w", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(cols)
+            w.writerows(rows)
+
+        results.append({"query": i, "rows": len(rows), "time": dt})
+    con.close()
+
+    print("\nSummary:")
+    for r in results:
+        print(f"Q{r['query']}: {r['time']:.3f}s ({r['rows']} rows)")
+    print(f"Total time: {sum(r['time'] for r in results):.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load events into several DuckDB shards in parallel and run the benchmark queries across them."
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        required=True,
+        help="The folder where the input CSV is provided"
+    )
+    parser.add_argument(
+        "--out-dir",
+        type=Path,
+        required=True,
+        help="Where to output query results"
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=DEFAULT_SHARDS,
+        help="Number of shard files, each loaded by its own process"
+    )
+    parser.add_argument(
+        "--shard-by",
+        choices=["day", "auction"],
+        default="day",
+        help="Split events into day ranges or by hash of auction_id"
+    )
+    parser.add_argument(
+        "--skip-preprocessing",
+        action="store_true",
+        help="Reuse the shards from a previous run"
+    )
+
+    args = parser.parse_args()
+    run(queries, args.data_dir, args.out_dir, args.shards, args.shard_by, args.skip_preprocessing)
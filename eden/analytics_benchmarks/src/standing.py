@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Standing Queries
+----------------
+
+Registers JSON queries in the inputs.py format as standing queries, whose
+results are kept up to date as ingest.py appends events. Each one keeps a
+state table with a row per group of partial aggregates, like the shards'
+(SUM and COUNT in place of AVG). Each ingested batch is aggregated by group
+and merged into the groups it touches, in the batch's transaction.
+assemble_sql answers a registered query from its state table, so reading it
+costs as much as its result is large instead of a scan of events or the
+rollups.
+
+Registering needs the database's single writer, so it can't run while
+ingest.py does.
+
+Usage:
+  python standing.py --register NAME (--query JSON | --input N)
+  python standing.py --drop NAME
+  python standing.py --show NAME
+  python standing.py
+"""
+
+import argparse
+import csv
+import json
+import re
+import sys
+import time
+
+import duckdb
+
+from assembler import assemble_sql, partial_query, _is_bucket
+from catalog import load_catalog, standing_key, STANDING_TABLE
+
+# How the partials of a group merge with those of the same group in a batch
+MERGE_PARTIALS = {"SUM": "SUM", "COUNT": "SUM", "MIN": "MIN", "MAX": "MAX"}
+
+
+def state_table(name):
+    return f"standing_{name}"
+
+
+def _plan(q):
+    """
+    The partial query that builds and maintains `q`'s state, the state's
+    column names and the merge of `q`'s result from its state, or raises
+    ValueError if `q` can't be maintained from partials.
+    """
+    split = partial_query(q)
+    if split is None or split[1] == "*":
+        raise ValueError("Standing queries need aggregations that merge from partials: SUM, COUNT, AVG, MIN, MAX")
+    partial_q, merge_select, merge_rest = split
+    keys = ["bucket" if _is_bucket(item) else item
+            for item in partial_q["select"] if isinstance(item, str) or _is_bucket(item)]
+    partials = [next(iter(item)) for item in partial_q["select"] if isinstance(item, dict) and not _is_bucket(item)]
+    return partial_q, keys, partials, merge_select, merge_rest
+
+
+def _registry_exists(con):
+    return con.execute("SELECT 1 FROM duckdb_tables() WHERE table_name = ?", [STANDING_TABLE]).fetchone() is not None
+
+
+def registered(con):
+    """{name: query} of every standing query."""
+    if not _registry_exists(con):
+        return {}
+    return {name: json.loads(q) for name, q in con.execute(f"SELECT name, query FROM {STANDING_TABLE}").fetchall()}
+
+
+def _build(con, name, q, catalog):
+    partial_q, keys, partials, _, _ = _plan(q)
+    columns = ", ".join(keys + [f"p{i}" for i in range(len(partials))])
+    con.execute(f"""
+        CREATE OR REPLACE TABLE {state_table(name)} AS
+        SELECT * FROM ({assemble_sql(partial_q, dark_launch=True, catalog=catalog)}) AS s({columns});
+    """)
+
+
+def register(con, name, q):
+    """Registers `q` as standing query `name`, replacing one of that name."""
+    if not re.fullmatch(r"\w+", name):
+        raise ValueError(f"Invalid standing query name {name!r}, use letters, digits and underscores")
+    _, _, _, merge_select, merge_rest = _plan(q)
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {STANDING_TABLE} (
+          name VARCHAR,
+          key VARCHAR,
+          query VARCHAR,
+          read_sql VARCHAR,
+          registered_at TIMESTAMP,
+          refreshed_at TIMESTAMP);
+    """)
+    catalog = load_catalog(con)
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        _build(con, name, q, catalog)
+        con.execute(f"DELETE FROM {STANDING_TABLE} WHERE name = ?;", [name])
+        con.execute(
+            f"INSERT INTO {STANDING_TABLE} VALUES (?, ?, ?, ?, now(), now());",
+            [name, standing_key(q), json.dumps(q),
+             f"SELECT {merge_select} FROM {state_table(name)} AS partials {merge_rest}".strip()],
+        )
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+
+
+def drop(con, name):
+    if _registry_exists(con):
+        con.execute(f"DELETE FROM {STANDING_TABLE} WHERE name = ?;", [name])
+    con.execute(f"DROP TABLE IF EXISTS {state_table(name)};")
+
+
+def rebuild(con):
+    """Rebuilds every standing query from events, after load_data replaced it."""
+    catalog = load_catalog(con)
+    for name, q in registered(con).items():
+        _build(con, name, q, catalog)
+    if _registry_exists(con):
+        con.execute(f"UPDATE {STANDING_TABLE} SET refreshed_at = now();")
+
+
+def maintain(con, delta_table):
+    """
+    Merges the events in `delta_table` into every standing query. Returns
+    {name: (columns, rows)} with the new result rows of the groups the
+    delta touched. Runs in the caller's transaction.
+    """
+    changed = {}
+    for name, q in registered(con).items():
+        partial_q, keys, partials, _, _ = _plan(q)
+        # The result rows of the touched groups, in q's order but unlimited
+        _, _, _, merge_select, merge_rest = _plan({**q, "limit": None, "offset": None})
+        columns = ", ".join(keys + [f"p{i}" for i in range(len(partials))])
+        delta_sql = re.sub(r"\bFROM events\b", f"FROM {delta_table}", assemble_sql(partial_q), count=1)
+        con.execute(f"CREATE OR REPLACE TEMP TABLE standing_delta AS SELECT * FROM ({delta_sql}) AS s({columns});")
+
+        # NULL is a group key like any other
+        touched = " AND ".join(f"s.{key} IS NOT DISTINCT FROM d.{key}" for key in keys) or "true"
+        merged = ", ".join(f"{MERGE_PARTIALS[partial]}(p{i}) AS p{i}" for i, partial in enumerate(partials))
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE standing_merged AS
+            SELECT {", ".join(keys + [merged])}
+            FROM (
+                SELECT * FROM {state_table(name)} s WHERE EXISTS (SELECT 1 FROM standing_delta d WHERE {touched})
+                UNION ALL
+                SELECT * FROM standing_delta
+            )
+            {f"GROUP BY {', '.join(keys)}" if keys else ""};
+        """)
+        con.execute(f"""
+            DELETE FROM {state_table(name)} s
+            WHERE EXISTS (SELECT 1 FROM standing_delta d WHERE {touched});
+        """)
+        con.execute(f"INSERT INTO {state_table(name)} SELECT * FROM standing_merged;")
+
+        res = con.execute(f"SELECT {merge_select} FROM standing_merged AS partials {merge_rest}")
+        changed[name] = ([d[0] for d in res.description], res.fetchall())
+    if changed:
+        con.execute(f"UPDATE {STANDING_TABLE} SET refreshed_at = now();")
+        con.execute("DROP TABLE standing_delta; DROP TABLE standing_merged;")
+    return changed
+
+
+def result(con, name):
+    """(columns, rows) of standing query `name`'s current result."""
+    (read_sql,) = con.execute(f"SELECT read_sql FROM {STANDING_TABLE} WHERE name = ?", [name]).fetchone()
+    res = con.execute(read_sql)
+    return [d[0] for d in res.description], res.fetchall()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Register, drop, list and read standing queries that ingest.py keeps up to date."
+    )
+    parser.add_argument(
+        "--register",
+        metavar="NAME",
+        help="Register a standing query under this name"
+    )
+    parser.add_argument(
+        "--query",
+        type=json.loads,
+        help="The JSON query to register"
+    )
+    parser.add_argument(
+        "--input",
+        type=int,
+        help="Register the Nth (from 1) of the queries in inputs.py instead of --query"
+    )
+    parser.add_argument(
+        "--drop",
+        metavar="NAME",
+        help="Drop a standing query"
+    )
+    parser.add_argument(
+        "--show",
+        metavar="NAME",
+        help="Print a standing query's current result as CSV"
+    )
+
+    args = parser.parse_args()
+    from main import DB_PATH
+    if args.show:
+        con = duckdb.connect(DB_PATH, read_only=True)
+        con.execute("SET timezone = 'America/Los_Angeles';")
+        t0 = time.time()
+        cols, rows = result(con, args.show)
+        print(f"✅ Rows: {len(rows)} | Time: {time.time() - t0:.3f}s", file=sys.stderr)
+        w = csv.writer(sys.stdout)
+        w.writerow(cols)
+        w.writerows(rows)
+    else:
+        con = duckdb.connect(DB_PATH)
+        con.execute("SET timezone = 'America/Los_Angeles';")
+        if args.register:
+            if args.input is not None:
+                from inputs import queries
+                q = queries[args.input - 1]
+            elif args.query is not None:
+                q = args.query
+            else:
+                parser.error("--register needs --query or --input")
+            t0 = time.time()
+            register(con, args.register, q)
+            print(f"🟩 Registered {args.register} in {time.time() - t0:.3f}s", file=sys.stderr)
+        elif args.drop:
+            drop(con, args.drop)
+            print(f"🟩 Dropped {args.drop}", file=sys.stderr)
+        for name, q in registered(con).items():
+            (groups,) = con.execute(f"SELECT COUNT(*) FROM {state_table(name)}").fetchone()
+            print(f"{name}: {groups} groups\t{json.dumps(q)}")
+    con.close()
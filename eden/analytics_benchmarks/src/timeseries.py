@@ -0,0 +1,79 @@
+# Downsampled time-series queries over the events table
+#
+# Plotting every minute bucket over months of data produces millions of
+# points, far more than a plot can show. These helpers aggregate a series
+# inside DuckDB and then reduce it with M4 (keep the first, last, min and max
+# point of every pixel column), which is visually lossless for line plots
+# while bounding the output to at most 4 * width points.
+
+from assembler import _where_to_sql
+
+TEMPORALS = ["minute", "hour", "day", "week"]
+
+
+def downsampled_series_sql(width, time_block="minute", start=None, end=None, where=None, agg=None):
+    """
+    Builds SQL returning an M4-downsampled (t, value) series of `agg`
+    (default COUNT(*)) per `time_block` for a plot `width` pixels wide.
+    `start`/`end` bound the time window on `ts` and `where` accepts extra
+    filters in the JSON query format from inputs.py.
+    """
+    if time_block not in TEMPORALS:
+        raise ValueError(f"time_block must be one of {TEMPORALS}, got {time_block!r}")
+    if width < 1:
+        raise ValueError(f"width must be positive, got {width}")
+    func, col = next(iter((agg or {"COUNT": "*"}).items()))
+
+    where_sql = _where_to_sql(where)
+    window = []
+    if start is not None:
+        window.append(f"ts >= '{start}'")
+    if end is not None:
+        window.append(f"ts < '{end}'")
+    if window:
+        where_sql = (where_sql + " AND " if where_sql else "WHERE ") + " AND ".join(window)
+
+    # Pixel columns span the requested window, or the data when unbounded,
+    # so that a zoomed-in plot gets its full width of detail.
+    lo = f"epoch(TIMESTAMP '{start}')" if start is not None else "epoch(t::TIMESTAMP)"
+    hi = f"epoch(TIMESTAMP '{end}')" if end is not None else "epoch(t::TIMESTAMP)"
+    return f"""
+        WITH series AS (
+            SELECT {time_block} AS t, {func.upper()}({col}) AS v
+            FROM events {where_sql}
+            GROUP BY {time_block}
+        ),
+        bounds AS (
+            SELECT MIN({lo}) AS lo, MAX({hi}) AS hi FROM series
+        ),
+        binned AS (
+            SELECT
+                t,
+                v,
+                LEAST({width - 1}, FLOOR({width} * (epoch(t::TIMESTAMP) - lo) / GREATEST(hi - lo, 1)))::INTEGER AS px
+            FROM series, bounds
+        ),
+        m4 AS (
+            SELECT
+                px,
+                MIN(t) AS t_first,
+                MAX(t) AS t_last,
+                ARG_MIN(t, v) AS t_min,
+                ARG_MAX(t, v) AS t_max
+            FROM binned
+            GROUP BY px
+        )
+        SELECT b.t AS which, b.v AS value
+        FROM binned b JOIN m4 ON b.px = m4.px
+        WHERE b.t IN (m4.t_first, m4.t_last, m4.t_min, m4.t_max)
+        ORDER BY b.t
+    """.strip()
+
+
+def downsampled_series(con, width, time_block="minute", start=None, end=None, where=None, agg=None):
+    """
+    Runs `downsampled_series_sql` on `con` and returns a DataFrame with
+    columns `which` and `value`, at most 4 * `width` rows regardless of range.
+    """
+    sql = downsampled_series_sql(width, time_block, start, end, where, agg)
+    return con.execute(sql).fetchdf()
@@ -0,0 +1,66 @@
+# Stage tracing
+#
+# Records spans (a stage's name, start, duration and arguments such as row
+# counts and bytes) as complete events of the Chrome Trace Event Format, so a
+# run can be opened in chrome://tracing or https://ui.perfetto.dev. Viewers
+# nest spans of one thread by time, so a span recorded inside another's
+# interval shows up as its child. Tracing is off until start(), and until then
+# spans only cost a branch.
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_events = None
+_lock = threading.Lock()
+
+
+def start():
+    global _events
+    _events = []
+
+
+def enabled():
+    return _events is not None
+
+
+def record(name, t0, **args):
+    """Records a span named `name` from `t0` (a time.time()) until now."""
+    if _events is None:
+        return
+    t1 = time.time()
+    event = {
+        "name": name,
+        "ph": "X",
+        # Microseconds, as the format expects
+        "ts": t0 * 1e6,
+        "dur": (t1 - t0) * 1e6,
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+        "args": args,
+    }
+    with _lock:
+        _events.append(event)
+
+
+@contextmanager
+def span(name, **args):
+    """
+    Records the enclosed block as a span. Yields its arguments, so the
+    block can add counts it only knows at the end.
+    """
+    t0 = time.time()
+    try:
+        yield args
+    finally:
+        record(name, t0, **args)
+
+
+def write(path):
+    """Writes the spans recorded since start() to `path`."""
+    with _lock:
+        events = list(_events or [])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+DuckDB Resource Tuning
+----------------------
+
+Sweeps threads, memory_limit and temp_directory for each stage of load_data
+(loading the CSVs, sorting events, building the catalog and rollups) and for
+each class of query (those a rollup answers and those that scan events) on
+this machine, and saves the fastest settings per stage to tmp/profile.json.
+load_data and main.py's run apply the profile automatically when it exists.
+
+Settings are swept one at a time, keeping the best value found for the ones
+before. Every load is a full load_data into a scratch database, which times
+all stages at once.
+
+Usage:
+  python tuning.py --data-dir ./data [--repeat 2] [--temp-dirs tmp/spill,/mnt/fast/spill]
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from pathlib import Path
+
+import duckdb
+
+PROFILE_PATH = Path("tmp/profile.json")
+SCRATCH_DB_PATH = Path("tmp/tuning.duckdb")
+LOAD_STAGES = ["load", "sort", "rollups"]
+QUERY_CLASSES = ["query_scan", "query_rollup"]
+SETTINGS = ["threads", "memory_limit", "temp_directory"]
+ROLLUP_SQL = re.compile(r"\bFROM events_bids_")
+# How much faster than the best so far a value has to be to replace it, so
+# that noise doesn't pick settings
+MIN_GAIN = 0.05
+
+_profile_cache = {}
+
+
+def load_profile(path=PROFILE_PATH):
+    """The saved profile, or an empty one if the machine hasn't been tuned."""
+    if path not in _profile_cache:
+        _profile_cache[path] = json.loads(path.read_text()) if path.exists() else {}
+    return _profile_cache[path]
+
+
+def apply_profile(con, stage, profile=None):
+    """
+    Sets the tuned settings of `stage` on `con`. A None value resets the
+    setting to DuckDB's default. Stages without a profile are left as is.
+    """
+    profile = load_profile() if profile is None else profile
+    for setting, value in profile.get(stage, {}).items():
+        if value is None:
+            con.execute(f"RESET {setting};")
+        elif isinstance(value, str):
+            con.execute(f"SET {setting} = '{value}';")
+        else:
+            con.execute(f"SET {setting} = {value};")
+
+
+def query_class(sql):
+    return "query_rollup" if ROLLUP_SQL.search(sql) else "query_scan"
+
+
+def candidates(temp_dirs):
+    """Values to try for each setting. None is DuckDB's default."""
+    cpus = os.cpu_count() or 1
+    threads = sorted({1, *(2 ** i for i in range(cpus.bit_length()) if 2 ** i <= cpus), cpus})
+    memory_mib = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2 ** 20
+    return {
+        "threads": [None, *threads],
+        "memory_limit": [None, *(f"{int(memory_mib * fraction)}MiB" for fraction in (0.25, 0.5, 0.75))],
+        "temp_directory": [None, *temp_dirs],
+    }
+
+
+def _time_load(data_dir, profile):
+    # Imported here because main.py imports this module
+    from main import load_data
+
+    SCRATCH_DB_PATH.unlink(missing_ok=True)
+    con = duckdb.connect(SCRATCH_DB_PATH)
+    con.execute("SET timezone = 'America/Los_Angeles';")
+    timings = load_data(con, data_dir, profile=profile)
+    con.close()
+    return timings
+
+
+def _time_queries(con, workload, profile):
+    from assembler import assemble_sql
+    from catalog import load_catalog
+
+    catalog = load_catalog(con)
+    timings = dict.fromkeys(QUERY_CLASSES, 0.0)
+    for q in workload:
+        try:
+            sql = assemble_sql(q, dark_launch=True, catalog=catalog)
+        except ValueError:
+            continue
+        stage = query_class(sql)
+        apply_profile(con, stage, profile)
+        t0 = time.time()
+        try:
+            con.execute(sql).fetchall()
+        except duckdb.Error:
+            continue
+        timings[stage] += time.time() - t0
+    return timings
+
+
+def _best_of(repeat, measure):
+    # Fastest time per stage over `repeat` measurements
+    best = {}
+    for _ in range(repeat):
+        for stage, seconds in measure().items():
+            best[stage] = min(best.get(stage, seconds), seconds)
+    return best
+
+
+def tune(data_dir, repeat, temp_dirs):
+    from inputs import queries, extended_queries
+
+    values = candidates(temp_dirs)
+    stages = LOAD_STAGES + QUERY_CLASSES
+    profile = {stage: {} for stage in stages}
+    best_times = {}
+    default_times = {}
+
+    # An unmeasured load first, so the OS page cache holds the CSVs for every
+    # candidate and the first one isn't penalized
+    print(f"🟦 Warming up ...", file=sys.stderr)
+    _time_load(data_dir, {})
+
+    for setting in SETTINGS:
+        if len(values[setting]) == 1:
+            continue
+        for value in values[setting]:
+            trial = {stage: {**profile[stage], setting: value} for stage in stages}
+            print(f"🟦 Trying {setting} = {value if value is not None else 'default'} ...", file=sys.stderr)
+            times = _best_of(repeat, lambda: _time_load(data_dir, trial))
+            # Queries run against the database the trial just loaded, warmed
+            # by the first repetition
+            con = duckdb.connect(SCRATCH_DB_PATH, read_only=True)
+            con.execute("SET timezone = 'America/Los_Angeles';")
+            _time_queries(con, queries + extended_queries, trial)
+            times.update(_best_of(repeat, lambda: _time_queries(con, queries + extended_queries, trial)))
+            con.close()
+
+            if all(v is None for v in trial["load"].values()):
+                default_times = times
+            for stage in stages:
+                if stage not in best_times or times[stage] < best_times[stage] * (1 - MIN_GAIN):
+                    best_times[stage] = times[stage]
+                    profile[stage] = trial[stage]
+        # Stages run one after another on a connection, so every stage sets
+        # every swept setting instead of inheriting the previous stage's
+        for stage in stages:
+            profile[stage].setdefault(setting, None)
+    SCRATCH_DB_PATH.unlink(missing_ok=True)
+
+    PROFILE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    PROFILE_PATH.write_text(json.dumps(profile, indent=2))
+    _profile_cache.pop(PROFILE_PATH, None)
+
+    print("\nBest settings:")
+    for stage in stages:
+        settings = ", ".join(f"{k}={v}" for k, v in profile[stage].items() if v is not None) or "defaults"
+        default = default_times.get(stage, best_times[stage])
+        gain = (default - best_times[stage]) / default * 100 if default else 0.0
+        print(f"{stage}: {settings}\t{best_times[stage]:.3f}s vs {default:.3f}s with defaults ({gain:.1f}% faster)")
+    print(f"Profile written to {PROFILE_PATH}")
+    return profile
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find the fastest DuckDB threads, memory_limit and temp_directory for each load stage and query class."
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        required=True,
+        help="The folder where the input CSV is provided"
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=2,
+        help="Measurements per setting, of which the fastest counts"
+    )
+    parser.add_argument(
+        "--temp-dirs",
+        type=lambda s: s.split(","),
+        default=[],
+        help="Comma separated spill directories to try besides DuckDB's default"
+    )
+
+    args = parser.parse_args()
+    tune(args.data_dir, args.repeat, args.temp_dirs)
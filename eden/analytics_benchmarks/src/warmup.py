@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Warm-up Planner
+---------------
+
+Instead of running random queries before a workload, assemble the
+workload's own SQL, work out which tables and columns (and, through the
+stats catalog, which ts ranges) it will read and read exactly those into
+DuckDB's buffer pool, within a time budget.
+
+Run directly to measure how much first-query latency the warm-up removes:
+  python warmup.py [--budget SECONDS]
+"""
+
+import argparse
+import re
+import threading
+import time
+from pathlib import Path
+
+import duckdb
+
+from assembler import assemble_sql
+from catalog import load_catalog, matching_stats, ts_bounds
+from inputs import queries
+
+# Seconds the warm-up may take before it stops early
+WARMUP_BUDGET_S = 5.0
+
+FROM_TABLE = re.compile(r"\bFROM\s+([A-Za-z_]\w*)")
+
+
+def plan_warm_up(con, workload, catalog=None, approximate=False):
+    """
+    Returns [(table, columns, ts ranges or None for the whole table)] that
+    `workload` will read, in the order the workload first reads them.
+    """
+    relation_columns = {}
+    # Tables a ts range can be read from, which standing query state with
+    # its formatted minute isn't
+    timed = set()
+    for table, column, data_type in con.execute(
+            "SELECT table_name, column_name, data_type FROM duckdb_columns()").fetchall():
+        relation_columns.setdefault(table, []).append(column)
+        if column in ("ts", "minute") and data_type.startswith("TIMESTAMP"):
+            timed.add(table)
+
+    plan = {}
+    for q in workload:
+        sql = assemble_sql(q, dark_launch=True, approximate=approximate, catalog=catalog)
+        if "WHERE false" in sql:
+            continue
+        tokens = set(re.findall(r"\w+", sql))
+        bounds = None
+        if catalog is not None:
+            entries = matching_stats(q.get("where"), catalog)
+            bounds = ts_bounds(entries, catalog) if entries else None
+        for table in FROM_TABLE.findall(sql):
+            if table not in relation_columns:
+                # A CTE or subquery alias
+                continue
+            columns = [c for c in relation_columns[table] if c in tokens]
+            table_plan = plan.setdefault(table, {"columns": [], "ranges": []})
+            table_plan["columns"] += [c for c in columns if c not in table_plan["columns"]]
+            if bounds is None or table not in timed:
+                table_plan["ranges"] = None
+            elif table_plan["ranges"] is not None and bounds not in table_plan["ranges"]:
+                table_plan["ranges"].append(bounds)
+    return [(table, p["columns"], p["ranges"]) for table, p in plan.items() if p["columns"]]
+
+
+def warm_up_sql(table, columns, ranges, has_ts):
+    # Summing hashes forces every value to be read, unlike MIN/MAX which
+    # could be answered from statistics
+    touch = ", ".join(f"SUM(hash({c}))" for c in columns)
+    where = ""
+    if ranges:
+        # Tables without ts that have ranges are minute rollups
+        col = "ts" if has_ts else "minute"
+        where = "WHERE " + " OR ".join(
+            f"{col} BETWEEN DATE_TRUNC('minute', TIMESTAMP '{low}') AND TIMESTAMP '{high}'"
+            for low, high in ranges
+        )
+    return f"SELECT {touch} FROM {table} {where}".strip()
+
+
+def warm_up(con, workload, catalog=None, approximate=False, budget_s=WARMUP_BUDGET_S):
+    """
+    Reads what `workload` will read, stopping once `budget_s` seconds have
+    passed. Returns (statements run, statements planned, seconds spent).
+    """
+    t0 = time.time()
+    plan = plan_warm_up(con, workload, catalog, approximate)
+    with_ts = {row[0] for row in con.execute("SELECT table_name FROM duckdb_columns() WHERE column_name = 'ts'").fetchall()}
+    done = 0
+    for table, columns, ranges in plan:
+        remaining = budget_s - (time.time() - t0)
+        if remaining <= 0:
+            break
+        # Interrupt a statement that would run past the budget
+        timer = threading.Timer(remaining, con.interrupt)
+        timer.start()
+        try:
+            con.execute(warm_up_sql(table, columns, ranges, table in with_ts)).fetchall()
+            done += 1
+        except duckdb.InterruptException:
+            break
+        finally:
+            timer.cancel()
+    return done, len(plan), time.time() - t0
+
+
+def first_query_latencies(db_path, workload, budget_s=None, approximate=False):
+    # A fresh database instance starts with an empty buffer pool. The OS
+    # page cache stays warm between calls, so this measures what the buffer
+    # pool warm-up saves on top of it.
+    con = duckdb.connect(db_path, read_only=True)
+    con.execute("SET timezone = 'America/Los_Angeles';")
+    catalog = load_catalog(con)
+    if budget_s is not None:
+        warm_up(con, workload, catalog, approximate, budget_s)
+    latencies = []
+    for q in workload:
+        sql = assemble_sql(q, dark_launch=True, approximate=approximate, catalog=catalog)
+        t0 = time.time()
+        con.execute(sql).fetchall()
+        latencies.append(time.time() - t0)
+    con.close()
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure first-query latency with and without the planned warm-up."
+    )
+    parser.add_argument(
+        "--db",
+        type=Path,
+        default=Path("tmp/baseline.duckdb"),
+        help="Preprocessed database to query"
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=WARMUP_BUDGET_S,
+        help="Warm-up time budget in seconds"
+    )
+
+    args = parser.parse_args()
+    cold = first_query_latencies(args.db, queries)
+    warm = first_query_latencies(args.db, queries, budget_s=args.budget)
+    for i, (c, w) in enumerate(zip(cold, warm), 1):
+        print(f"Q{i}: cold {c:.3f}s\twarmed {w:.3f}s\tremoved {c - w:.3f}s")
+    print(f"Total: cold {sum(cold):.3f}s\twarmed {sum(warm):.3f}s\tremoved {sum(cold) - sum(warm):.3f}s "
+          f"({(sum(cold) - sum(warm)) / sum(cold):.1%})")